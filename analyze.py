@@ -34,8 +34,8 @@ def get_prediction(config_name, saved_suffix, gpu_id):
     else:
         # Get prediction
         model = runner.initialize_model(saved_suffix)
-        examples_train, examples_dev, examples_test = runner.data.get_tensor_examples()
-        stored_info = runner.data.get_stored_info()
+        examples_test = runner.data.get_split_examples('tst')
+        stored_info = runner.data.get_stored_info(['tst'])
 
         samples_test = [example[1] for example in examples_test]
         predicted_clusters, predicted_spans, predicted_antecedents = runner.predict(model, samples_test)
@@ -63,8 +63,8 @@ def get_prediction_wo_hoi(config_name, saved_suffix, gpu_id):
     else:
         # Get prediction
         model = runner.initialize_model(saved_suffix)
-        examples_train, examples_dev, examples_test = runner.data.get_tensor_examples()
-        stored_info = runner.data.get_stored_info()
+        examples_test = runner.data.get_split_examples('tst')
+        stored_info = runner.data.get_stored_info(['tst'])
 
         # Turn off HOI after model initialization
         if '_cm' in config_name:
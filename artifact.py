@@ -0,0 +1,142 @@
+""" Inference artifact: one file of config, tokenizer vocab and all model weights.
+Layout of safetensors: 8-byte little-endian header size, JSON header of {name: dtype, shape, data_offsets} and
+string metadata, then raw tensor data; tensors are memory-mapped on loading, read from disk when first accessed.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import struct
+from os.path import join
+import numpy as np
+import pyhocon
+import torch
+import torch.nn as nn
+import torch.nn.init as init
+from transformers import PreTrainedModel
+from model import CorefModel
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+dtype_names = {
+    torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+    torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8', torch.uint8: 'U8', torch.bool: 'BOOL'
+}
+numpy_dtypes = {
+    'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.int16,  # Raw bits of bfloat16, not in numpy
+    'I64': np.int64, 'I32': np.int32, 'I16': np.int16, 'I8': np.int8, 'U8': np.uint8, 'BOOL': np.bool_
+}
+
+
+def save_artifact(path, model, config, tokenizer):
+    state_dict = {name: tensor.detach().cpu().contiguous() for name, tensor in model.state_dict().items()}
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())  # Keep each tensor aligned
+
+    header, offset = {}, 0
+    for name in names:
+        tensor = state_dict[name]
+        num_bytes = tensor.element_size() * tensor.nelement()
+        header[name] = {'dtype': dtype_names[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + num_bytes]}
+        offset += num_bytes
+    vocab = sorted(tokenizer.vocab.items(), key=lambda item: item[1])
+    header['__metadata__'] = {
+        'config': pyhocon.HOCONConverter.to_json(config),
+        'bert_config': json.dumps(model.bert.config.to_dict()),
+        'num_genres': str(model.num_genres),
+        'vocab': '\n'.join(token for token, _ in vocab),
+        'do_lower_case': json.dumps(tokenizer.basic_tokenizer.do_lower_case)
+    }
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-len(header) % 8)  # Tensor data starts aligned
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name in names:
+            tensor = state_dict[name]
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+    os.replace(path + '.tmp', path)
+    logger.info('Saved inference artifact of %d tensors, %.1fMB to %s' % (len(names), offset / 1024 ** 2, path))
+
+
+def read_artifact(path):
+    """ Return metadata and {name: tensor}; tensors are copy-on-write memory maps of the file """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    metadata = header.pop('__metadata__')
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size) if header else None
+    tensors = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        array = data[start: end].view(numpy_dtypes[info['dtype']]).reshape(info['shape'])
+        tensors[name] = torch.from_numpy(array)
+        if info['dtype'] == 'BF16':
+            tensors[name] = tensors[name].view(torch.bfloat16)
+    return metadata, tensors
+
+
+@contextlib.contextmanager
+def skip_weight_init():
+    """ Build modules without random init of weights, which are all overwritten on loading """
+    patched = [(nn.Linear, 'reset_parameters'), (nn.Embedding, 'reset_parameters'), (nn.LayerNorm, 'reset_parameters'),
+               (PreTrainedModel, 'init_weights'), (init, 'normal_'), (init, 'zeros_')]
+    originals = [getattr(obj, name) for obj, name in patched]
+    for obj, name in patched:
+        setattr(obj, name, lambda *args, **kwargs: None)
+    try:
+        yield
+    finally:
+        for (obj, name), original in zip(patched, originals):
+            setattr(obj, name, original)
+
+
+def load_config(path):
+    """ Config of exported model; bert_vocab and bert_do_lower_case are set to build the tokenizer of artifact in memory """
+    metadata, _ = read_artifact(path)
+    config = pyhocon.ConfigFactory.from_dict(json.loads(metadata['config']))
+    config['bert_vocab'] = metadata['vocab'].split('\n')
+    config['bert_do_lower_case'] = json.loads(metadata['do_lower_case'])
+    return config
+
+
+def load_model(path, config, device):
+    """ Build model without pretrained BERT weights; all weights are from artifact without copying """
+    metadata, tensors = read_artifact(path)
+    with skip_weight_init():
+        model = CorefModel(config, device, int(metadata['num_genres']), bert_config=json.loads(metadata['bert_config']))
+    model_tensors = model.state_dict(keep_vars=True)
+    missing, unexpected = model_tensors.keys() - tensors.keys(), tensors.keys() - model_tensors.keys()
+    if missing or unexpected:
+        raise ValueError(f'Artifact does not match model: missing {sorted(missing)}; unexpected {sorted(unexpected)}')
+    for name, tensor in tensors.items():
+        if model_tensors[name].shape != tensor.shape:
+            raise ValueError(f'Artifact does not match model: {name} of shape {tuple(tensor.shape)} instead of '
+                             f'{tuple(model_tensors[name].shape)}')
+        model_tensors[name].data = tensor
+    logger.info('Loaded model from inference artifact %s' % path)
+    return model
+
+
+if __name__ == '__main__':
+    from run import Runner
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_name', type=str, required=True,
+                        help='Configuration name in experiments.conf')
+    parser.add_argument('--model_identifier', type=str, required=True,
+                        help='Model identifier to export')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='Path of artifact; model_[model_identifier].safetensors in log dir by default')
+    args = parser.parse_args()
+
+    runner = Runner(args.config_name, None)
+    model = runner.initialize_model(args.model_identifier)
+    output_path = args.output_path or join(runner.config['log_dir'], f'model_{args.model_identifier}.safetensors')
+    save_artifact(output_path, model, runner.config, runner.data.tokenizer)
@@ -0,0 +1,470 @@
+import argparse
+import inspect
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import util
+import conll
+import artifact
+import export
+import higher_order as ho
+import metrics
+from model import CorefModel
+from preprocess import get_document
+from tensorize import Tensorizer, CachedTensorExamples
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_random_candidates(num_words, max_span_width, device, avg_sentence_len=20):
+    """ Candidate spans within random sentences, same as in CorefModel.get_predictions_and_loss """
+    sentence_map = torch.cumsum((torch.rand(num_words) < 1 / avg_sentence_len).to(torch.long), dim=0).to(device)
+    candidate_starts = torch.unsqueeze(torch.arange(0, num_words, device=device), 1).repeat(1, max_span_width)
+    candidate_ends = candidate_starts + torch.arange(0, max_span_width, device=device)
+    candidate_start_sent_idx = sentence_map[candidate_starts]
+    candidate_end_sent_idx = sentence_map[torch.min(candidate_ends, torch.tensor(num_words - 1, device=device))]
+    candidate_mask = (candidate_ends < num_words) & (candidate_start_sent_idx == candidate_end_sent_idx)
+    return candidate_starts[candidate_mask], candidate_ends[candidate_mask]
+
+
+def time_fn(fn, num_runs, device):
+    result = fn()  # Warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    for _ in range(num_runs):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return result, (time.time() - start_time) / num_runs
+
+
+def get_cpu_peak_memory(fn):
+    """ Peak CPU memory of tensors allocated during fn, by memory usage of top-level profiler events in time order;
+    None if the profiler has no memory profiling
+    """
+    if 'profile_memory' not in inspect.signature(torch.autograd.profiler.profile).parameters:
+        return None
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    events = sorted((e for e in prof.function_events if e.cpu_parent is None), key=lambda e: e.time_range.start)
+    return max(itertools.accumulate(e.cpu_memory_usage for e in events), default=0)
+
+
+def benchmark_extract_spans(args, device):
+    for num_words in args.num_words:
+        candidate_starts, candidate_ends = get_random_candidates(num_words, args.max_span_width, device)
+        candidate_scores = torch.randn(candidate_starts.shape[0], device=device)
+        num_top_spans = int(min(args.max_num_extracted_spans, args.top_span_ratio * num_words))
+
+        candidate_idx_sorted = torch.argsort(candidate_scores, descending=True)  # Same input to all; as by the model
+
+        def run_sequential():
+            selected_idx = CorefModel._extract_top_spans_sequential(candidate_idx_sorted.tolist(), candidate_starts.tolist(),
+                                                                    candidate_ends.tolist(), num_top_spans)
+            return torch.tensor(selected_idx, device=device)
+
+        def run_numpy():
+            selected_idx = CorefModel._extract_top_spans_numpy(candidate_idx_sorted.cpu().numpy(), candidate_starts.cpu().numpy(),
+                                                               candidate_ends.cpu().numpy(), num_top_spans)
+            return torch.from_numpy(selected_idx).to(device)
+
+        def run_parallel():
+            return CorefModel._extract_top_spans_parallel(candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans,
+                                                          num_words, args.max_span_width)
+
+        selected_sequential, time_sequential = time_fn(run_sequential, args.num_runs, device)
+        selected_numpy, time_numpy = time_fn(run_numpy, args.num_runs, device)
+        selected_parallel, time_parallel = time_fn(run_parallel, args.num_runs, device)
+        assert torch.equal(selected_sequential, selected_numpy), 'Different spans selected by numpy'
+        assert torch.equal(selected_sequential, selected_parallel), 'Different spans selected by parallel rounds'
+        logger.info('%d subtokens, %d candidates, %d top spans: sequential %.1fms; numpy %.1fms (speedup %.2fx); '
+                    'parallel rounds on %s %.1fms (speedup %.2fx)' %
+                    (num_words, candidate_starts.shape[0], num_top_spans, time_sequential * 1000, time_numpy * 1000,
+                     time_sequential / time_numpy, device.type, time_parallel * 1000, time_sequential / time_parallel))
+
+
+def benchmark_coarse_scores(args, device):
+    config = util.initialize_config(args.config_name)
+    config['coarse_antecedent_window'] = args.coarse_antecedent_window
+    model = CorefModel(config, device)
+    model.to(device)
+    model.eval()
+    for num_top_spans in args.num_spans:
+        top_span_emb = torch.randn(num_top_spans, model.span_emb_size, device=device)
+        top_span_mention_scores = torch.randn(num_top_spans, device=device)
+        max_top_antecedents = min(num_top_spans, config['max_top_antecedents'])
+        results = []
+        for block_size in args.block_sizes:
+            config['coarse_block_size'] = block_size
+            if device.type == 'cuda':
+                torch.cuda.reset_max_memory_allocated(device)
+                memory_before = torch.cuda.memory_allocated(device)
+            with torch.no_grad():
+                result, elapsed = time_fn(lambda: model.get_coarse_antecedent_scores(top_span_emb, top_span_mention_scores, max_top_antecedents),
+                                          args.num_runs, device)
+            if device.type == 'cuda':
+                peak_memory = torch.cuda.max_memory_allocated(device) - memory_before
+            else:
+                with torch.no_grad():
+                    peak_memory = get_cpu_peak_memory(lambda: model.get_coarse_antecedent_scores(top_span_emb, top_span_mention_scores,
+                                                                                                 max_top_antecedents))
+            results.append(result)
+            logger.info('%d top spans, block size %d: %.1fms; peak memory %s' %
+                        (num_top_spans, block_size, elapsed * 1000,
+                         'n/a' if peak_memory is None else '%.1fMB' % (peak_memory / 1024 ** 2)))
+        if not args.coarse_antecedent_window:
+            for result in results[1:]:
+                assert torch.equal(result[1], results[0][1]), 'Different antecedents selected'
+                assert torch.allclose(result[0], results[0][0]), 'Different antecedent scores'
+
+
+def benchmark_head_attn(args, device):
+    """ Span emb by windowed head attention vs. dense head attention over full document, on candidate spans of real docs """
+    from run import Runner
+    runner = Runner(args.config_name, None, artifact_path=args.artifact_path)
+    runner.set_inference_mode('fp32')
+    model = runner.initialize_model(args.model_identifier)
+    model.to(device)
+    model.eval()
+    with open(args.input_path, 'r') as f:
+        samples = [json.loads(line) for line, _ in zip(f, range(args.num_docs))]
+    tensor_examples, _ = runner.data.get_tensor_examples_from_custom_input(samples)
+
+    max_diff = 0
+    for doc_key, tensor_example in tensor_examples:
+        input_ids, input_mask, _, _, _, sentence_map = [t.to(device) for t in tensor_example[:6]]
+        with torch.no_grad():
+            mention_doc = model.encode_documents([input_ids], [input_mask])[0]
+            mention_doc = mention_doc[input_mask[:, :mention_doc.shape[1]].to(torch.bool)]
+            candidate_starts, candidate_ends = model.get_candidate_spans(sentence_map.long(), mention_doc.shape[0], model.max_span_width)
+            results = {}
+            for windowed in [False, True]:
+                model.config['windowed_head_attn'] = windowed
+                result, elapsed = time_fn(lambda: model.get_span_emb(mention_doc, candidate_starts, candidate_ends), args.num_runs, device)
+                peak_memory = None if device.type == 'cuda' else \
+                    get_cpu_peak_memory(lambda: model.get_span_emb(mention_doc, candidate_starts, candidate_ends))
+                results[windowed] = result
+                logger.info('%s: %d words, %d candidates, %s head attn %.1fms; peak memory %s' %
+                            (doc_key, mention_doc.shape[0], candidate_starts.shape[0], 'windowed' if windowed else 'dense',
+                             elapsed * 1000, 'n/a' if peak_memory is None else '%.1fMB' % (peak_memory / 1024 ** 2)))
+        diff = (results[True] - results[False]).abs().max().item()
+        max_diff = max(max_diff, diff)
+        logger.info('%s: max abs diff of span emb %.2e' % (doc_key, diff))
+        assert torch.allclose(results[True], results[False], atol=args.atol), 'Different span emb by windowed head attn'
+    logger.info('%d docs: windowed head attn matches dense within atol %.0e; max abs diff %.2e' %
+                (len(tensor_examples), args.atol, max_diff))
+
+
+def benchmark_pair_scores(args, device):
+    config = util.initialize_config(args.config_name)
+    model = CorefModel(config, device)
+    model.to(device)
+    model.eval()
+    span_emb_size, feature_size = model.span_emb_size, model.pair_emb_size - 3 * model.span_emb_size
+    hidden_size = config['ffnn_size'] if config['ffnn_depth'] else 1
+    for num_top_spans in args.num_spans:
+        max_top_antecedents = min(num_top_spans, config['max_top_antecedents'])
+        top_span_emb = torch.randn(num_top_spans, span_emb_size, device=device)
+        top_antecedent_idx = torch.randint(0, num_top_spans, (num_top_spans, max_top_antecedents), device=device)
+        top_antecedent_emb = top_span_emb[top_antecedent_idx]
+        feature_emb = torch.randn(num_top_spans, max_top_antecedents, feature_size, device=device)
+        num_pairs = num_top_spans * max_top_antecedents
+
+        results = []
+        for factorized in [False, True]:
+            config['factorized_pair_scores'] = factorized
+            with torch.no_grad():
+                result, elapsed = time_fn(lambda: model.get_pair_scores(top_span_emb, top_antecedent_emb, top_antecedent_idx, feature_emb),
+                                          args.num_runs, device)
+            if factorized:  # Similarity emb and first hidden layer per pair; target/antecedent projection per span
+                pair_memory = num_pairs * (span_emb_size + hidden_size) * 4
+                first_layer_flops = 2 * (num_pairs * (span_emb_size + feature_size) + num_top_spans * 2 * span_emb_size) * hidden_size
+            else:  # Target, similarity, pair emb and first hidden layer per pair
+                pair_memory = num_pairs * (2 * span_emb_size + model.pair_emb_size + hidden_size) * 4
+                first_layer_flops = 2 * num_pairs * model.pair_emb_size * hidden_size
+            results.append(result)
+            logger.info('%d top spans, factorized=%s: %.1fms; per-pair tensors %.1fMB; first layer %.2f GFLOPs' %
+                        (num_top_spans, factorized, elapsed * 1000, pair_memory / 1024 ** 2, first_layer_flops / 1e9))
+        assert torch.allclose(results[0], results[1], atol=1e-4), 'Different pair scores'
+
+
+def benchmark_cluster_merging(args, device):
+    config = util.initialize_config(args.config_name)
+    config['higher_order'] = 'cluster_merging'
+    model = CorefModel(config, device)
+    model.to(device)
+    model.eval()
+    for num_top_spans in args.num_spans:
+        max_top_antecedents = min(num_top_spans, config['max_top_antecedents'])
+        top_span_emb = torch.randn(num_top_spans, model.span_emb_size, device=device)
+        top_antecedent_offsets = torch.randint(1, 4 * max_top_antecedents, (num_top_spans, max_top_antecedents), device=device)
+        top_antecedent_idx = torch.unsqueeze(torch.arange(0, num_top_spans, device=device), 1) - top_antecedent_offsets
+        top_antecedent_scores = torch.randn(num_top_spans, max_top_antecedents, device=device) - args.antecedent_score_shift
+        top_antecedent_scores[top_antecedent_idx < 0] = float('-inf')
+        top_antecedent_idx = torch.clamp(top_antecedent_idx, min=0)
+
+        for easy_cluster_first in [False, True]:
+            def run(cluster_merging, **kwargs):
+                return cluster_merging(top_span_emb, top_antecedent_idx, top_antecedent_scores, model.emb_cluster_size,
+                                       model.cluster_score_ffnn, None, model.dropout, device, config['cluster_reduce'],
+                                       easy_cluster_first, **kwargs)
+
+            with torch.no_grad():
+                scores_sequential, time_sequential = time_fn(lambda: run(ho.cluster_merging_sequential), args.num_runs, device)
+                logger.info('%d top spans, easy_cluster_first=%s: sequential %.1fms' %
+                            (num_top_spans, easy_cluster_first, time_sequential * 1000))
+                for block_size in args.merging_block_sizes:
+                    scores, elapsed = time_fn(lambda: run(ho.cluster_merging, block_size=block_size), args.num_runs, device)
+                    assert torch.allclose(scores, scores_sequential, atol=1e-4), 'Different cluster merging scores'
+                    logger.info('%d top spans, easy_cluster_first=%s, block size %d: %.1fms; speedup %.2fx' %
+                                (num_top_spans, easy_cluster_first, block_size, elapsed * 1000, time_sequential / elapsed))
+
+
+def benchmark_tokenize(args, device):
+    tokenizer_name = util.initialize_config(args.config_name)['bert_tokenizer_name']
+    with conll.open_conll(args.input_path) as f:
+        documents = list(conll.iter_documents(f))[:args.num_docs]
+    num_words = sum(len(line.split()) > 0 for _, doc_lines in documents for line in doc_lines)
+
+    def run(tokenizer):
+        return [get_document(doc_key, doc_lines, args.language, args.seg_len, tokenizer) for doc_key, doc_lines in documents]
+
+    slow_tokenizer = util.get_tokenizer(tokenizer_name)
+    docs_slow, time_slow = time_fn(lambda: run(slow_tokenizer), args.num_runs, device)
+    logger.info('%d docs, %d words: word by word %.1fms' % (len(documents), num_words, time_slow * 1000))
+    for use_fast in [False, True]:
+        for cache_size in [0, args.tokenizer_cache_size]:
+            tokenizer = util.WordTokenizer(tokenizer_name, cache_size, use_fast)
+
+            def run_batch():  # Cache starts empty in each run
+                tokenizer.cache.clear()
+                return run(tokenizer)
+            docs, elapsed = time_fn(run_batch, args.num_runs, device)
+            assert json.dumps(docs) == json.dumps(docs_slow), 'Different documents'
+            logger.info('fast=%s, cache size %d: %.1fms; speedup %.2fx; cache hit rate %.2f' %
+                        (tokenizer.fast_tokenizer is not None, cache_size, elapsed * 1000, time_slow / elapsed,
+                         tokenizer.num_hits / max(tokenizer.num_lookups, 1)))
+
+
+def benchmark_tensorize(args, device):
+    config = util.initialize_config(args.config_name)
+    tensorizer = Tensorizer(config, util.get_tokenizer(config['bert_tokenizer_name']))
+    with open(args.input_path, 'r') as f:
+        examples = [json.loads(line) for line, _ in zip(f, range(args.num_docs))]
+    time_sequential, time_vectorized, bytes_long, bytes_compact = 0, 0, 0, 0
+    for example in examples:
+        sentences, speakers = example['sentences'], example['speakers']
+        speaker_dict = tensorizer._get_speaker_dict(util.flatten(speakers))
+        result_sequential, elapsed = time_fn(lambda: tensorizer._get_bert_input_sequential(sentences, speakers, speaker_dict),
+                                             args.num_runs, device)
+        time_sequential += elapsed
+        result, elapsed = time_fn(lambda: tensorizer._get_bert_input(sentences, speakers, speaker_dict), args.num_runs, device)
+        time_vectorized += elapsed
+        assert all((a == b).all() for a, b in zip(result, result_sequential)), 'Different bert input'
+
+        _, example_tensor = tensorizer.tensorize_example(example, False)
+        for tensor in example_tensor:
+            if isinstance(tensor, np.ndarray):
+                bytes_compact += tensor.nbytes
+                bytes_long += tensor.size * 8  # All as torch.long previously
+    logger.info('%d docs: bert input per doc sequential %.2fms; vectorized %.2fms; speedup %.2fx' %
+                (len(examples), time_sequential / len(examples) * 1000, time_vectorized / len(examples) * 1000,
+                 time_sequential / time_vectorized))
+    logger.info('Example tensors: %.1fMB as long; %.1fMB in compact dtypes; %.2fx smaller' %
+                (bytes_long / 1024 ** 2, bytes_compact / 1024 ** 2, bytes_long / bytes_compact))
+
+
+def benchmark_cache(args, device):
+    config = util.initialize_config(args.config_name)
+    tensorizer = Tensorizer(config, util.get_tokenizer(config['bert_tokenizer_name']))
+    with open(args.input_path, 'r') as f:
+        tensor_samples = [tensorizer.tensorize_example(json.loads(line), False) for line, _ in zip(f, range(args.num_docs))]
+    schemas = {
+        'long': {name: ('bool' if dtype == 'bool' else 'int64') for name, dtype in CachedTensorExamples.column_dtypes.items()},
+        'compact': {}
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for schema, column_dtypes in schemas.items():
+            dir_path = os.path.join(tmp_dir, schema)
+            CachedTensorExamples.write(dir_path, tensor_samples, column_dtypes)
+            file_size = sum(os.path.getsize(os.path.join(dir_path, file_name)) for file_name in os.listdir(dir_path))
+
+            def load():  # Read all examples into memory and transfer to device
+                return [[tensor.to(device, copy=True) for tensor in tensors] for _, tensors in CachedTensorExamples(dir_path)]
+            examples, elapsed = time_fn(load, args.num_runs, device)
+            memory = sum(tensor.element_size() * tensor.nelement() for tensors in examples for tensor in tensors)
+            logger.info('%s: cache files %.1fMB; examples in memory %.1fMB; load time %.1fms' %
+                        (schema, file_size / 1024 ** 2, memory / 1024 ** 2, elapsed * 1000))
+
+
+def benchmark_startup(args, device):
+    """ Time to first prediction of predict.py in new process, from checkpoint or from inference artifact """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        artifact_path = args.artifact_path
+        if not artifact_path:
+            from run import Runner
+            runner = Runner(args.config_name, None)
+            artifact_path = os.path.join(tmp_dir, 'model.safetensors')
+            artifact.save_artifact(artifact_path, runner.initialize_model(args.model_identifier), runner.config,
+                                   runner.data.tokenizer)
+
+        model_args = {
+            'checkpoint': ['--config_name', args.config_name, '--model_identifier', args.model_identifier],
+            'artifact': ['--artifact_path', artifact_path]
+        }
+        predictions = {}
+        for name, model_arg in model_args.items():
+            output_path = os.path.join(tmp_dir, f'{name}.jsonlines')
+            command = [sys.executable, 'predict.py'] + model_arg + ['--jsonlines_path', args.input_path, '--output_path', output_path]
+            if args.gpu_id is not None:
+                command += ['--gpu_id', str(args.gpu_id)]
+            elapsed = []
+            for _ in range(args.num_runs):
+                start_time = time.time()
+                subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+                elapsed.append(time.time() - start_time)
+            with open(output_path, 'r') as f:
+                predictions[name] = [json.loads(line)['predicted_clusters'] for line in f]
+            logger.info('%s: time to first prediction of %d docs %.2fs (min of %d runs)' %
+                        (name, len(predictions[name]), min(elapsed), args.num_runs))
+        assert predictions['checkpoint'] == predictions['artifact'], 'Different predictions'
+
+
+def benchmark_export(args, device):
+    """ CPU latency per doc of the eager model and of stages exported by export.py """
+    from run import Runner
+    runner = Runner(args.config_name, None, artifact_path=args.artifact_path)
+    runner.set_inference_mode('fp32')
+    model = runner.initialize_model(args.model_identifier)
+    model.eval()
+    with open(args.input_path, 'r') as f:
+        samples = [json.loads(line) for line, _ in zip(f, range(args.num_docs))]
+    tensor_examples, _ = runner.data.get_tensor_examples_from_custom_input(samples)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export.export_stages(model, tensor_examples[0][1], tmp_dir, args.export_format, args.opset_version)
+        staged = export.load_stages(tmp_dir)
+        assert export.check_parity(model, staged, tensor_examples) == 0, 'Different outputs by exported stages'
+
+        time_eager, time_exported = 0, 0
+        for _, tensor_example in tensor_examples:
+            with torch.no_grad():
+                _, elapsed = time_fn(lambda: model(*tensor_example[:7]), args.num_runs, device)
+                time_eager += elapsed
+                _, elapsed = time_fn(lambda: staged.get_predictions(*tensor_example[:6]), args.num_runs, device)
+                time_exported += elapsed
+    logger.info('%d docs: latency per doc eager %.1fms; exported %s %.1fms; speedup %.2fx' %
+                (len(tensor_examples), time_eager / len(tensor_examples) * 1000, args.export_format,
+                 time_exported / len(tensor_examples) * 1000, time_eager / time_exported))
+
+
+def get_random_clusters(num_words, avg_cluster_size=3, mention_ratio=0.1, error_rate=0.2):
+    """ Gold clusters of random mentions, and predicted clusters with some mentions moved to other clusters or dropped """
+    num_mentions = int(num_words * mention_ratio)
+    starts = np.sort(np.random.choice(num_words, num_mentions, replace=False))
+    mentions = list(zip(starts.tolist(), (starts + np.random.randint(0, 5, num_mentions)).tolist()))
+    gold_ids = np.random.randint(0, max(num_mentions // avg_cluster_size, 1), num_mentions)
+    predicted_ids = np.where(np.random.rand(num_mentions) < error_rate, np.random.randint(-1, gold_ids.max() + 1, num_mentions), gold_ids)
+    clusters = []
+    for cluster_ids in [predicted_ids, gold_ids]:
+        cluster_to_mentions = {}
+        for mention, cluster_id in zip(mentions, cluster_ids.tolist()):
+            if cluster_id >= 0:
+                cluster_to_mentions.setdefault(cluster_id, []).append(mention)
+        clusters.append([tuple(c) for c in cluster_to_mentions.values()])
+    return clusters
+
+
+def benchmark_metrics(args, device):
+    for num_words in args.num_words:
+        documents = []
+        for _ in range(args.num_docs):
+            predicted, gold = get_random_clusters(num_words)
+            predicted = [c for c in predicted if len(c) > 1]  # As by get_predicted_clusters
+            documents.append((predicted, gold, {m: c for c in predicted for m in c}, {m: c for c in gold for m in c}))
+
+        start_time = time.time()
+        evaluators = [metrics.Evaluator(m) for m in (metrics.muc, metrics.b_cubed, metrics.ceafe, metrics.ceafm, metrics.lea)]
+        for document in documents:
+            for evaluator in evaluators:
+                evaluator.update(*document)
+        time_reference = time.time() - start_time
+
+        start_time = time.time()
+        coref_evaluator = metrics.CorefEvaluator()
+        for document in documents:
+            coref_evaluator.update(*document)
+        time_contingency = time.time() - start_time
+
+        prf = coref_evaluator.get_metric_prf()
+        assert all(np.allclose(prf[e.metric.__name__], e.get_prf(), rtol=1e-12, atol=0) for e in evaluators), 'Different scores'
+        logger.info('%d docs of %d words: all metrics per-metric loops %.2fs; contingency matrix %.2fs; speedup %.1fx' %
+                    (len(documents), num_words, time_reference, time_contingency, time_reference / time_contingency))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, choices=['extract_spans', 'coarse_scores', 'head_attn', 'pair_scores', 'cluster_merging', 'tokenize', 'tensorize', 'cache', 'startup', 'export', 'metrics'],
+                        help='Component to benchmark')
+    parser.add_argument('--config_name', type=str, default='train_spanbert_large_ml0_d1',
+                        help='Configuration name in experiments.conf; for benchmarks that need the model')
+    parser.add_argument('--gpu_id', type=int, default=None,
+                        help='GPU id; CPU by default')
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=11)
+    parser.add_argument('--num_words', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='Document lengths in subtokens')
+    parser.add_argument('--max_span_width', type=int, default=30)
+    parser.add_argument('--top_span_ratio', type=float, default=0.4)
+    parser.add_argument('--max_num_extracted_spans', type=int, default=3900)
+    parser.add_argument('--num_spans', type=int, nargs='+', default=[1000, 3900],
+                        help='Numbers of top spans')
+    parser.add_argument('--block_sizes', type=int, nargs='+', default=[0, 512, 128],
+                        help='coarse_block_size values; 0: all at once')
+    parser.add_argument('--coarse_antecedent_window', type=int, default=0)
+    parser.add_argument('--atol', type=float, default=1e-5,
+                        help='Tolerance of span emb by windowed vs. dense head attn')
+    parser.add_argument('--merging_block_sizes', type=int, nargs='+', default=[1, 16, 64],
+                        help='block_size values of cluster merging')
+    parser.add_argument('--antecedent_score_shift', type=float, default=2.5,
+                        help='Subtracted from random antecedent scores; larger for fewer merges')
+    parser.add_argument('--input_path', type=str, default=None,
+                        help='CoNLL file, optionally gzip/xz compressed, for tokenize; jsonlines file for head_attn, tensorize, cache, startup, export')
+    parser.add_argument('--num_docs', type=int, default=100)
+    parser.add_argument('--language', type=str, default='english')
+    parser.add_argument('--seg_len', type=int, default=512)
+    parser.add_argument('--tokenizer_cache_size', type=int, default=100000)
+    parser.add_argument('--model_identifier', type=str, default=None,
+                        help='Model identifier of checkpoint for head_attn, startup, export')
+    parser.add_argument('--artifact_path', type=str, default=None,
+                        help='Inference artifact of the same model for startup; exported to temp dir by default. '
+                             'Model to load instead of checkpoint for head_attn, export')
+    parser.add_argument('--export_format', type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--opset_version', type=int, default=11, help='ONNX opset for export')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device('cpu' if args.gpu_id is None else f'cuda:{args.gpu_id}')
+    benchmarks = {
+        'extract_spans': benchmark_extract_spans,
+        'coarse_scores': benchmark_coarse_scores,
+        'head_attn': benchmark_head_attn,
+        'pair_scores': benchmark_pair_scores,
+        'cluster_merging': benchmark_cluster_merging,
+        'tokenize': benchmark_tokenize,
+        'tensorize': benchmark_tensorize,
+        'cache': benchmark_cache,
+        'startup': benchmark_startup,
+        'export': benchmark_export,
+        'metrics': benchmark_metrics
+    }
+    benchmarks[args.benchmark](args, device)
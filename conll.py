@@ -1,4 +1,7 @@
 import re
+import gzip
+import lzma
+import shutil
 import tempfile
 import subprocess
 import operator
@@ -15,28 +18,56 @@ def get_doc_key(doc_id, part):
     return "{}_{}".format(doc_id, int(part))
 
 
-def output_conll(input_file, output_file, predictions, subtoken_map):
-    prediction_map = {}
-    for doc_key, clusters in predictions.items():
-        start_map = collections.defaultdict(list)
-        end_map = collections.defaultdict(list)
-        word_map = collections.defaultdict(list)
-        for cluster_id, mentions in enumerate(clusters):
-            for start, end in mentions:
-                start, end = subtoken_map[doc_key][start], subtoken_map[doc_key][end]
-                if start == end:
-                    word_map[start].append(cluster_id)
-                else:
-                    start_map[start].append((cluster_id, end))
-                    end_map[end].append((cluster_id, start))
-        for k,v in start_map.items():
-            start_map[k] = [cluster_id for cluster_id, end in sorted(v, key=operator.itemgetter(1), reverse=True)]
-        for k,v in end_map.items():
-            end_map[k] = [cluster_id for cluster_id, start in sorted(v, key=operator.itemgetter(1), reverse=True)]
-        prediction_map[doc_key] = (start_map, end_map, word_map)
+def open_conll(path, mode='rt'):
+    """ Open plain, gzip (.gz) or xz (.xz) file by extension """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    elif path.endswith('.xz'):
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+
+def iter_documents(input_file):
+    """ Stream (doc_key, lines) of each document; lines exclude begin/end document lines """
+    doc_key, doc_lines = None, []
+    for line in input_file:
+        begin_document_match = re.match(BEGIN_DOCUMENT_REGEX, line)
+        if begin_document_match:
+            doc_key = get_doc_key(begin_document_match.group(1), begin_document_match.group(2))
+            doc_lines = []
+        elif line.startswith('#end document'):
+            yield doc_key, doc_lines
+            doc_key, doc_lines = None, []
+        elif doc_key is not None:
+            doc_lines.append(line)
+    if doc_key is not None:  # Missing end line
+        yield doc_key, doc_lines
+
+
+def get_prediction_maps(clusters, subtoken_map):
+    """ Map word idx to cluster ids starting, ending, or as single word at that word """
+    start_map = collections.defaultdict(list)
+    end_map = collections.defaultdict(list)
+    word_map = collections.defaultdict(list)
+    for cluster_id, mentions in enumerate(clusters):
+        for start, end in mentions:
+            start, end = subtoken_map[start], subtoken_map[end]
+            if start == end:
+                word_map[start].append(cluster_id)
+            else:
+                start_map[start].append((cluster_id, end))
+                end_map[end].append((cluster_id, start))
+    for k,v in start_map.items():
+        start_map[k] = [cluster_id for cluster_id, end in sorted(v, key=operator.itemgetter(1), reverse=True)]
+    for k,v in end_map.items():
+        end_map[k] = [cluster_id for cluster_id, start in sorted(v, key=operator.itemgetter(1), reverse=True)]
+    return start_map, end_map, word_map
 
+
+def output_conll(input_file, output_file, predictions, subtoken_map):
+    """ Stream input lines; prediction maps are built when each document begins """
     word_index = 0
-    for line in input_file.readlines():
+    for line in input_file:
         row = line.split()
         if len(row) == 0:
             output_file.write("\n")
@@ -44,7 +75,7 @@ def output_conll(input_file, output_file, predictions, subtoken_map):
             begin_match = re.match(BEGIN_DOCUMENT_REGEX, line)
             if begin_match:
                 doc_key = get_doc_key(begin_match.group(1), begin_match.group(2))
-                start_map, end_map, word_map = prediction_map[doc_key]
+                start_map, end_map, word_map = get_prediction_maps(predictions[doc_key], subtoken_map[doc_key])
                 word_index = 0
             output_file.write(line)
             output_file.write("\n")
@@ -93,9 +124,16 @@ def official_conll_eval(gold_path, predicted_path, metric, official_stdout=True)
 
 
 def evaluate_conll(gold_path, predictions, subtoken_maps, official_stdout=True):
-    with tempfile.NamedTemporaryFile(delete=True, mode="w") as prediction_file:
-        with open(gold_path, "r") as gold_file:
+    with tempfile.NamedTemporaryFile(delete=True, mode="w") as prediction_file, \
+            tempfile.NamedTemporaryFile(delete=True, mode="w") as decompressed_gold_file:
+        with open_conll(gold_path) as gold_file:
             output_conll(gold_file, prediction_file, predictions, subtoken_maps)
+        prediction_file.flush()
+        if gold_path.endswith(('.gz', '.xz')):  # Official scorer reads plain files
+            with open_conll(gold_path) as gold_file:
+                shutil.copyfileobj(gold_file, decompressed_gold_file)
+            decompressed_gold_file.flush()
+            gold_path = decompressed_gold_file.name
         # logger.info("Predicted conll file: {}".format(prediction_file.name))
-        results = {m: official_conll_eval(gold_file.name, prediction_file.name, m, official_stdout) for m in ("muc", "bcub", "ceafe") }
+        results = {m: official_conll_eval(gold_path, prediction_file.name, m, official_stdout) for m in ("muc", "bcub", "ceafe") }
     return results
@@ -6,10 +6,10 @@ def evaluate(config_name, gpu_id, saved_suffix):
     runner = Runner(config_name, gpu_id)
     model = runner.initialize_model(saved_suffix)
 
-    examples_train, examples_dev, examples_test = runner.data.get_tensor_examples()
-    stored_info = runner.data.get_stored_info()
+    examples_test = runner.data.get_split_examples('tst')  # Only test split is loaded
+    stored_info = runner.data.get_stored_info(['tst'])
 
-    # runner.evaluate(model, examples_dev, stored_info, 0, official=True, conll_path=runner.config['conll_eval_path'])  # Eval dev
+    # runner.evaluate(model, runner.data.get_split_examples('dev'), runner.data.get_stored_info(['dev']), 0, official=True, conll_path=runner.config['conll_eval_path'])  # Eval dev
     # print('=================================')
     runner.evaluate(model, examples_test, stored_info, 0, official=True, conll_path=runner.config['conll_test_path'])  # Eval test
 
@@ -0,0 +1,313 @@
+import argparse
+import inspect
+import json
+import logging
+import os
+from os.path import join
+import torch
+import torch.nn as nn
+import util
+from model import CorefModel
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+stage_names = ['encoder', 'mention_scorer', 'coarse_scorer', 'fine_scorer']
+stage_axes = {  # Input and output names with dynamic axes of each stage
+    'encoder': ({'input_ids': {0: 'num_segs', 1: 'seg_len'}, 'input_mask': {0: 'num_segs', 1: 'seg_len'}},
+                {'token_emb': {0: 'num_segs', 1: 'seg_len'}}),
+    'mention_scorer': ({'token_emb': {0: 'num_words'}, 'candidate_starts': {0: 'num_candidates'},
+                        'candidate_ends': {0: 'num_candidates'}},
+                       {'candidate_span_emb': {0: 'num_candidates'}, 'candidate_mention_scores': {0: 'num_candidates'}}),
+    'coarse_scorer': ({'block_span_emb': {0: 'block_size'}, 'block_mention_scores': {0: 'block_size'},
+                       'col_span_emb': {0: 'num_cols'}, 'col_mention_scores': {0: 'num_cols'}, 'block_start': {},
+                       'col_start': {}},
+                      {'top_pairwise_fast_scores': {0: 'block_size'}, 'top_antecedent_idx': {0: 'block_size'}}),
+    'fine_scorer': ({'top_span_emb': {0: 'num_top_spans'}, 'top_pairwise_fast_scores': {0: 'num_top_spans'},
+                     'top_antecedent_idx': {0: 'num_top_spans'}, 'top_span_speaker_ids': {0: 'num_top_spans'},
+                     'top_span_seg_ids': {0: 'num_top_spans'}, 'genre': {}},
+                    {'top_antecedent_scores': {0: 'num_top_spans'}})
+}
+
+
+class Encoder(nn.Module):
+    """ Token emb of segments: [num segs, seg len] -> [num segs, seg len, emb size] """
+    def __init__(self, model):
+        super().__init__()
+        self.bert = model.bert
+
+    def forward(self, input_ids, input_mask):
+        return self.bert(input_ids, attention_mask=input_mask)[0]
+
+
+class MentionScorer(nn.Module):
+    """ Span emb and mention scores of candidate spans, given token emb of all words """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, token_emb, candidate_starts, candidate_ends):
+        candidate_span_emb = self.model.get_span_emb(token_emb, candidate_starts, candidate_ends)
+        return candidate_span_emb, self.model.get_mention_scores(candidate_span_emb, candidate_starts, candidate_ends)
+
+
+class CoarseScorer(nn.Module):
+    """ Top fast scores and antecedent idx of a block of top spans among a range of antecedent columns, as a block of
+    CorefModel.get_coarse_antecedent_scores; called by blocks of coarse_block_size spans
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.max_top_antecedents = model.config['max_top_antecedents']
+        self.window = model.config['coarse_antecedent_window']
+
+    def forward(self, block_span_emb, block_mention_scores, col_span_emb, col_mention_scores, block_start, col_start):
+        model, conf = self.model, self.model.config
+        block_positions = torch.arange(block_span_emb.shape[0], device=block_span_emb.device) + block_start
+        col_positions = torch.arange(col_span_emb.shape[0], device=col_span_emb.device) + col_start
+        antecedent_offsets = torch.unsqueeze(block_positions, 1) - torch.unsqueeze(col_positions, 0)  # [block size, num cols]
+        pairwise_mention_score_sum = torch.unsqueeze(block_mention_scores, 1) + torch.unsqueeze(col_mention_scores, 0)
+        pairwise_coref_scores = torch.matmul(model.coarse_bilinear(block_span_emb), torch.transpose(col_span_emb, 0, 1))
+        pairwise_fast_scores = pairwise_mention_score_sum + pairwise_coref_scores
+        antecedent_mask = (antecedent_offsets >= 1)
+        if self.window:
+            antecedent_mask = antecedent_mask & (antecedent_offsets <= self.window)
+        pairwise_fast_scores += torch.log(antecedent_mask.to(torch.float))
+        if conf['use_distance_prior']:
+            distance_score = torch.squeeze(model.antecedent_distance_score_ffnn(model.emb_antecedent_distance_prior.weight), 1)
+            pairwise_fast_scores += distance_score[util.bucket_distance(antecedent_offsets)]
+        top_pairwise_fast_scores, top_antecedent_idx = torch.topk(pairwise_fast_scores, k=self.max_top_antecedents)
+        return top_pairwise_fast_scores, top_antecedent_idx + col_start
+
+
+class FineScorer(nn.Module):
+    """ Coarse-to-fine scores of top spans on their top antecedents, with dummy antecedent scores as the first column """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, top_span_emb, top_pairwise_fast_scores, top_antecedent_idx, top_span_speaker_ids, top_span_seg_ids, genre):
+        model, conf = self.model, self.model.config
+        if conf['fine_grained']:
+            top_span_positions = torch.arange(top_span_emb.shape[0], device=top_span_emb.device)
+            top_antecedent_offsets = torch.unsqueeze(top_span_positions, 1) - top_antecedent_idx
+            top_pairwise_scores, _ = model.get_fine_antecedent_scores(
+                top_span_emb, top_pairwise_fast_scores, top_antecedent_idx, top_antecedent_offsets, top_span_speaker_ids,
+                top_span_seg_ids, genre)
+        else:
+            top_pairwise_scores = top_pairwise_fast_scores
+        return torch.cat([torch.zeros_like(top_pairwise_scores[:, :1]), top_pairwise_scores], dim=1)
+
+
+def get_stages(model):
+    conf = model.config
+    if conf['higher_order'] == 'cluster_merging' or (conf['coref_depth'] > 1 and conf['higher_order'] not in
+                                                     ['attended_antecedent', 'max_antecedent']):
+        raise ValueError(f'Higher-order inference of {conf["higher_order"]} has data-dependent control flow; not exportable')
+    model.eval()
+    return {'encoder': Encoder(model).eval(), 'mention_scorer': MentionScorer(model).eval(),
+            'coarse_scorer': CoarseScorer(model).eval(), 'fine_scorer': FineScorer(model).eval()}
+
+
+class OnnxStage:
+    """ Stage exported to ONNX, run by onnxruntime on torch tensors """
+    def __init__(self, path, name):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path)
+        self.input_names = list(stage_axes[name][0])
+        self.used_input_names = {session_input.name for session_input in self.session.get_inputs()}  # Unused are dropped
+
+    def __call__(self, *inputs):
+        outputs = self.session.run(None, {name: util.to_numpy(tensor) for name, tensor in zip(self.input_names, inputs)
+                                          if name in self.used_input_names})
+        outputs = [torch.from_numpy(output) for output in outputs]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class StagedInference:
+    """ Inference by stages: encoder, mention scorer, coarse scorer on blocks of top spans and fine scorer, each an
+    exported graph or a module; candidate spans, top span extraction and blocks in between are in Python.
+    Same output as CorefModel.get_predictions_and_loss at inference.
+    """
+    def __init__(self, stages, max_span_width, max_num_extracted_spans, top_span_ratio, max_top_antecedents,
+                 coarse_block_size, coarse_antecedent_window):
+        self.stages = stages
+        self.max_span_width = max_span_width
+        self.max_num_extracted_spans = max_num_extracted_spans
+        self.top_span_ratio = top_span_ratio
+        self.max_top_antecedents = max_top_antecedents
+        self.coarse_block_size = coarse_block_size
+        self.coarse_antecedent_window = coarse_antecedent_window
+
+    @classmethod
+    def from_model(cls, model, stages=None):
+        conf = model.config
+        return cls(stages or get_stages(model), model.max_span_width, conf['max_num_extracted_spans'], conf['top_span_ratio'],
+                   conf['max_top_antecedents'], conf['coarse_block_size'], conf['coarse_antecedent_window'])
+
+    def get_predictions(self, input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map):
+        input_mask = input_mask.long()
+        seg_len = int(input_mask.sum(dim=1).max())
+        input_ids, input_mask, speaker_ids = input_ids[:, :seg_len].long(), input_mask[:, :seg_len], speaker_ids[:, :seg_len].long()
+        token_emb = self.stages['encoder'](input_ids, input_mask)
+        token_mask = input_mask.to(torch.bool)
+        token_emb, speaker_ids = token_emb[token_mask], speaker_ids[token_mask]
+        num_words = token_emb.shape[0]
+
+        # Get top spans
+        candidate_starts, candidate_ends = CorefModel.get_candidate_spans(sentence_map.long(), num_words, self.max_span_width)
+        candidate_span_emb, candidate_mention_scores = self.stages['mention_scorer'](token_emb, candidate_starts, candidate_ends)
+        candidate_idx_sorted_by_score = torch.argsort(candidate_mention_scores, descending=True)
+        num_top_spans = int(min(self.max_num_extracted_spans, self.top_span_ratio * num_words))
+        selected_idx = CorefModel._extract_top_spans(candidate_idx_sorted_by_score, candidate_starts, candidate_ends,
+                                                     num_top_spans, num_words, self.max_span_width)
+        top_span_starts, top_span_ends = candidate_starts[selected_idx], candidate_ends[selected_idx]
+        top_span_emb = candidate_span_emb[selected_idx]
+        top_span_mention_scores = candidate_mention_scores[selected_idx]
+        top_span_speaker_ids = speaker_ids[top_span_starts]
+        token_seg_ids = torch.arange(0, input_ids.shape[0], device=input_ids.device).unsqueeze(1).repeat(1, seg_len)
+        top_span_seg_ids = token_seg_ids[token_mask][top_span_starts]
+
+        # Get antecedent scores; padded with spans after all others that are never antecedents, for at least
+        # max_top_antecedents spans
+        num_padding = max(self.max_top_antecedents - num_top_spans, 0)
+        if num_padding:
+            top_span_emb = nn.functional.pad(top_span_emb, [0, 0, 0, num_padding])
+            top_span_mention_scores = nn.functional.pad(top_span_mention_scores, [0, num_padding], value=float('-inf'))
+            top_span_speaker_ids = nn.functional.pad(top_span_speaker_ids, [0, num_padding])
+            top_span_seg_ids = nn.functional.pad(top_span_seg_ids, [0, num_padding])
+        # Coarse scores by blocks of spans as CorefModel.get_coarse_antecedent_scores, so pairwise tensors are [block size, num cols]
+        num_padded_spans = top_span_emb.shape[0]
+        block_size = self.coarse_block_size or num_padded_spans
+        top_pairwise_fast_scores, top_antecedent_idx = [], []
+        for block_start in range(0, num_padded_spans, block_size):
+            block_end = min(block_start + block_size, num_padded_spans)
+            col_start, col_end = CorefModel.get_coarse_block_cols(block_start, block_end, num_padded_spans, self.max_top_antecedents,
+                                                                  self.coarse_antecedent_window)
+            block_top_scores, block_top_idx = self.stages['coarse_scorer'](
+                top_span_emb[block_start:block_end], top_span_mention_scores[block_start:block_end],
+                top_span_emb[col_start:col_end], top_span_mention_scores[col_start:col_end], torch.tensor(block_start),
+                torch.tensor(col_start))
+            top_pairwise_fast_scores.append(block_top_scores)
+            top_antecedent_idx.append(block_top_idx)
+        top_pairwise_fast_scores, top_antecedent_idx = torch.cat(top_pairwise_fast_scores), torch.cat(top_antecedent_idx)
+        top_antecedent_scores = self.stages['fine_scorer'](top_span_emb, top_pairwise_fast_scores, top_antecedent_idx,
+                                                           top_span_speaker_ids, top_span_seg_ids, genre.long())
+        max_top_antecedents = min(num_top_spans, self.max_top_antecedents)
+        top_antecedent_idx = top_antecedent_idx[:num_top_spans, :max_top_antecedents]
+        top_antecedent_scores = top_antecedent_scores[:num_top_spans, :max_top_antecedents + 1]
+        return candidate_starts, candidate_ends, candidate_mention_scores, top_span_starts, top_span_ends, top_antecedent_idx, top_antecedent_scores
+
+
+def export_stages(model, tensor_example, output_dir, export_format='torchscript', opset_version=11):
+    """ Export each stage by inputs traced on the example; graphs have dynamic sizes, and the same constants of config;
+    opset_version is for ONNX
+    """
+    stages = get_stages(model)
+    stage_inputs = {}
+
+    def record(name):
+        def run(*inputs):
+            stage_inputs.setdefault(name, inputs)  # Traced on the first call
+            return stages[name](*inputs)
+        return run
+    staged = StagedInference.from_model(model, {name: record(name) for name in stage_names})
+    with torch.no_grad():
+        staged.get_predictions(*tensor_example[:6])
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name in stage_names:
+        with torch.no_grad():
+            if export_format == 'torchscript':
+                traced = torch.jit.trace(stages[name], stage_inputs[name], check_trace=False)
+                if hasattr(torch.jit, 'freeze'):  # Inline weights as constants for graph optimizations
+                    traced = torch.jit.freeze(traced)
+                traced.save(join(output_dir, f'{name}.pt'))
+            else:
+                input_axes, output_axes = stage_axes[name]
+                kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}  # By tracing
+                torch.onnx.export(stages[name], stage_inputs[name], join(output_dir, f'{name}.onnx'),
+                                  input_names=list(input_axes), output_names=list(output_axes),
+                                  dynamic_axes={**input_axes, **output_axes}, opset_version=opset_version, **kwargs)
+    with open(join(output_dir, 'export_config.json'), 'w') as f:
+        json.dump({'format': export_format, 'max_span_width': staged.max_span_width,
+                   'max_num_extracted_spans': staged.max_num_extracted_spans, 'top_span_ratio': staged.top_span_ratio,
+                   'max_top_antecedents': staged.max_top_antecedents, 'coarse_block_size': staged.coarse_block_size,
+                   'coarse_antecedent_window': staged.coarse_antecedent_window}, f)
+    logger.info('Exported stages in %s to %s' % (export_format, output_dir))
+
+
+def load_stages(output_dir):
+    with open(join(output_dir, 'export_config.json'), 'r') as f:
+        export_config = json.load(f)
+    if export_config.pop('format') == 'torchscript':
+        stages = {name: torch.jit.load(join(output_dir, f'{name}.pt'), map_location='cpu') for name in stage_names}
+    else:
+        stages = {name: OnnxStage(join(output_dir, f'{name}.onnx'), name) for name in stage_names}
+    return StagedInference(stages, **export_config)
+
+
+def get_sorted_antecedents(antecedent_idx, antecedent_scores):
+    """ Antecedent idx and scores of each span sorted by idx; antecedents with -inf scores are last, as idx num spans """
+    scores = antecedent_scores[:, 1:]
+    antecedent_idx = torch.where(torch.isfinite(scores), antecedent_idx, torch.full_like(antecedent_idx, antecedent_idx.shape[0]))
+    antecedent_idx, order = torch.sort(antecedent_idx, dim=1)
+    return antecedent_idx, torch.gather(scores, 1, order)
+
+
+def check_parity(model, staged, tensor_examples, atol=1e-4):
+    """ Number of examples whose outputs by stages differ from the eager model: same spans, antecedents and clusters;
+    scores within atol
+    """
+    model.eval()
+    num_different = 0
+    for doc_key, tensor_example in tensor_examples:
+        with torch.no_grad():
+            eager_output = model(*tensor_example[:7])
+            staged_output = staged.get_predictions(*tensor_example[:6])
+        same = all(torch.equal(eager_output[i], staged_output[i]) for i in [0, 1, 3, 4])
+        same = same and torch.allclose(eager_output[2], staged_output[2], atol=atol)
+        same = same and eager_output[6].shape == staged_output[6].shape
+        if same:
+            # Order of antecedents with close fast scores is arbitrary; compare antecedents sorted by idx
+            eager_idx, eager_scores = get_sorted_antecedents(eager_output[5], eager_output[6])
+            staged_idx, staged_scores = get_sorted_antecedents(staged_output[5], staged_output[6])
+            is_valid = torch.isfinite(eager_scores)
+            same = torch.equal(eager_idx, staged_idx) and torch.equal(is_valid, torch.isfinite(staged_scores))
+            same = same and torch.allclose(eager_scores[is_valid], staged_scores[is_valid], atol=atol)
+            same = same and model.get_predicted_clusters(*eager_output[3:])[0] == model.get_predicted_clusters(*staged_output[3:])[0]
+        if not same:
+            logger.info('Different outputs by stages on %s' % doc_key)
+            num_different += 1
+    return num_different
+
+
+if __name__ == '__main__':
+    from run import Runner
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_name', type=str, default=None,
+                        help='Configuration name in experiments.conf')
+    parser.add_argument('--model_identifier', type=str, default=None,
+                        help='Model identifier to export')
+    parser.add_argument('--artifact_path', type=str, default=None,
+                        help='Inference artifact exported by artifact.py, instead of config_name and model_identifier')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Directory of exported stages')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--opset_version', type=int, default=11,
+                        help='ONNX opset; 14 or later for encoders by scaled_dot_product_attention')
+    parser.add_argument('--num_parity_docs', type=int, default=20,
+                        help='Dev docs to check exported stages against the eager model')
+    args = parser.parse_args()
+    if not args.artifact_path and not (args.config_name and args.model_identifier):
+        parser.error('Either --artifact_path, or --config_name and --model_identifier are required')
+
+    runner = Runner(args.config_name, None, artifact_path=args.artifact_path)  # CPU
+    runner.set_inference_mode('fp32')
+    model = runner.initialize_model(args.model_identifier)
+    examples = runner.data.get_split_examples('dev')
+    examples = [examples[i] for i in range(min(args.num_parity_docs, len(examples)))]
+    export_stages(model, examples[0][1], args.output_dir, args.format, args.opset_version)
+    num_different = check_parity(model, load_stages(args.output_dir), examples)
+    logger.info('Parity: %d of %d docs different' % (num_different, len(examples)))
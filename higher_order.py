@@ -26,61 +26,158 @@ def entity_equalization(top_span_emb, top_antecedent_emb, top_antecedent_idx, to
     pass
 
 def span_clustering(top_span_emb, top_antecedent_idx, top_antecedent_scores, span_attn_ffnn, device):
-    # Get predicted antecedents
-    num_top_spans, max_top_antecedents = top_antecedent_idx.shape[0], top_antecedent_idx.shape[1]
-    predicted_antecedents = []
+    # Get predicted antecedents; span itself if no antecedent
+    num_top_spans = top_antecedent_idx.shape[0]
     top_antecedent_scores = torch.cat([torch.zeros(num_top_spans, 1, device=device), top_antecedent_scores], dim=1)
-    for i, idx in enumerate((torch.argmax(top_antecedent_scores, axis=1) - 1).tolist()):
-        if idx < 0:
-            predicted_antecedents.append(-1)
-        else:
-            predicted_antecedents.append(top_antecedent_idx[i, idx].item())
-    # Get predicted clusters
-    predicted_clusters = []
-    span_to_cluster_id = [-1] * num_top_spans
-    for i, predicted_idx in enumerate(predicted_antecedents):
-        if predicted_idx < 0:
-            continue
-        assert i > predicted_idx, f'span idx: {i}; antecedent idx: {predicted_idx}'
-        # Check antecedent's cluster
-        antecedent_cluster_id = span_to_cluster_id[predicted_idx]
-        if antecedent_cluster_id == -1:
-            antecedent_cluster_id = len(predicted_clusters)
-            predicted_clusters.append([predicted_idx])
-            span_to_cluster_id[predicted_idx] = antecedent_cluster_id
-        # Add mention to cluster
-        predicted_clusters[antecedent_cluster_id].append(i)
-        span_to_cluster_id[i] = antecedent_cluster_id
-    if len(predicted_clusters) == 0:
+    predicted_idx = torch.argmax(top_antecedent_scores, dim=1) - 1
+    has_antecedent = predicted_idx >= 0
+    span_idx = torch.arange(0, num_top_spans, device=device)
+    predicted_antecedents = torch.gather(top_antecedent_idx, 1, torch.clamp(predicted_idx, min=0).unsqueeze(1)).squeeze(1)
+    predicted_antecedents = torch.where(has_antecedent, predicted_antecedents, span_idx)
+    # Get first span of each antecedent chain by pointer jumping
+    span_to_root = predicted_antecedents
+    for _ in range((num_top_spans - 1).bit_length()):
+        span_to_root = span_to_root[span_to_root]
+
+    # Get predicted clusters: spans with antecedent and their antecedents
+    in_cluster = has_antecedent.clone()
+    in_cluster[predicted_antecedents[has_antecedent]] = True
+    if not in_cluster.any():
         return top_span_emb
+    clustered_span_idx = torch.nonzero(in_cluster, as_tuple=False).squeeze(1)
+    cluster_roots, span_to_cluster_id = torch.unique(span_to_root[clustered_span_idx], return_inverse=True)
+    num_clusters = cluster_roots.shape[0]
+
+    # Get position of each span in its cluster
+    cluster_sizes = torch.bincount(span_to_cluster_id, minlength=num_clusters)
+    cluster_starts = torch.cumsum(cluster_sizes, dim=0) - cluster_sizes
+    span_order = torch.argsort(span_to_cluster_id * num_top_spans + clustered_span_idx)
+    ordered_cluster_id = span_to_cluster_id[span_order]
+    ordered_position = torch.arange(0, clustered_span_idx.shape[0], device=device) - cluster_starts[ordered_cluster_id]
+    # Get cluster repr by softmax over cluster members
+    clustered_span_emb = top_span_emb[clustered_span_idx]
+    span_attn = torch.squeeze(span_attn_ffnn(clustered_span_emb), 1)
+    cluster_span_attn = torch.full((num_clusters, int(cluster_sizes.max())), float('-inf'), dtype=span_attn.dtype, device=device)  # [num clusters, max cluster size]
+    cluster_span_attn[ordered_cluster_id, ordered_position] = span_attn[span_order]
+    cluster_span_attn = nn.functional.softmax(cluster_span_attn, dim=1)
+    span_attn = torch.zeros_like(span_attn)
+    span_attn[span_order] = cluster_span_attn[ordered_cluster_id, ordered_position]
+    weighted_span_emb = clustered_span_emb * torch.unsqueeze(span_attn, 1)
+    cluster_emb = torch.zeros(num_clusters, top_span_emb.shape[-1], dtype=weighted_span_emb.dtype, device=device)
+    cluster_emb = cluster_emb.index_add(0, span_to_cluster_id, weighted_span_emb).to(top_span_emb.dtype)  # [num clusters, emb size]
 
-    # Pad clusters
-    max_cluster_size = max([len(c) for c in predicted_clusters])
-    cluster_sizes = []
-    for cluster in predicted_clusters:
-        cluster_sizes.append(len(cluster))
-        cluster += [0] * (max_cluster_size - len(cluster))
-    predicted_clusters_mask = torch.arange(0, max_cluster_size, device=device).repeat(len(predicted_clusters), 1)
-    predicted_clusters_mask = predicted_clusters_mask < torch.tensor(cluster_sizes, device=device).unsqueeze(1)  # [num clusters, max cluster size]
-    # Get cluster repr
-    predicted_clusters = torch.tensor(predicted_clusters, device=device)
-    cluster_emb = top_span_emb[predicted_clusters]  # [num clusters, max cluster size, emb size]
-    span_attn = torch.squeeze(span_attn_ffnn(cluster_emb), 2)
-    span_attn += torch.log(predicted_clusters_mask.to(torch.float))
-    span_attn = nn.functional.softmax(span_attn, dim=1)
-    cluster_emb = torch.sum(cluster_emb * torch.unsqueeze(span_attn, 2), dim=1)  # [num clusters, emb size]
     # Get refined span
-    refined_span_emb = []
-    for i, cluster_idx in enumerate(span_to_cluster_id):
-        if cluster_idx < 0:
-            refined_span_emb.append(top_span_emb[i])
-        else:
-            refined_span_emb.append(cluster_emb[cluster_idx])
-    refined_span_emb = torch.stack(refined_span_emb, dim=0)
+    span_to_emb_idx = span_idx.clone()
+    span_to_emb_idx[clustered_span_idx] = num_top_spans + span_to_cluster_id
+    refined_span_emb = torch.cat([top_span_emb, cluster_emb], dim=0)[span_to_emb_idx]
     return refined_span_emb
 
 
-def cluster_merging(top_span_emb, top_antecedent_idx, top_antecedent_scores, emb_cluster_size, cluster_score_ffnn, cluster_transform, dropout, device, reduce='mean', easy_cluster_first=False):
+def cluster_merging(top_span_emb, top_antecedent_idx, top_antecedent_scores, emb_cluster_size, cluster_score_ffnn, cluster_transform, dropout, device, reduce='mean', easy_cluster_first=False, block_size=16):
+    """ Same decisions as cluster_merging_sequential; cluster scores are computed for a block of spans at once by current clusters,
+    and only recomputed for antecedents whose clusters are changed by earlier spans of the block
+    """
+    num_top_spans, max_top_antecedents = top_antecedent_idx.shape[0], top_antecedent_idx.shape[1]
+    span_emb_size = top_span_emb.shape[-1]
+    max_num_clusters = num_top_spans
+
+    span_to_cluster_id = [0] * num_top_spans  # id 0 as dummy cluster
+    cluster_emb = torch.zeros(max_num_clusters, span_emb_size, dtype=torch.float, device=device)  # [max num clusters, emb size]
+    num_clusters = 1  # dummy cluster
+    cluster_sizes = [1] * max_num_clusters
+
+    merge_order = torch.arange(0, num_top_spans)
+    if easy_cluster_first:
+        max_antecedent_scores, _ = torch.max(top_antecedent_scores, dim=1)
+        merge_order = torch.argsort(max_antecedent_scores, descending=True)
+    merge_order = merge_order.tolist()
+    top_antecedent_idx_cpu = top_antecedent_idx.tolist()
+    cluster_merging_scores = [None] * num_top_spans
+
+    for block_start in range(0, num_top_spans, block_size):
+        # Get cluster scores of all spans in block
+        block_span_idx = merge_order[block_start: block_start + block_size]
+        block_cluster_scores = _get_cluster_scores([i for i in block_span_idx for _ in range(max_top_antecedents)],
+                                                   [j for i in block_span_idx for j in top_antecedent_idx_cpu[i]],
+                                                   top_span_emb, span_to_cluster_id, cluster_emb, cluster_sizes,
+                                                   emb_cluster_size, cluster_score_ffnn, dropout, device)
+        block_cluster_scores = block_cluster_scores.view(len(block_span_idx), max_top_antecedents)
+        block_antecedent_scores = top_antecedent_scores[torch.tensor(block_span_idx, device=device)] + block_cluster_scores
+        block_max_scores, block_max_score_idx = torch.max(block_antecedent_scores, dim=1)
+        block_max_scores, block_max_score_idx = block_max_scores.tolist(), block_max_score_idx.tolist()
+
+        changed_cluster_ids = set()
+        for block_i, i in enumerate(block_span_idx):
+            cluster_scores = block_cluster_scores[block_i]
+            max_score, max_score_idx = block_max_scores[block_i], block_max_score_idx[block_i]
+            outdated_idx = [antecedent_i for antecedent_i, antecedent_idx in enumerate(top_antecedent_idx_cpu[i])
+                            if span_to_cluster_id[antecedent_idx] in changed_cluster_ids]
+            if outdated_idx:
+                # Recompute cluster scores of antecedents in changed clusters
+                cluster_scores = cluster_scores.clone()
+                cluster_scores[outdated_idx] = _get_cluster_scores([i] * len(outdated_idx), [top_antecedent_idx_cpu[i][antecedent_i] for antecedent_i in outdated_idx],
+                                                                   top_span_emb, span_to_cluster_id, cluster_emb, cluster_sizes,
+                                                                   emb_cluster_size, cluster_score_ffnn, dropout, device)
+                max_score, max_score_idx = torch.max(top_antecedent_scores[i] + cluster_scores, dim=0)
+                max_score, max_score_idx = max_score.item(), max_score_idx.item()
+            cluster_merging_scores[i] = cluster_scores
+            if max_score < 0:
+                continue  # Dummy antecedent
+            max_antecedent_idx = top_antecedent_idx_cpu[i][max_score_idx]
+
+            antecedent_cluster_id = span_to_cluster_id[max_antecedent_idx]
+            curr_span_cluster_id = span_to_cluster_id[i]
+            if easy_cluster_first and antecedent_cluster_id > 0 and curr_span_cluster_id > 0:
+                # Merge two clusters; as in cluster_merging_sequential, antecedent cluster id is read after reassignment
+                span_to_cluster_id[max_antecedent_idx] = curr_span_cluster_id
+                antecedent_cluster_id = curr_span_cluster_id
+                _merge_cluster_emb(cluster_emb, antecedent_cluster_id, curr_span_cluster_id,
+                                   cluster_sizes[antecedent_cluster_id], cluster_sizes[curr_span_cluster_id], reduce=reduce)
+                cluster_sizes[curr_span_cluster_id] += cluster_sizes[antecedent_cluster_id]
+                changed_cluster_ids.add(curr_span_cluster_id)
+            elif easy_cluster_first and curr_span_cluster_id > 0:
+                # Merge antecedent to span's cluster
+                span_to_cluster_id[max_antecedent_idx] = curr_span_cluster_id
+                _merge_span_emb(cluster_emb, curr_span_cluster_id, cluster_sizes[curr_span_cluster_id], top_span_emb[max_antecedent_idx], reduce=reduce)
+                cluster_sizes[curr_span_cluster_id] += 1
+                changed_cluster_ids.add(curr_span_cluster_id)
+            else:
+                # Create antecedent cluster if needed
+                if antecedent_cluster_id == 0:
+                    antecedent_cluster_id = num_clusters
+                    span_to_cluster_id[max_antecedent_idx] = antecedent_cluster_id
+                    cluster_emb[antecedent_cluster_id] = top_span_emb[max_antecedent_idx]
+                    num_clusters += 1
+                # Add span to cluster
+                span_to_cluster_id[i] = antecedent_cluster_id
+                _merge_span_emb(cluster_emb, antecedent_cluster_id, cluster_sizes[antecedent_cluster_id], top_span_emb[i], reduce=reduce)
+                cluster_sizes[antecedent_cluster_id] += 1
+                changed_cluster_ids.add(antecedent_cluster_id)
+
+    cluster_merging_scores = torch.stack(cluster_merging_scores, dim=0)
+    return cluster_merging_scores
+
+
+def _get_cluster_scores(span_idx, antecedent_idx, top_span_emb, span_to_cluster_id, cluster_emb, cluster_sizes, emb_cluster_size, cluster_score_ffnn, dropout, device):
+    """ Cluster scores of (span, antecedent) pairs by current clusters """
+    antecedent_cluster_idx = [span_to_cluster_id[idx] for idx in antecedent_idx]
+    antecedent_cluster_size = [cluster_sizes[cluster_id] for cluster_id in antecedent_cluster_idx]
+    antecedent_cluster_idx = torch.tensor(antecedent_cluster_idx, device=device)
+    antecedent_cluster_emb = cluster_emb[antecedent_cluster_idx]
+
+    antecedent_cluster_size = util.bucket_distance(torch.tensor(antecedent_cluster_size, device=device))
+    cluster_size_emb = dropout(emb_cluster_size(antecedent_cluster_size))
+
+    span_emb = top_span_emb[torch.tensor(span_idx, device=device)]
+    similarity_emb = span_emb * antecedent_cluster_emb
+    pair_emb = torch.cat([span_emb, antecedent_cluster_emb, similarity_emb, cluster_size_emb], dim=1)  # [num pairs, pair emb size]
+    cluster_scores = torch.squeeze(cluster_score_ffnn(pair_emb), 1)
+    cluster_scores_mask = (antecedent_cluster_idx > 0).to(torch.float)
+    cluster_scores *= cluster_scores_mask
+    return cluster_scores
+
+
+def cluster_merging_sequential(top_span_emb, top_antecedent_idx, top_antecedent_scores, emb_cluster_size, cluster_score_ffnn, cluster_transform, dropout, device, reduce='mean', easy_cluster_first=False):
     num_top_spans, max_top_antecedents = top_antecedent_idx.shape[0], top_antecedent_idx.shape[1]
     span_emb_size = top_span_emb.shape[-1]
     max_num_clusters = num_top_spans
@@ -159,23 +256,30 @@ def cluster_merging(top_span_emb, top_antecedent_idx, top_antecedent_scores, emb
 
 
 def _merge_span_to_cluster(cluster_emb, cluster_sizes, cluster_to_merge_id, span_emb, reduce):
-    cluster_size = cluster_sizes[cluster_to_merge_id].item()
+    _merge_span_emb(cluster_emb, cluster_to_merge_id, cluster_sizes[cluster_to_merge_id].item(), span_emb, reduce)
+    cluster_sizes[cluster_to_merge_id] += 1
+
+
+def _merge_clusters(cluster_emb, cluster_sizes, cluster1_id, cluster2_id, reduce):
+    """ Merge cluster1 to cluster2 """
+    _merge_cluster_emb(cluster_emb, cluster1_id, cluster2_id, cluster_sizes[cluster1_id].item(), cluster_sizes[cluster2_id].item(), reduce)
+    cluster_sizes[cluster2_id] += cluster_sizes[cluster1_id]
+
+
+def _merge_span_emb(cluster_emb, cluster_to_merge_id, cluster_size, span_emb, reduce):
     if reduce == 'mean':
         cluster_emb[cluster_to_merge_id] = (cluster_emb[cluster_to_merge_id] * cluster_size + span_emb) / (cluster_size + 1)
     elif reduce == 'max':
         cluster_emb[cluster_to_merge_id], _ = torch.max(torch.stack([cluster_emb[cluster_to_merge_id], span_emb]), dim=0)
     else:
         raise ValueError('reduce value is invalid: %s' % reduce)
-    cluster_sizes[cluster_to_merge_id] += 1
 
 
-def _merge_clusters(cluster_emb, cluster_sizes, cluster1_id, cluster2_id, reduce):
-    """ Merge cluster1 to cluster2 """
-    cluster1_size, cluster2_size = cluster_sizes[cluster1_id].item(), cluster_sizes[cluster2_id].item()
+def _merge_cluster_emb(cluster_emb, cluster1_id, cluster2_id, cluster1_size, cluster2_size, reduce):
+    """ Merge emb of cluster1 to cluster2 """
     if reduce == 'mean':
         cluster_emb[cluster2_id] = (cluster_emb[cluster1_id] * cluster1_size + cluster_emb[cluster2_id] * cluster2_size) / (cluster1_size + cluster2_size)
     elif reduce == 'max':
         cluster_emb[cluster2_id] = torch.max(cluster_emb[cluster1_id], cluster_emb[cluster2_id])
     else:
         raise ValueError('reduce value is invalid: %s' % reduce)
-    cluster_sizes[cluster2_id] += cluster_sizes[cluster1_id]
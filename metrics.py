@@ -4,8 +4,9 @@ from __future__ import print_function
 
 import numpy as np
 from collections import Counter
-from sklearn.utils.linear_assignment_ import linear_assignment
+from scipy import sparse
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
 
 
 def f1(p_num, p_den, r_num, r_den, beta=1):
@@ -15,12 +16,22 @@ def f1(p_num, p_den, r_num, r_den, beta=1):
 
 
 class CorefEvaluator(object):
+    """ Counts of all metrics are from one contingency matrix per document (see get_contingency), or from the metric
+    functions if a document repeats mentions;
+    F1 is averaged over MUC, B-cubed and CEAFe as CoNLL F1, and CEAFm, LEA are reported separately
+    """
     def __init__(self):
         self.evaluators = [Evaluator(m) for m in (muc, b_cubed, ceafe)]
+        self.other_evaluators = [Evaluator(m) for m in (ceafm, lea)]
 
     def update(self, predicted, gold, mention_to_predicted, mention_to_gold):
-        for e in self.evaluators:
-            e.update(predicted, gold, mention_to_predicted, mention_to_gold)
+        if has_repeated_mentions(predicted) or has_repeated_mentions(gold):
+            for e in self.evaluators + self.other_evaluators:  # Contingency counts assume disjoint clusters
+                e.update(predicted, gold, mention_to_predicted, mention_to_gold)
+            return
+        counts = get_counts(*get_contingency(predicted, gold))
+        for e in self.evaluators + self.other_evaluators:
+            e.add_counts(*counts[e.metric])
 
     def get_f1(self):
         return sum(e.get_f1() for e in self.evaluators) / len(self.evaluators)
@@ -34,6 +45,9 @@ class CorefEvaluator(object):
     def get_prf(self):
         return self.get_precision(), self.get_recall(), self.get_f1()
 
+    def get_metric_prf(self):
+        return {e.metric.__name__: e.get_prf() for e in self.evaluators + self.other_evaluators}
+
 
 class Evaluator(object):
     def __init__(self, metric, beta=1):
@@ -45,11 +59,14 @@ class Evaluator(object):
         self.beta = beta
 
     def update(self, predicted, gold, mention_to_predicted, mention_to_gold):
-        if self.metric == ceafe:
+        if self.metric in (ceafe, ceafm):
             pn, pd, rn, rd = self.metric(predicted, gold)
         else:
             pn, pd = self.metric(predicted, mention_to_gold)
             rn, rd = self.metric(gold, mention_to_predicted)
+        self.add_counts(pn, pd, rn, rd)
+
+    def add_counts(self, pn, pd, rn, rd):
         self.p_num += pn
         self.p_den += pd
         self.r_num += rn
@@ -119,7 +136,12 @@ def phi4(c1, c2):
     return 2 * len([m for m in c1 if m in c2]) / float(len(c1) + len(c2))
 
 
+def phi3(c1, c2):
+    return len([m for m in c1 if m in c2])
+
+
 def ceafe(clusters, gold_clusters):
+    from sklearn.utils.linear_assignment_ import linear_assignment  # Imported on first use; not needed for inference
     clusters = [c for c in clusters if len(c) != 1]
     scores = np.zeros((len(gold_clusters), len(clusters)))
     for i in range(len(gold_clusters)):
@@ -132,6 +154,18 @@ def ceafe(clusters, gold_clusters):
     return similarity, len(clusters), similarity, len(gold_clusters)
 
 
+def ceafm(clusters, gold_clusters):
+    from sklearn.utils.linear_assignment_ import linear_assignment
+    clusters = [c for c in clusters if len(c) != 1]
+    scores = np.zeros((len(gold_clusters), len(clusters)))
+    for i in range(len(gold_clusters)):
+        for j in range(len(clusters)):
+            scores[i, j] = phi3(gold_clusters[i], clusters[j])
+    matching = linear_assignment(-scores)
+    similarity = sum(scores[matching[:, 0], matching[:, 1]])
+    return similarity, sum(len(c) for c in clusters), similarity, sum(len(c) for c in gold_clusters)
+
+
 def lea(clusters, mention_to_gold):
     num, dem = 0, 0
 
@@ -151,3 +185,93 @@ def lea(clusters, mention_to_gold):
         dem += len(c)
 
     return num, dem
+
+
+def has_repeated_mentions(clusters):
+    """ Whether any mention appears more than once, in one or more clusters """
+    return sum(len(c) for c in clusters) != len({m for c in clusters for m in c})
+
+
+def get_contingency(predicted, gold):
+    """ Sparse [num gold clusters, num predicted clusters] matrix of common mentions, and cluster sizes.
+    Mentions are encoded as their gold cluster ids; callers ensure no repeated mentions (see has_repeated_mentions).
+    """
+    mention_to_gold_id = {m: i for i, c in enumerate(gold) for m in c}
+    gold_sizes = np.array([len(c) for c in gold], dtype=np.int64)
+    predicted_sizes = np.array([len(c) for c in predicted], dtype=np.int64)
+    mention_gold_ids = np.fromiter((mention_to_gold_id.get(m, -1) for c in predicted for m in c), dtype=np.int64,
+                                   count=int(predicted_sizes.sum()))
+    mention_predicted_ids = np.repeat(np.arange(len(predicted)), predicted_sizes)
+    is_common = mention_gold_ids >= 0
+    pair_keys, common = np.unique(mention_gold_ids[is_common] * len(predicted) + mention_predicted_ids[is_common],
+                                  return_counts=True)  # Sorted by gold then predicted cluster id
+    indptr = np.searchsorted(pair_keys, np.arange(len(gold) + 1) * len(predicted))
+    contingency = sparse.csr_matrix((common, pair_keys % max(len(predicted), 1), indptr), shape=(len(gold), len(predicted)))
+    return contingency, gold_sizes, predicted_sizes
+
+
+def get_counts(contingency, gold_sizes, predicted_sizes):
+    """ {metric: (p_num, p_den, r_num, r_den)} of one document from its contingency matrix; same as metric functions """
+    gold_ids = np.repeat(np.arange(contingency.shape[0]), np.diff(contingency.indptr))
+    predicted_ids, common = contingency.indices, contingency.data
+    num_common = int(common.sum())
+    counts = {muc: (num_common - common.shape[0], int((predicted_sizes - 1).sum()),
+                    num_common - common.shape[0], int((gold_sizes - 1).sum()))}
+
+    # B-cubed and LEA per cluster of one side, summed in cluster order as the metric functions
+    cluster_counts = {b_cubed: [], lea: []}
+    for ids, sizes, other_ids, other_sizes in [(predicted_ids, predicted_sizes, gold_ids, gold_sizes),
+                                               (gold_ids, gold_sizes, predicted_ids, predicted_sizes)]:
+        is_scored = sizes > 1
+        correct = np.bincount(ids, weights=common * common * (other_sizes[other_ids] != 1), minlength=sizes.shape[0])
+        common_links = np.bincount(ids, weights=common * (common - 1) // 2, minlength=sizes.shape[0])
+        correct, common_links, sizes = correct[is_scored], common_links[is_scored], sizes[is_scored]
+        all_links = sizes * (sizes - 1) / 2.0
+        cluster_counts[b_cubed] += [sum((correct / sizes).tolist()), int(sizes.sum())]
+        cluster_counts[lea] += [sum((sizes * common_links / all_links).tolist()), int(sizes.sum())]
+    counts.update((metric, tuple(metric_counts)) for metric, metric_counts in cluster_counts.items())
+
+    # CEAF over non-singleton predicted clusters
+    is_kept = predicted_sizes[predicted_ids] != 1
+    gold_ids, predicted_ids, common = gold_ids[is_kept], predicted_ids[is_kept], common[is_kept]
+    components = _get_overlap_components(gold_ids, predicted_ids, gold_sizes.shape[0], predicted_sizes.shape[0])
+    scores = 2 * common / (gold_sizes[gold_ids] + predicted_sizes[predicted_ids]).astype(float)
+    similarity = _get_max_matching_similarity(gold_ids, predicted_ids, scores, components, gold_sizes.shape[0])
+    counts[ceafe] = (similarity, int((predicted_sizes != 1).sum()), similarity, gold_sizes.shape[0])
+    similarity = _get_max_matching_similarity(gold_ids, predicted_ids, common.astype(float), components, gold_sizes.shape[0])
+    counts[ceafm] = (similarity, int(predicted_sizes[predicted_sizes != 1].sum()), similarity, int(gold_sizes.sum()))
+    return counts
+
+
+def _get_overlap_components(gold_ids, predicted_ids, num_gold, num_predicted):
+    """ Connected components of clusters linked by overlapping pairs; return indices of pairs overlapping no other
+    cluster, and pair indices of each other component
+    """
+    is_single = (np.bincount(gold_ids, minlength=num_gold)[gold_ids] == 1) & \
+        (np.bincount(predicted_ids, minlength=num_predicted)[predicted_ids] == 1)
+    pair_idx = np.nonzero(~is_single)[0]
+    if not pair_idx.shape[0]:
+        return np.nonzero(is_single)[0], []
+    graph = sparse.csr_matrix((np.ones(pair_idx.shape[0]), (gold_ids[pair_idx], num_gold + predicted_ids[pair_idx])),
+                              shape=(num_gold + num_predicted, num_gold + num_predicted))
+    _, node_labels = connected_components(graph, directed=False)
+    labels = node_labels[gold_ids[pair_idx]]
+    order = np.argsort(labels, kind='stable')
+    return np.nonzero(is_single)[0], np.split(pair_idx[order], np.nonzero(np.diff(labels[order]))[0] + 1)
+
+
+def _get_max_matching_similarity(gold_ids, predicted_ids, scores, components, num_gold):
+    """ Max total score of one-to-one matching between clusters, given positive scores of overlapping cluster pairs;
+    pairs without overlap score 0, so each connected component is matched separately
+    """
+    single_idx, components = components
+    gold_scores = np.zeros(num_gold)  # Score of matched pair of each gold cluster
+    gold_scores[gold_ids[single_idx]] = scores[single_idx]
+    for component in components:
+        rows, row_ids = np.unique(gold_ids[component], return_inverse=True)
+        cols, col_ids = np.unique(predicted_ids[component], return_inverse=True)
+        component_scores = np.zeros((rows.shape[0], cols.shape[0]))
+        component_scores[row_ids.reshape(-1), col_ids.reshape(-1)] = scores[component]
+        matched_rows, matched_cols = linear_sum_assignment(-component_scores)
+        gold_scores[rows[matched_rows]] = component_scores[matched_rows, matched_cols]
+    return sum(gold_scores.tolist())  # In gold cluster order as linear_assignment
@@ -1,6 +1,7 @@
+import copy
 import torch
 import torch.nn as nn
-from transformers import BertModel
+from transformers import BertModel, BertConfig
 import util
 import logging
 from collections import Iterable
@@ -16,7 +17,10 @@ logger = logging.getLogger()
 
 
 class CorefModel(nn.Module):
-    def __init__(self, config, device, num_genres=None):
+    def __init__(self, config, device, num_genres=None, bert_config=None):
+        """ bert_config: dict of BERT config to build BERT without loading pretrained weights, e.g. for all weights to be
+        loaded from an inference artifact (see artifact.py)
+        """
         super().__init__()
         self.config = config
         self.device = device
@@ -30,7 +34,10 @@ class CorefModel(nn.Module):
 
         # Model
         self.dropout = nn.Dropout(p=config['dropout_rate'])
-        self.bert = BertModel.from_pretrained(config['bert_pretrained_name_or_path'])
+        if bert_config is None:
+            self.bert = BertModel.from_pretrained(config['bert_pretrained_name_or_path'])
+        else:
+            self.bert = BertModel(BertConfig.from_dict(bert_config))
 
         self.bert_emb_size = self.bert.config.hidden_size
         self.span_emb_size = self.bert_emb_size * 3
@@ -64,6 +71,8 @@ class CorefModel(nn.Module):
         self.span_attn_ffnn = self.make_ffnn(self.span_emb_size, 0, output_size=1) if config['higher_order'] == 'span_clustering' else None
         self.cluster_score_ffnn = self.make_ffnn(3 * self.span_emb_size + config['feature_emb_size'], [config['cluster_ffnn_size']] * config['ffnn_depth'], output_size=1) if config['higher_order'] == 'cluster_merging' else None
 
+        self.coref_score_blocks = None  # First layer of coref_score_ffnn split by pair emb blocks, if quantized
+
         self.update_steps = 0  # Internal use for debug
         self.debug = True
 
@@ -91,6 +100,28 @@ class CorefModel(nn.Module):
         ffnn.append(self.make_linear(hidden_size[-1], output_size))
         return nn.Sequential(*ffnn)
 
+    def quantize_int8(self):
+        """ Copy of model for CPU inference, with all linear layers of BERT and task FFNNs in dynamic int8 quantization:
+        weights stored in int8; activations quantized on the fly
+        """
+        if self.device.type != 'cpu':
+            raise ValueError('Dynamic int8 quantization is for CPU inference only')
+        model = copy.deepcopy(self)
+        if model.coref_score_ffnn is not None and model.config['factorized_pair_scores']:
+            # Factorized scores use blocks of the first layer weight, not available once quantized
+            first_linear = model.coref_score_ffnn[0] if isinstance(model.coref_score_ffnn, nn.Sequential) else model.coref_score_ffnn
+            weight, bias = first_linear.weight.detach(), first_linear.bias.detach()
+            bounds = [0, self.span_emb_size, 2 * self.span_emb_size, 3 * self.span_emb_size, weight.shape[1]]
+            model.coref_score_blocks = nn.ModuleList()
+            for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+                linear = nn.Linear(end - start, weight.shape[0], bias=(i == 0))
+                linear.weight.data = weight[:, start: end].clone()
+                if i == 0:
+                    linear.bias.data = bias.clone()
+                model.coref_score_blocks.append(linear)
+        torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model
+
     def get_params(self, named=False):
         bert_based_param, task_param = [], []
         for name, param in self.named_parameters():
@@ -102,12 +133,21 @@ class CorefModel(nn.Module):
                 task_param.append(to_add)
         return bert_based_param, task_param
 
-    def forward(self, *input):
-        return self.get_predictions_and_loss(*input)
+    def forward(self, *input, **kwargs):
+        return self.get_predictions_and_loss(*input, **kwargs)
+
+    def encode_documents(self, input_ids_list, input_mask_list):
+        """ Get token emb of multiple documents in one BERT pass; segments of all documents are in the same batch,
+        trimmed to the longest segment
+        """
+        input_ids, input_mask = torch.cat(input_ids_list, dim=0).long(), torch.cat(input_mask_list, dim=0).long()
+        seg_len = int(input_mask.sum(dim=1).max())
+        mention_doc, _ = self.bert(input_ids[:, :seg_len], attention_mask=input_mask[:, :seg_len])  # [num seg of all docs, seg len, emb size]
+        return torch.split(mention_doc, [doc_input_ids.shape[0] for doc_input_ids in input_ids_list], dim=0)
 
     def get_predictions_and_loss(self, input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map,
-                                 is_training, gold_starts=None, gold_ends=None, gold_mention_cluster_map=None):
-        """ Model and input are already on the device """
+                                 is_training, gold_starts=None, gold_ends=None, gold_mention_cluster_map=None, mention_doc=None):
+        """ Model and input are already on the device; mention_doc: token emb if already encoded """
         device = self.device
         conf = self.config
 
@@ -116,23 +156,21 @@ class CorefModel(nn.Module):
             assert gold_starts is not None
             assert gold_ends is not None
             do_loss = True
+            gold_starts, gold_ends, gold_mention_cluster_map = gold_starts.long(), gold_ends.long(), gold_mention_cluster_map.long()
+        speaker_ids, sentence_map = speaker_ids.long(), sentence_map.long()  # Input can be in compact dtypes
 
         # Get token emb
-        mention_doc, _ = self.bert(input_ids, attention_mask=input_mask)  # [num seg, num max tokens, emb size]
+        if mention_doc is None:
+            mention_doc = self.encode_documents([input_ids], [input_mask])[0]  # [num seg, seg len, emb size]
+        seg_len = mention_doc.shape[1]  # Padding beyond the longest segment is trimmed
+        input_ids, input_mask, speaker_ids = input_ids[:, :seg_len], input_mask[:, :seg_len], speaker_ids[:, :seg_len]
         input_mask = input_mask.to(torch.bool)
         mention_doc = mention_doc[input_mask]
         speaker_ids = speaker_ids[input_mask]
         num_words = mention_doc.shape[0]
 
         # Get candidate span
-        sentence_indices = sentence_map  # [num tokens]
-        candidate_starts = torch.unsqueeze(torch.arange(0, num_words, device=device), 1).repeat(1, self.max_span_width)
-        candidate_ends = candidate_starts + torch.arange(0, self.max_span_width, device=device)
-        candidate_start_sent_idx = sentence_indices[candidate_starts]
-        candidate_end_sent_idx = sentence_indices[torch.min(candidate_ends, torch.tensor(num_words - 1, device=device))]
-        candidate_mask = (candidate_ends < num_words) & (candidate_start_sent_idx == candidate_end_sent_idx)
-        candidate_starts, candidate_ends = candidate_starts[candidate_mask], candidate_ends[candidate_mask]  # [num valid candidates]
-        num_candidates = candidate_starts.shape[0]
+        candidate_starts, candidate_ends = self.get_candidate_spans(sentence_map, num_words, self.max_span_width)  # [num valid candidates]
 
         # Get candidate labels
         if do_loss:
@@ -142,125 +180,27 @@ class CorefModel(nn.Module):
             candidate_labels = torch.matmul(torch.unsqueeze(gold_mention_cluster_map, 0).to(torch.float), same_span.to(torch.float))
             candidate_labels = torch.squeeze(candidate_labels.to(torch.long), 0)  # [num candidates]; non-gold span has label 0
 
-        # Get span embedding
-        span_start_emb, span_end_emb = mention_doc[candidate_starts], mention_doc[candidate_ends]
-        candidate_emb_list = [span_start_emb, span_end_emb]
-        if conf['use_features']:
-            candidate_width_idx = candidate_ends - candidate_starts
-            candidate_width_emb = self.emb_span_width(candidate_width_idx)
-            candidate_width_emb = self.dropout(candidate_width_emb)
-            candidate_emb_list.append(candidate_width_emb)
-        # Use attended head or avg token
-        candidate_tokens = torch.unsqueeze(torch.arange(0, num_words, device=device), 0).repeat(num_candidates, 1)
-        candidate_tokens_mask = (candidate_tokens >= torch.unsqueeze(candidate_starts, 1)) & (candidate_tokens <= torch.unsqueeze(candidate_ends, 1))
-        if conf['model_heads']:
-            token_attn = torch.squeeze(self.mention_token_attn(mention_doc), 1)
-        else:
-            token_attn = torch.ones(num_words, dtype=torch.float, device=device)  # Use avg if no attention
-        candidate_tokens_attn_raw = torch.log(candidate_tokens_mask.to(torch.float)) + torch.unsqueeze(token_attn, 0)
-        candidate_tokens_attn = nn.functional.softmax(candidate_tokens_attn_raw, dim=1)
-        head_attn_emb = torch.matmul(candidate_tokens_attn, mention_doc)
-        candidate_emb_list.append(head_attn_emb)
-        candidate_span_emb = torch.cat(candidate_emb_list, dim=1)  # [num candidates, new emb size]
-
-        # Get span score
-        candidate_mention_scores = torch.squeeze(self.span_emb_score_ffnn(candidate_span_emb), 1)
-        if conf['use_width_prior']:
-            width_score = torch.squeeze(self.span_width_score_ffnn(self.emb_span_width_prior.weight), 1)
-            candidate_width_score = width_score[candidate_width_idx]
-            candidate_mention_scores += candidate_width_score
+        # Get span embedding and score
+        candidate_span_emb = self.get_span_emb(mention_doc, candidate_starts, candidate_ends)  # [num candidates, new emb size]
+        candidate_mention_scores = self.get_mention_scores(candidate_span_emb, candidate_starts, candidate_ends)
 
         # Extract top spans
-        candidate_idx_sorted_by_score = torch.argsort(candidate_mention_scores, descending=True).tolist()
-        candidate_starts_cpu, candidate_ends_cpu = candidate_starts.tolist(), candidate_ends.tolist()
+        candidate_idx_sorted_by_score = torch.argsort(candidate_mention_scores, descending=True)
         num_top_spans = int(min(conf['max_num_extracted_spans'], conf['top_span_ratio'] * num_words))
-        selected_idx_cpu = self._extract_top_spans(candidate_idx_sorted_by_score, candidate_starts_cpu, candidate_ends_cpu, num_top_spans)
-        assert len(selected_idx_cpu) == num_top_spans
-        selected_idx = torch.tensor(selected_idx_cpu, device=device)
+        selected_idx = self._extract_top_spans(candidate_idx_sorted_by_score, candidate_starts, candidate_ends, num_top_spans, num_words, self.max_span_width)
+        assert selected_idx.shape[0] == num_top_spans
         top_span_starts, top_span_ends = candidate_starts[selected_idx], candidate_ends[selected_idx]
         top_span_emb = candidate_span_emb[selected_idx]
         top_span_cluster_ids = candidate_labels[selected_idx] if do_loss else None
         top_span_mention_scores = candidate_mention_scores[selected_idx]
 
-        # Coarse pruning on each mention's antecedents
-        max_top_antecedents = min(num_top_spans, conf['max_top_antecedents'])
-        top_span_range = torch.arange(0, num_top_spans, device=device)
-        antecedent_offsets = torch.unsqueeze(top_span_range, 1) - torch.unsqueeze(top_span_range, 0)
-        antecedent_mask = (antecedent_offsets >= 1)
-        pairwise_mention_score_sum = torch.unsqueeze(top_span_mention_scores, 1) + torch.unsqueeze(top_span_mention_scores, 0)
-        source_span_emb = self.dropout(self.coarse_bilinear(top_span_emb))
-        target_span_emb = self.dropout(torch.transpose(top_span_emb, 0, 1))
-        pairwise_coref_scores = torch.matmul(source_span_emb, target_span_emb)
-        pairwise_fast_scores = pairwise_mention_score_sum + pairwise_coref_scores
-        pairwise_fast_scores += torch.log(antecedent_mask.to(torch.float))
-        if conf['use_distance_prior']:
-            distance_score = torch.squeeze(self.antecedent_distance_score_ffnn(self.dropout(self.emb_antecedent_distance_prior.weight)), 1)
-            bucketed_distance = util.bucket_distance(antecedent_offsets)
-            antecedent_distance_score = distance_score[bucketed_distance]
-            pairwise_fast_scores += antecedent_distance_score
-        top_pairwise_fast_scores, top_antecedent_idx = torch.topk(pairwise_fast_scores, k=max_top_antecedents)
-        top_antecedent_mask = util.batch_select(antecedent_mask, top_antecedent_idx, device)  # [num top spans, max top antecedents]
-        top_antecedent_offsets = util.batch_select(antecedent_offsets, top_antecedent_idx, device)
-
-        # Slow mention ranking
-        if conf['fine_grained']:
-            same_speaker_emb, genre_emb, seg_distance_emb, top_antecedent_distance_emb = None, None, None, None
-            if conf['use_metadata']:
-                top_span_speaker_ids = speaker_ids[top_span_starts]
-                top_antecedent_speaker_id = top_span_speaker_ids[top_antecedent_idx]
-                same_speaker = torch.unsqueeze(top_span_speaker_ids, 1) == top_antecedent_speaker_id
-                same_speaker_emb = self.emb_same_speaker(same_speaker.to(torch.long))
-                genre_emb = self.emb_genre(genre)
-                genre_emb = torch.unsqueeze(torch.unsqueeze(genre_emb, 0), 0).repeat(num_top_spans, max_top_antecedents, 1)
-            if conf['use_segment_distance']:
-                num_segs, seg_len = input_ids.shape[0], input_ids.shape[1]
-                token_seg_ids = torch.arange(0, num_segs, device=device).unsqueeze(1).repeat(1, seg_len)
-                token_seg_ids = token_seg_ids[input_mask]
-                top_span_seg_ids = token_seg_ids[top_span_starts]
-                top_antecedent_seg_ids = token_seg_ids[top_span_starts[top_antecedent_idx]]
-                top_antecedent_seg_distance = torch.unsqueeze(top_span_seg_ids, 1) - top_antecedent_seg_ids
-                top_antecedent_seg_distance = torch.clamp(top_antecedent_seg_distance, 0, self.config['max_training_sentences'] - 1)
-                seg_distance_emb = self.emb_segment_distance(top_antecedent_seg_distance)
-            if conf['use_features']:  # Antecedent distance
-                top_antecedent_distance = util.bucket_distance(top_antecedent_offsets)
-                top_antecedent_distance_emb = self.emb_top_antecedent_distance(top_antecedent_distance)
-
-            for depth in range(conf['coref_depth']):
-                top_antecedent_emb = top_span_emb[top_antecedent_idx]  # [num top spans, max top antecedents, emb size]
-                feature_list = []
-                if conf['use_metadata']:  # speaker, genre
-                    feature_list.append(same_speaker_emb)
-                    feature_list.append(genre_emb)
-                if conf['use_segment_distance']:
-                    feature_list.append(seg_distance_emb)
-                if conf['use_features']:  # Antecedent distance
-                    feature_list.append(top_antecedent_distance_emb)
-                feature_emb = torch.cat(feature_list, dim=2)
-                feature_emb = self.dropout(feature_emb)
-                target_emb = torch.unsqueeze(top_span_emb, 1).repeat(1, max_top_antecedents, 1)
-                similarity_emb = target_emb * top_antecedent_emb
-                pair_emb = torch.cat([target_emb, top_antecedent_emb, similarity_emb, feature_emb], 2)
-                top_pairwise_slow_scores = torch.squeeze(self.coref_score_ffnn(pair_emb), 2)
-                top_pairwise_scores = top_pairwise_slow_scores + top_pairwise_fast_scores
-                if conf['higher_order'] == 'cluster_merging':
-                    cluster_merging_scores = ho.cluster_merging(top_span_emb, top_antecedent_idx, top_pairwise_scores, self.emb_cluster_size, self.cluster_score_ffnn, None, self.dropout,
-                                                                device=device, reduce=conf['cluster_reduce'], easy_cluster_first=conf['easy_cluster_first'])
-                    break
-                elif depth != conf['coref_depth'] - 1:
-                    if conf['higher_order'] == 'attended_antecedent':
-                        refined_span_emb = ho.attended_antecedent(top_span_emb, top_antecedent_emb, top_pairwise_scores, device)
-                    elif conf['higher_order'] == 'max_antecedent':
-                        refined_span_emb = ho.max_antecedent(top_span_emb, top_antecedent_emb, top_pairwise_scores, device)
-                    elif conf['higher_order'] == 'entity_equalization':
-                        refined_span_emb = ho.entity_equalization(top_span_emb, top_antecedent_emb, top_antecedent_idx, top_pairwise_scores, device)
-                    elif conf['higher_order'] == 'span_clustering':
-                        refined_span_emb = ho.span_clustering(top_span_emb, top_antecedent_idx, top_pairwise_scores, self.span_attn_ffnn, device)
-
-                    gate = self.gate_ffnn(torch.cat([top_span_emb, refined_span_emb], dim=1))
-                    gate = torch.sigmoid(gate)
-                    top_span_emb = gate * refined_span_emb + (1 - gate) * top_span_emb  # [num top spans, span emb size]
-        else:
-            top_pairwise_scores = top_pairwise_fast_scores  # [num top spans, max top antecedents]
+        # Get antecedent scores
+        top_span_speaker_ids = speaker_ids[top_span_starts]
+        num_segs, seg_len = input_ids.shape[0], input_ids.shape[1]
+        token_seg_ids = torch.arange(0, num_segs, device=device).unsqueeze(1).repeat(1, seg_len)
+        top_span_seg_ids = token_seg_ids[input_mask][top_span_starts]
+        top_pairwise_scores, top_antecedent_idx, top_antecedent_mask, cluster_merging_scores = \
+            self.get_antecedent_scores(top_span_emb, top_span_mention_scores, top_span_speaker_ids, top_span_seg_ids, genre)
 
         if not do_loss:
             if conf['fine_grained'] and conf['higher_order'] == 'cluster_merging':
@@ -333,8 +273,478 @@ class CorefModel(nn.Module):
 
         return [candidate_starts, candidate_ends, candidate_mention_scores, top_span_starts, top_span_ends, top_antecedent_idx, top_antecedent_scores], loss
 
-    def _extract_top_spans(self, candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans):
-        """ Keep top non-cross-overlapping candidates ordered by scores; compute on CPU because of loop """
+    def get_predictions_streaming(self, input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map):
+        """ Inference by windows of stream_window_segments segments, so that device memory does not grow with doc length;
+        top spans of each window are scored together with a memory of at most stream_memory_size top spans from earlier windows.
+        Input can be on CPU; output is on CPU, in the same format as get_predictions_and_loss at inference.
+        """
+        device = self.device
+        conf = self.config
+        window_size, memory_size = conf['stream_window_segments'], conf['stream_memory_size']
+        max_top_antecedents = conf['max_top_antecedents']
+        num_segs = input_ids.shape[0]
+        genre = genre.to(device)
+
+        memory = None  # [emb, mention scores, positions, speaker ids, seg ids] of memory spans, ordered by position
+        memory_cluster_ids = []  # Predicted cluster of each memory span; -1 if none
+        num_clusters = 0
+        outputs = [[] for _ in range(7)]
+        num_prev_words, num_prev_top_spans = 0, 0
+        for window_start in range(0, num_segs, window_size):
+            window_end = min(window_start + window_size, num_segs)
+            # Get token emb of window
+            window_input_mask = input_mask[window_start:window_end].to(device)
+            mention_doc = self.encode_documents([input_ids[window_start:window_end].to(device)], [window_input_mask])[0]
+            seg_len = mention_doc.shape[1]
+            window_input_mask = window_input_mask[:, :seg_len].to(torch.bool)
+            mention_doc = mention_doc[window_input_mask]
+            window_speaker_ids = speaker_ids[window_start:window_end, :seg_len].to(device, torch.long)[window_input_mask]
+            token_seg_ids = torch.arange(window_start, window_end, device=device).unsqueeze(1).repeat(1, seg_len)[window_input_mask]
+            num_words = mention_doc.shape[0]
+            window_sentence_map = sentence_map[num_prev_words: num_prev_words + num_words].to(device, torch.long)
+
+            # Get top spans of window
+            candidate_starts, candidate_ends = self.get_candidate_spans(window_sentence_map, num_words, self.max_span_width)
+            candidate_span_emb = self.get_span_emb(mention_doc, candidate_starts, candidate_ends)
+            candidate_mention_scores = self.get_mention_scores(candidate_span_emb, candidate_starts, candidate_ends)
+            candidate_idx_sorted_by_score = torch.argsort(candidate_mention_scores, descending=True)
+            num_top_spans = int(min(conf['max_num_extracted_spans'], conf['top_span_ratio'] * num_words))
+            outputs[0].append(candidate_starts.cpu() + num_prev_words)
+            outputs[1].append(candidate_ends.cpu() + num_prev_words)
+            outputs[2].append(candidate_mention_scores.cpu())
+            if num_top_spans == 0:
+                num_prev_words += num_words
+                continue
+            selected_idx = self._extract_top_spans(candidate_idx_sorted_by_score, candidate_starts, candidate_ends, num_top_spans, num_words, self.max_span_width)
+            top_span_starts, top_span_ends = candidate_starts[selected_idx], candidate_ends[selected_idx]
+            window_spans = [candidate_span_emb[selected_idx], candidate_mention_scores[selected_idx],
+                            num_prev_top_spans + torch.arange(0, num_top_spans, device=device),
+                            window_speaker_ids[top_span_starts], token_seg_ids[top_span_starts]]
+
+            # Get antecedent scores of window spans among memory and window spans
+            num_memory_spans = 0 if memory is None else memory[0].shape[0]
+            spans = window_spans if memory is None else [torch.cat([m, w], dim=0) for m, w in zip(memory, window_spans)]
+            span_emb, span_mention_scores, span_positions, span_speaker_ids, span_seg_ids = spans
+            top_pairwise_scores, top_antecedent_idx, _, cluster_merging_scores = \
+                self.get_antecedent_scores(span_emb, span_mention_scores, span_speaker_ids, span_seg_ids, genre, span_positions)
+            if cluster_merging_scores is not None:
+                top_pairwise_scores += cluster_merging_scores
+            top_pairwise_scores, top_antecedent_idx = top_pairwise_scores[num_memory_spans:], top_antecedent_idx[num_memory_spans:]
+            top_antecedent_scores = torch.cat([torch.zeros(num_top_spans, 1, device=device), top_pairwise_scores], dim=1)
+
+            # Update predicted clusters of memory and window spans
+            cluster_ids = memory_cluster_ids + [-1] * num_top_spans
+            predicted_antecedents = self.get_predicted_antecedents(top_antecedent_idx, top_antecedent_scores).tolist()
+            for i, predicted_idx in enumerate(predicted_antecedents, start=num_memory_spans):
+                if predicted_idx < 0:
+                    continue
+                if cluster_ids[predicted_idx] < 0:
+                    cluster_ids[predicted_idx] = num_clusters
+                    num_clusters += 1
+                cluster_ids[i] = cluster_ids[predicted_idx]
+            # Keep latest span of each cluster, then latest other spans
+            is_latest_in_cluster, seen_cluster_ids = [False] * len(cluster_ids), set()
+            for i in range(len(cluster_ids) - 1, -1, -1):
+                if cluster_ids[i] >= 0 and cluster_ids[i] not in seen_cluster_ids:
+                    is_latest_in_cluster[i] = True
+                    seen_cluster_ids.add(cluster_ids[i])
+            kept_idx = sorted(range(len(cluster_ids)), key=lambda i: (is_latest_in_cluster[i], i), reverse=True)[:memory_size]
+            kept_idx = sorted(kept_idx)
+            memory = [t[torch.tensor(kept_idx, dtype=torch.long, device=device)] for t in spans]
+            memory_cluster_ids = [cluster_ids[i] for i in kept_idx]
+
+            # Output with doc-level idx; antecedents are padded to max_top_antecedents
+            top_antecedent_idx = span_positions[top_antecedent_idx]
+            num_padding = max_top_antecedents - top_antecedent_idx.shape[1]
+            if num_padding > 0:
+                top_antecedent_idx = nn.functional.pad(top_antecedent_idx, [0, num_padding])
+                top_antecedent_scores = nn.functional.pad(top_antecedent_scores, [0, num_padding], value=float('-inf'))
+            outputs[3].append(top_span_starts.cpu() + num_prev_words)
+            outputs[4].append(top_span_ends.cpu() + num_prev_words)
+            outputs[5].append(top_antecedent_idx.cpu())
+            outputs[6].append(top_antecedent_scores.cpu())
+            num_prev_words += num_words
+            num_prev_top_spans += num_top_spans
+
+        if not outputs[3]:  # No top span in any window
+            outputs[3:] = [[torch.zeros(0, dtype=torch.long)]] * 2 + [[torch.zeros(0, max_top_antecedents, dtype=torch.long)],
+                                                                      [torch.zeros(0, max_top_antecedents + 1)]]
+        return [torch.cat(output, dim=0) for output in outputs]
+
+    @staticmethod
+    def get_candidate_spans(sentence_map, num_words, max_span_width):
+        """ Candidate spans up to max span width within each sentence """
+        device = sentence_map.device
+        sentence_indices = sentence_map  # [num tokens]
+        candidate_starts = torch.unsqueeze(torch.arange(0, num_words, device=device), 1).repeat(1, max_span_width)
+        candidate_ends = candidate_starts + torch.arange(0, max_span_width, device=device)
+        candidate_start_sent_idx = sentence_indices[candidate_starts]
+        candidate_end_sent_idx = sentence_indices[torch.min(candidate_ends, torch.tensor(num_words - 1, device=device))]
+        candidate_mask = (candidate_ends < num_words) & (candidate_start_sent_idx == candidate_end_sent_idx)
+        return candidate_starts[candidate_mask], candidate_ends[candidate_mask]
+
+    def get_span_emb(self, mention_doc, candidate_starts, candidate_ends):
+        device = self.device
+        conf = self.config
+        num_words, num_candidates = mention_doc.shape[0], candidate_starts.shape[0]
+
+        span_start_emb, span_end_emb = mention_doc[candidate_starts], mention_doc[candidate_ends]
+        candidate_emb_list = [span_start_emb, span_end_emb]
+        if conf['use_features']:
+            candidate_width_idx = candidate_ends - candidate_starts
+            candidate_width_emb = self.emb_span_width(candidate_width_idx)
+            candidate_width_emb = self.dropout(candidate_width_emb)
+            candidate_emb_list.append(candidate_width_emb)
+        # Use attended head or avg token
+        if conf['model_heads']:
+            token_attn = torch.squeeze(self.mention_token_attn(mention_doc), 1)
+        else:
+            token_attn = torch.ones(num_words, dtype=torch.float, device=device)  # Use avg if no attention
+        if conf['windowed_head_attn']:
+            # Only attend to tokens within max span width; linear in num words
+            candidate_tokens = torch.unsqueeze(candidate_starts, 1) + torch.arange(0, self.max_span_width, device=device)
+            candidate_tokens_mask = candidate_tokens <= torch.unsqueeze(candidate_ends, 1)  # [num candidates, max span width]
+            candidate_tokens = torch.min(candidate_tokens, torch.unsqueeze(candidate_ends, 1))
+            candidate_tokens_attn_raw = torch.log(candidate_tokens_mask.to(torch.float)) + token_attn[candidate_tokens]
+            candidate_tokens_attn = nn.functional.softmax(candidate_tokens_attn_raw, dim=1)
+            head_attn_emb = nn.functional.embedding_bag(candidate_tokens, mention_doc, mode='sum', per_sample_weights=candidate_tokens_attn)
+        else:
+            candidate_tokens = torch.unsqueeze(torch.arange(0, num_words, device=device), 0).repeat(num_candidates, 1)
+            candidate_tokens_mask = (candidate_tokens >= torch.unsqueeze(candidate_starts, 1)) & (candidate_tokens <= torch.unsqueeze(candidate_ends, 1))
+            candidate_tokens_attn_raw = torch.log(candidate_tokens_mask.to(torch.float)) + torch.unsqueeze(token_attn, 0)
+            candidate_tokens_attn = nn.functional.softmax(candidate_tokens_attn_raw, dim=1)
+            head_attn_emb = torch.matmul(candidate_tokens_attn, mention_doc)
+        candidate_emb_list.append(head_attn_emb)
+        candidate_span_emb = torch.cat(candidate_emb_list, dim=1)  # [num candidates, new emb size]
+        return candidate_span_emb
+
+    def get_mention_scores(self, candidate_span_emb, candidate_starts, candidate_ends):
+        candidate_mention_scores = torch.squeeze(self.span_emb_score_ffnn(candidate_span_emb), 1)
+        if self.config['use_width_prior']:
+            width_score = torch.squeeze(self.span_width_score_ffnn(self.emb_span_width_prior.weight), 1)
+            candidate_width_score = width_score[candidate_ends - candidate_starts]
+            candidate_mention_scores += candidate_width_score
+        return candidate_mention_scores
+
+    def get_antecedent_scores(self, top_span_emb, top_span_mention_scores, top_span_speaker_ids, top_span_seg_ids, genre, top_span_positions=None):
+        """ Coarse-to-fine scores of top spans on their top antecedents; top_span_positions: span positions among all top spans
+        if not consecutive, for antecedent distance. Cluster merging scores are returned separately (None if not used).
+        """
+        conf = self.config
+        num_top_spans = top_span_emb.shape[0]
+
+        # Coarse pruning on each mention's antecedents
+        max_top_antecedents = min(num_top_spans, conf['max_top_antecedents'])
+        top_pairwise_fast_scores, top_antecedent_idx, top_antecedent_mask, top_antecedent_offsets = \
+            self.get_coarse_antecedent_scores(top_span_emb, top_span_mention_scores, max_top_antecedents, top_span_positions)
+
+        # Slow mention ranking
+        cluster_merging_scores = None
+        if conf['fine_grained']:
+            top_pairwise_scores, cluster_merging_scores = self.get_fine_antecedent_scores(
+                top_span_emb, top_pairwise_fast_scores, top_antecedent_idx, top_antecedent_offsets, top_span_speaker_ids,
+                top_span_seg_ids, genre)
+        else:
+            top_pairwise_scores = top_pairwise_fast_scores  # [num top spans, max top antecedents]
+        return top_pairwise_scores, top_antecedent_idx, top_antecedent_mask, cluster_merging_scores
+
+    def get_fine_antecedent_scores(self, top_span_emb, top_pairwise_fast_scores, top_antecedent_idx, top_antecedent_offsets,
+                                   top_span_speaker_ids, top_span_seg_ids, genre):
+        """ Fast plus slow scores on top antecedents, refining span emb by higher-order inference if coref_depth > 1;
+        return scores and cluster merging scores (None if not used)
+        """
+        device = self.device
+        conf = self.config
+        num_top_spans, max_top_antecedents = top_antecedent_idx.shape[0], top_antecedent_idx.shape[1]
+        cluster_merging_scores = None
+        same_speaker_emb, genre_emb, seg_distance_emb, top_antecedent_distance_emb = None, None, None, None
+        if conf['use_metadata']:
+            top_antecedent_speaker_id = top_span_speaker_ids[top_antecedent_idx]
+            same_speaker = torch.unsqueeze(top_span_speaker_ids, 1) == top_antecedent_speaker_id
+            same_speaker_emb = self.emb_same_speaker(same_speaker.to(torch.long))
+            genre_emb = self.emb_genre(genre)
+            genre_emb = torch.unsqueeze(torch.unsqueeze(genre_emb, 0), 0).repeat(num_top_spans, max_top_antecedents, 1)
+        if conf['use_segment_distance']:
+            top_antecedent_seg_ids = top_span_seg_ids[top_antecedent_idx]
+            top_antecedent_seg_distance = torch.unsqueeze(top_span_seg_ids, 1) - top_antecedent_seg_ids
+            top_antecedent_seg_distance = torch.clamp(top_antecedent_seg_distance, 0, self.config['max_training_sentences'] - 1)
+            seg_distance_emb = self.emb_segment_distance(top_antecedent_seg_distance)
+        if conf['use_features']:  # Antecedent distance
+            top_antecedent_distance = util.bucket_distance(top_antecedent_offsets)
+            top_antecedent_distance_emb = self.emb_top_antecedent_distance(top_antecedent_distance)
+
+        for depth in range(conf['coref_depth']):
+            top_antecedent_emb = top_span_emb[top_antecedent_idx]  # [num top spans, max top antecedents, emb size]
+            feature_list = []
+            if conf['use_metadata']:  # speaker, genre
+                feature_list.append(same_speaker_emb)
+                feature_list.append(genre_emb)
+            if conf['use_segment_distance']:
+                feature_list.append(seg_distance_emb)
+            if conf['use_features']:  # Antecedent distance
+                feature_list.append(top_antecedent_distance_emb)
+            feature_emb = torch.cat(feature_list, dim=2)
+            feature_emb = self.dropout(feature_emb)
+            top_pairwise_slow_scores = self.get_pair_scores(top_span_emb, top_antecedent_emb, top_antecedent_idx, feature_emb)
+            top_pairwise_scores = top_pairwise_slow_scores + top_pairwise_fast_scores
+            if conf['higher_order'] == 'cluster_merging':
+                cluster_merging_scores = ho.cluster_merging(top_span_emb, top_antecedent_idx, top_pairwise_scores, self.emb_cluster_size, self.cluster_score_ffnn, None, self.dropout,
+                                                            device=device, reduce=conf['cluster_reduce'], easy_cluster_first=conf['easy_cluster_first'],
+                                                            block_size=conf['cluster_merging_block_size'])
+                break
+            elif depth != conf['coref_depth'] - 1:
+                if conf['higher_order'] == 'attended_antecedent':
+                    refined_span_emb = ho.attended_antecedent(top_span_emb, top_antecedent_emb, top_pairwise_scores, device)
+                elif conf['higher_order'] == 'max_antecedent':
+                    refined_span_emb = ho.max_antecedent(top_span_emb, top_antecedent_emb, top_pairwise_scores, device)
+                elif conf['higher_order'] == 'entity_equalization':
+                    refined_span_emb = ho.entity_equalization(top_span_emb, top_antecedent_emb, top_antecedent_idx, top_pairwise_scores, device)
+                elif conf['higher_order'] == 'span_clustering':
+                    refined_span_emb = ho.span_clustering(top_span_emb, top_antecedent_idx, top_pairwise_scores, self.span_attn_ffnn, device)
+
+                gate = self.gate_ffnn(torch.cat([top_span_emb, refined_span_emb], dim=1))
+                gate = torch.sigmoid(gate)
+                top_span_emb = gate * refined_span_emb + (1 - gate) * top_span_emb  # [num top spans, span emb size]
+        return top_pairwise_scores, cluster_merging_scores
+
+    def get_coarse_antecedent_scores(self, top_span_emb, top_span_mention_scores, max_top_antecedents, top_span_positions=None):
+        """ Keep top antecedents by fast scores; pairwise scores are computed for a block of spans at a time """
+        device = self.device
+        conf = self.config
+        num_top_spans = top_span_emb.shape[0]
+        if top_span_positions is None:
+            top_span_positions = torch.arange(0, num_top_spans, device=device)
+        block_size = conf['coarse_block_size'] or num_top_spans
+        window = conf['coarse_antecedent_window']  # 0: all preceding spans
+
+        source_span_emb = self.dropout(self.coarse_bilinear(top_span_emb))
+        target_span_emb = self.dropout(torch.transpose(top_span_emb, 0, 1))
+        if conf['use_distance_prior']:
+            distance_score = torch.squeeze(self.antecedent_distance_score_ffnn(self.dropout(self.emb_antecedent_distance_prior.weight)), 1)
+
+        top_pairwise_fast_scores, top_antecedent_idx = [], []
+        for block_start in range(0, num_top_spans, block_size):
+            block_end = min(block_start + block_size, num_top_spans)
+            col_start, col_end = self.get_coarse_block_cols(block_start, block_end, num_top_spans, max_top_antecedents, window)
+            antecedent_offsets = torch.unsqueeze(top_span_positions[block_start:block_end], 1) - \
+                torch.unsqueeze(top_span_positions[col_start:col_end], 0)  # [block size, num cols]
+            antecedent_mask = (antecedent_offsets >= 1)
+            if window:
+                antecedent_mask &= (antecedent_offsets <= window)
+            pairwise_mention_score_sum = torch.unsqueeze(top_span_mention_scores[block_start:block_end], 1) + \
+                torch.unsqueeze(top_span_mention_scores[col_start:col_end], 0)
+            pairwise_coref_scores = torch.matmul(source_span_emb[block_start:block_end], target_span_emb[:, col_start:col_end])
+            pairwise_fast_scores = pairwise_mention_score_sum + pairwise_coref_scores
+            pairwise_fast_scores += torch.log(antecedent_mask.to(torch.float))
+            if conf['use_distance_prior']:
+                bucketed_distance = util.bucket_distance(antecedent_offsets)
+                antecedent_distance_score = distance_score[bucketed_distance]
+                pairwise_fast_scores += antecedent_distance_score
+            block_top_scores, block_top_idx = torch.topk(pairwise_fast_scores, k=max_top_antecedents)
+            top_pairwise_fast_scores.append(block_top_scores)
+            top_antecedent_idx.append(block_top_idx + col_start)
+        top_pairwise_fast_scores = torch.cat(top_pairwise_fast_scores, dim=0)  # [num top spans, max top antecedents]
+        top_antecedent_idx = torch.cat(top_antecedent_idx, dim=0)
+
+        top_antecedent_offsets = torch.unsqueeze(top_span_positions, 1) - top_span_positions[top_antecedent_idx]
+        top_antecedent_mask = (top_antecedent_offsets >= 1)
+        if window:
+            top_antecedent_mask &= (top_antecedent_offsets <= window)
+        return top_pairwise_fast_scores, top_antecedent_idx, top_antecedent_mask, top_antecedent_offsets
+
+    @staticmethod
+    def get_coarse_block_cols(block_start, block_end, num_top_spans, max_top_antecedents, window):
+        """ Range of antecedent columns for a block of spans in coarse scoring """
+        if window:  # Only preceding spans within window; keep at least max_top_antecedents columns
+            col_start = max(0, min(block_start - window, num_top_spans - max_top_antecedents))
+            return col_start, min(num_top_spans, max(block_end, col_start + max_top_antecedents))
+        return 0, num_top_spans
+
+    def get_pair_scores(self, top_span_emb, top_antecedent_emb, top_antecedent_idx, feature_emb):
+        """ Slow scores by coref_score_ffnn on each span and its top antecedents """
+        if self.config['factorized_pair_scores']:
+            return self.get_factorized_pair_scores(top_span_emb, top_antecedent_emb, top_antecedent_idx, feature_emb)
+        max_top_antecedents = top_antecedent_idx.shape[1]
+        target_emb = torch.unsqueeze(top_span_emb, 1).repeat(1, max_top_antecedents, 1)
+        similarity_emb = target_emb * top_antecedent_emb
+        pair_emb = torch.cat([target_emb, top_antecedent_emb, similarity_emb, feature_emb], 2)
+        return torch.squeeze(self.coref_score_ffnn(pair_emb), 2)
+
+    def get_factorized_pair_scores(self, top_span_emb, top_antecedent_emb, top_antecedent_idx, feature_emb):
+        """ Same as coref_score_ffnn on concatenated [target, antecedent, similarity, feature] pair emb;
+        first layer is applied to each block separately, so target/antecedent parts are projected once per span
+        """
+        if isinstance(self.coref_score_ffnn, nn.Sequential):
+            first_linear, rest_ffnn = self.coref_score_ffnn[0], self.coref_score_ffnn[1:]
+        else:
+            first_linear, rest_ffnn = self.coref_score_ffnn, None
+        similarity_emb = torch.unsqueeze(top_span_emb, 1) * top_antecedent_emb  # [num top spans, max top antecedents, emb size]
+        if self.coref_score_blocks is not None:
+            target_linear, antecedent_linear, similarity_linear, feature_linear = self.coref_score_blocks
+            target_proj = target_linear(top_span_emb)  # [num top spans, hidden size]
+            antecedent_proj = antecedent_linear(top_span_emb)
+            pair_hidden = similarity_linear(similarity_emb) + feature_linear(feature_emb)
+        else:
+            weight = first_linear.weight
+            span_emb_size = self.span_emb_size
+            target_proj = nn.functional.linear(top_span_emb, weight[:, :span_emb_size], first_linear.bias)  # [num top spans, hidden size]
+            antecedent_proj = nn.functional.linear(top_span_emb, weight[:, span_emb_size: 2 * span_emb_size])
+            pair_hidden = nn.functional.linear(similarity_emb, weight[:, 2 * span_emb_size: 3 * span_emb_size])
+            pair_hidden += nn.functional.linear(feature_emb, weight[:, 3 * span_emb_size:])
+        pair_hidden += torch.unsqueeze(target_proj, 1) + antecedent_proj[top_antecedent_idx]
+        if rest_ffnn is not None:
+            pair_hidden = rest_ffnn(pair_hidden)
+        return torch.squeeze(pair_hidden, 2)
+
+    @staticmethod
+    def _extract_top_spans(candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans, num_words, max_span_width):
+        """ Keep top non-cross-overlapping candidates ordered by scores, sorted by span idx; by numpy array ops on CPU,
+        and by rounds of tensor ops on GPU
+        """
+        if candidate_starts.device.type == 'cpu':
+            selected_idx = CorefModel._extract_top_spans_numpy(candidate_idx_sorted.numpy(), candidate_starts.numpy(),
+                                                               candidate_ends.numpy(), num_top_spans)
+            return torch.from_numpy(selected_idx)
+        return CorefModel._extract_top_spans_parallel(candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans,
+                                                      num_words, max_span_width)
+
+    @staticmethod
+    def _extract_top_spans_numpy(candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans):
+        """ Same selection as the sequential greedy, by numpy arrays on blocks of candidates ordered by scores """
+        num_candidates = candidate_idx_sorted.shape[0]
+        num_tokens = int(candidate_ends.max(initial=0)) + 1
+        # Of kept spans: max end of those starting at each token; min start of those ending at each token
+        start_to_max_end = np.full(num_tokens, -1, dtype=np.int64)
+        end_to_min_start = np.full(num_tokens, num_tokens, dtype=np.int64)
+        selected_idx, num_selected = [], 0
+        block_start, block_size = 0, max(2 * num_top_spans, 1)
+        while block_start < num_candidates and num_selected < num_top_spans:
+            block_idx = candidate_idx_sorted[block_start: block_start + block_size].astype(np.int64)
+            starts, ends = candidate_starts[block_idx], candidate_ends[block_idx]
+            # Drop candidates crossing kept spans: starting in (start, end] and ending after end, or ending in [start, end)
+            # and starting before start; single-token candidates cross nothing
+            inner_idx = np.nonzero(ends > starts)[0]
+            inner_starts, inner_ends = starts[inner_idx], ends[inner_idx]
+            is_crossing = (util.range_max(start_to_max_end, inner_starts + 1, inner_ends + 1) > inner_ends) | \
+                (-util.range_max(-end_to_min_start, inner_starts, inner_ends) < inner_starts)
+            is_candidate = np.ones(block_idx.shape[0], dtype=bool)
+            is_candidate[inner_idx[is_crossing]] = False
+            # Greedy among remaining candidates of the block, which cross no kept span
+            block_kept_idx = np.nonzero(is_candidate)[0]
+            block_kept_idx = block_kept_idx[CorefModel._get_greedy_non_crossing(starts[block_kept_idx], ends[block_kept_idx])]
+            np.maximum.at(start_to_max_end, starts[block_kept_idx], ends[block_kept_idx])
+            np.minimum.at(end_to_min_start, ends[block_kept_idx], starts[block_kept_idx])
+            selected_idx.append(block_idx[block_kept_idx])
+            num_selected += block_kept_idx.shape[0]
+            block_start, block_size = block_start + block_size, 2 * block_size
+
+        # Take top kept candidates; sort by span idx
+        selected_idx = np.concatenate(selected_idx)[:num_top_spans]
+        selected_idx = selected_idx[np.lexsort((candidate_ends[selected_idx], candidate_starts[selected_idx]))]
+        if selected_idx.shape[0] < num_top_spans:  # Padding
+            selected_idx = np.concatenate([selected_idx, np.repeat(selected_idx[:1], num_top_spans - selected_idx.shape[0])])
+        return selected_idx
+
+    @staticmethod
+    def _get_greedy_non_crossing(span_starts, span_ends):
+        """ Whether each span is kept by the greedy over spans in the given order, where a span is kept if it crosses no
+        kept span; decided in rounds over edges of the crossing graph, as spans crossing no undecided higher span are kept
+        """
+        num_spans = span_starts.shape[0]
+        # Edges (i, j) of span j starting inside span i after its start and ending after it; by span positions in order
+        order = np.argsort(span_starts, kind='stable')
+        start_ptr = np.concatenate([[0], np.cumsum(np.bincount(span_starts, minlength=int(span_ends.max(initial=0)) + 1))])
+        first_inner_idx = start_ptr[span_starts + 1]
+        num_inner = start_ptr[span_ends + 1] - first_inner_idx  # Spans starting in (start, end]
+        edge_src = np.repeat(np.arange(num_spans), num_inner)
+        edge_dst = order[np.repeat(first_inner_idx - np.cumsum(num_inner) + num_inner, num_inner) + np.arange(edge_src.shape[0])]
+        is_crossing = span_ends[edge_dst] > span_ends[edge_src]
+        edge_src, edge_dst = edge_src[is_crossing], edge_dst[is_crossing]
+        higher, lower = np.minimum(edge_src, edge_dst), np.maximum(edge_src, edge_dst)
+
+        is_kept = np.zeros(num_spans, dtype=bool)
+        is_undecided = np.ones(num_spans, dtype=bool)
+        while higher.shape[0]:
+            is_blocked = np.zeros(num_spans, dtype=bool)
+            is_blocked[lower] = True  # By an undecided higher span
+            is_new_kept = is_undecided & ~is_blocked
+            is_kept |= is_new_kept
+            is_undecided[is_new_kept] = False
+            is_undecided[lower[is_new_kept[higher]]] = False  # Dropped
+            is_live = is_undecided[higher] & is_undecided[lower]
+            higher, lower = higher[is_live], lower[is_live]
+        return is_kept | is_undecided
+
+    @staticmethod
+    def _extract_top_spans_parallel(candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans, num_words, max_span_width):
+        """ Same selection as the sequential greedy, without loop over candidates: decided in rounds, where undecided
+        candidates crossing a kept one are dropped, and undecided candidates ranked higher than all undecided candidates
+        crossing them are kept. Each round has one device-to-host sync, for whether any candidate is undecided.
+        """
+        device = candidate_starts.device
+        num_candidates = candidate_starts.shape[0]
+        sorted_starts, sorted_ends = candidate_starts[candidate_idx_sorted], candidate_ends[candidate_idx_sorted]
+        # Priority by score rank: larger is better; 0 is reserved for empty grid cells
+        sorted_priority = torch.arange(num_candidates, 0, -1, dtype=torch.int, device=device)
+        sorted_state = torch.zeros(num_candidates, dtype=torch.long, device=device)  # 0: undecided; 1: kept; 2: dropped
+
+        num_considered = min(num_candidates, 2 * num_top_spans)  # Only consider top candidates; extend if not enough kept
+        while True:
+            starts, ends = sorted_starts[:num_considered], sorted_ends[:num_considered]
+            priority, state = sorted_priority[:num_considered], sorted_state[:num_considered]
+            while True:
+                undecided_idx = torch.nonzero(state == 0, as_tuple=False).squeeze(1)
+                if undecided_idx.shape[0] == 0:
+                    break
+                # Kept candidates outrank all undecided ones
+                source_idx = torch.nonzero(state != 2, as_tuple=False).squeeze(1)
+                source_priority = priority[source_idx] + (state[source_idx] == 1).to(torch.int) * num_candidates
+                max_crossing_priority = CorefModel._get_max_crossing_priority(starts, ends, source_idx, source_priority, undecided_idx,
+                                                                              num_words, max_span_width)
+                state[undecided_idx[max_crossing_priority > num_candidates]] = 2
+                state[undecided_idx[priority[undecided_idx] > max_crossing_priority]] = 1
+            if num_considered == num_candidates or (state == 1).sum() >= num_top_spans:
+                break
+            num_considered = min(num_candidates, 2 * num_considered)
+
+        # Take top kept candidates; sort by span idx
+        selected_idx = candidate_idx_sorted[torch.nonzero(sorted_state == 1, as_tuple=False).squeeze(1)[:num_top_spans]]
+        selected_idx = selected_idx[torch.argsort(candidate_starts[selected_idx] * num_words + candidate_ends[selected_idx])]
+        if selected_idx.shape[0] < num_top_spans:  # Padding
+            selected_idx = torch.cat([selected_idx, selected_idx[:1].repeat(num_top_spans - selected_idx.shape[0])])
+        return selected_idx
+
+    @staticmethod
+    def _get_max_crossing_priority(span_starts, span_ends, source_idx, source_priority, query_idx, num_words, max_span_width):
+        """ For each query span, max priority of source spans cross-overlapping it; 0 if none """
+        device = span_starts.device
+        # Source priority by start/end token and width; suffix max over width: max priority of spans at least that wide
+        source_starts, source_ends = span_starts[source_idx], span_ends[source_idx]
+        source_widths = source_ends - source_starts
+        start_grid = torch.zeros(max_span_width * num_words, dtype=torch.int, device=device)
+        start_grid[source_widths * num_words + source_starts] = source_priority
+        end_grid = torch.zeros(max_span_width * num_words, dtype=torch.int, device=device)
+        end_grid[source_widths * num_words + source_ends] = source_priority
+        start_grid = util.suffix_max(start_grid.view(max_span_width, num_words)).view(-1)  # [max span width, num words]
+        end_grid = util.suffix_max(end_grid.view(max_span_width, num_words)).view(-1)
+
+        query_starts = span_starts[query_idx].unsqueeze(1)
+        query_widths = span_ends[query_idx].unsqueeze(1) - query_starts
+        offsets = torch.arange(0, max_span_width, device=device)
+        token_idx = torch.clamp(query_starts + offsets, max=num_words - 1)  # [num queries, max span width]
+        # Spans starting at token in (start, end] and ending after end
+        right_min_width = torch.clamp(query_widths - offsets + 1, 0, max_span_width - 1)
+        right_mask = (offsets >= 1) & (offsets <= query_widths)
+        right_priority = start_grid[right_min_width * num_words + token_idx] * right_mask.to(torch.int)
+        # Spans ending at token in [start, end) and starting before start
+        left_min_width = torch.clamp(offsets + 1, max=max_span_width - 1)
+        left_mask = offsets < query_widths
+        left_priority = end_grid[left_min_width * num_words + token_idx] * left_mask.to(torch.int)
+        return torch.max(torch.max(right_priority, left_priority), dim=1)[0]
+
+    @staticmethod
+    def _extract_top_spans_sequential(candidate_idx_sorted, candidate_starts, candidate_ends, num_top_spans):
+        """ Sequential greedy of _extract_top_spans, by loop over candidates; list input """
         selected_candidate_idx = []
         start_to_max_end, end_to_min_start = {}, {}
         for candidate_idx in candidate_idx_sorted:
@@ -369,27 +779,60 @@ class CorefModel(nn.Module):
         return selected_candidate_idx
 
     def get_predicted_antecedents(self, antecedent_idx, antecedent_scores):
-        """ CPU list input """
-        predicted_antecedents = []
-        for i, idx in enumerate(np.argmax(antecedent_scores, axis=1) - 1):
-            if idx < 0:
-                predicted_antecedents.append(-1)
-            else:
-                predicted_antecedents.append(antecedent_idx[i][idx])
-        return predicted_antecedents
+        """ Tensor or array input; array output, -1 for dummy antecedent """
+        antecedent_idx, antecedent_scores = util.to_numpy(antecedent_idx), util.to_numpy(antecedent_scores)
+        predicted_idx = np.argmax(antecedent_scores, axis=1) - 1
+        predicted_antecedents = antecedent_idx[np.arange(predicted_idx.shape[0]), np.maximum(predicted_idx, 0)]
+        return np.where(predicted_idx < 0, -1, predicted_antecedents)
 
     def get_predicted_clusters(self, span_starts, span_ends, antecedent_idx, antecedent_scores):
-        """ CPU list input """
+        """ Tensor or array input """
+        span_starts, span_ends = util.to_numpy(span_starts), util.to_numpy(span_ends)
+        num_spans = span_starts.shape[0]
         # Get predicted antecedents
         predicted_antecedents = self.get_predicted_antecedents(antecedent_idx, antecedent_scores)
-
-        # Get predicted clusters
+        span_idx = np.arange(num_spans)
+        assert np.all(predicted_antecedents < span_idx), 'antecedent idx must be smaller than span idx'
+        if np.unique(np.stack([span_starts, span_ends], axis=1), axis=0).shape[0] < num_spans:
+            # Padded top spans repeat a span; mentions are resolved by (start, end)
+            return self._get_predicted_clusters_by_mentions(span_starts.tolist(), span_ends.tolist(), predicted_antecedents.tolist())
+
+        # Get first mention of each antecedent chain by path compression
+        has_antecedent = predicted_antecedents >= 0
+        span_to_root = np.where(has_antecedent, predicted_antecedents, span_idx)
+        while True:
+            next_span_to_root = span_to_root[span_to_root]
+            if np.array_equal(next_span_to_root, span_to_root):
+                break
+            span_to_root = next_span_to_root
+
+        # Get predicted clusters, ordered by their first linked spans
+        linked_idx = np.nonzero(has_antecedent)[0]
+        cluster_roots, first_linked_idx, linked_to_cluster_id = np.unique(span_to_root[linked_idx], return_index=True, return_inverse=True)
+        cluster_order = np.argsort(first_linked_idx)
+        cluster_rank = np.empty_like(cluster_order)
+        cluster_rank[cluster_order] = np.arange(cluster_order.shape[0])
+        linked_to_cluster_id = cluster_rank[linked_to_cluster_id.reshape(-1)]
+        cluster_roots = cluster_roots[cluster_order]
+        # Each cluster: first mention, then linked mentions by span order
+        mention_idx = np.concatenate([cluster_roots, linked_idx])
+        mention_to_cluster_id = np.concatenate([np.arange(cluster_roots.shape[0]), linked_to_cluster_id])
+        mention_order = np.argsort(mention_to_cluster_id, kind='stable')
+        mention_idx, mention_to_cluster_id = mention_idx[mention_order], mention_to_cluster_id[mention_order]
+        mentions = list(zip(span_starts[mention_idx].tolist(), span_ends[mention_idx].tolist()))
+        cluster_ends = np.cumsum(np.bincount(mention_to_cluster_id, minlength=cluster_roots.shape[0])).tolist()
+
+        predicted_clusters = [tuple(mentions[start:end]) for start, end in zip([0] + cluster_ends[:-1], cluster_ends)]
+        mention_to_cluster_id = dict(zip(mentions, mention_to_cluster_id.tolist()))
+        return predicted_clusters, mention_to_cluster_id, predicted_antecedents.tolist()
+
+    def _get_predicted_clusters_by_mentions(self, span_starts, span_ends, predicted_antecedents):
+        """ CPU list input """
         mention_to_cluster_id = {}
         predicted_clusters = []
         for i, predicted_idx in enumerate(predicted_antecedents):
             if predicted_idx < 0:
                 continue
-            assert i > predicted_idx, f'span idx: {i}; antecedent idx: {predicted_idx}'
             # Check antecedent's cluster
             antecedent = (int(span_starts[predicted_idx]), int(span_ends[predicted_idx]))
             antecedent_cluster_id = mention_to_cluster_id.get(antecedent, -1)
@@ -1,15 +1,14 @@
 import json
-from spacy.lang.en import English
 from preprocess import get_document
 import argparse
 import util
-from tensorize import CorefDataProcessor
 from run import Runner
 import logging
 logging.getLogger().setLevel(logging.CRITICAL)
 
 
 def create_spacy_tokenizer():
+    from spacy.lang.en import English
     nlp = English()
     sentencizer = nlp.create_pipe('sentencizer')
     nlp.add_pipe(sentencizer)
@@ -33,10 +32,14 @@ def get_document_from_string(string, seg_len, bert_tokenizer, spacy_tokenizer, g
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--config_name', type=str, required=True,
+    parser.add_argument('--config_name', type=str, default=None,
                         help='Configuration name in experiments.conf')
-    parser.add_argument('--model_identifier', type=str, required=True,
+    parser.add_argument('--model_identifier', type=str, default=None,
                         help='Model identifier to load')
+    parser.add_argument('--artifact_path', type=str, default=None,
+                        help='Inference artifact exported by artifact.py, instead of config_name and model_identifier')
+    parser.add_argument('--inference_mode', type=str, default=None, choices=['fp32', 'int8', 'bf16'],
+                        help='Override inference_int8 and inference_bf16 of config')
     parser.add_argument('--gpu_id', type=int, default=None,
                         help='GPU id; CPU by default')
     parser.add_argument('--seg_len', type=int, default=512)
@@ -45,10 +48,14 @@ if __name__ == '__main__':
     parser.add_argument('--output_path', type=str, default=None,
                         help='Path to save output')
     args = parser.parse_args()
+    if not args.artifact_path and not (args.config_name and args.model_identifier):
+        parser.error('Either --artifact_path, or --config_name and --model_identifier are required')
 
-    runner = Runner(args.config_name, args.gpu_id)
+    runner = Runner(args.config_name, args.gpu_id, artifact_path=args.artifact_path)
+    if args.inference_mode:
+        runner.set_inference_mode(args.inference_mode)
     model = runner.initialize_model(args.model_identifier)
-    data_processor = CorefDataProcessor(runner.config)
+    data_processor = runner.data
 
     if args.jsonlines_path:
         # Input from file
@@ -63,15 +70,19 @@ if __name__ == '__main__':
                 for i, doc in enumerate(docs):
                     doc['predicted_clusters'] = predicted_clusters[i]
                     f.write(json.dumps(doc))
+                    f.write('\n')
             print(f'Saved prediction in {args.output_path}')
     else:
         # Interactive input
         model.to(model.device)
+        from spacy.lang.en import English
         nlp = English()
         nlp.add_pipe(nlp.create_pipe('sentencizer'))
+        word_tokenizer = util.WordTokenizer(runner.config['bert_tokenizer_name'], vocab=runner.config.get('bert_vocab', None),
+                                            do_lower_case=runner.config.get('bert_do_lower_case', True))  # Cache kept across inputs
         while True:
             input_str = str(input('Input document:'))
-            bert_tokenizer, spacy_tokenizer = data_processor.tokenizer, nlp
+            bert_tokenizer, spacy_tokenizer = word_tokenizer, nlp
             doc = get_document_from_string(input_str, args.seg_len, bert_tokenizer, nlp)
             tensor_examples, stored_info = data_processor.get_tensor_examples_from_custom_input([doc])
             predicted_clusters, _, _ = runner.predict(model, tensor_examples)
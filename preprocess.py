@@ -1,7 +1,7 @@
 import argparse
 import logging
 import os
-import re
+import time
 import collections
 import json
 import conll
@@ -185,18 +185,23 @@ def split_into_segments(document_state: DocumentState, max_seg_len, constraints1
 def get_document(doc_key, doc_lines, language, seg_len, tokenizer):
     """ Process raw input to finalized documents """
     document_state = DocumentState(doc_key)
+    rows = [line.split() for line in doc_lines]  # Columns for each token
+    words = [normalize_word(row[3], language) for row in rows if len(row) > 0]
+    if isinstance(tokenizer, util.WordTokenizer):
+        words_subtokens = tokenizer.tokenize_words(words)  # All words in one batch
+    else:
+        words_subtokens = [tokenizer.tokenize(word) for word in words]
     word_idx = -1
 
     # Build up documents
-    for line in doc_lines:
-        row = line.split()  # Columns for each token
+    for row in rows:
         if len(row) == 0:
             document_state.sentence_end[-1] = True
         else:
             assert len(row) >= 12
             word_idx += 1
-            word = normalize_word(row[3], language)
-            subtokens = tokenizer.tokenize(word)
+            word = words[word_idx]
+            subtokens = words_subtokens[word_idx]
             document_state.tokens.append(word)
             document_state.token_end += [False] * (len(subtokens) - 1) + [True]
             for idx, subtoken in enumerate(subtokens):
@@ -213,43 +218,54 @@ def get_document(doc_key, doc_lines, language, seg_len, tokenizer):
     return document
 
 
-def minimize_partition(partition, extension, args, tokenizer):
-    input_path = os.path.join(args.input_dir, f'{partition}.{args.language}.{extension}')
+worker_tokenizer = None  # Tokenizer of each worker process
+
+
+def init_document_worker(tokenizer_name, cache_size, use_fast):
+    global worker_tokenizer
+    worker_tokenizer = util.WordTokenizer(tokenizer_name, cache_size, use_fast)
+
+
+def document_worker(item):
+    doc_key, doc_lines, language, seg_len = item
+    return get_document(doc_key, doc_lines, language, seg_len, worker_tokenizer)
+
+
+def get_input_path(input_dir, file_name):
+    """ Plain file, or gzip/xz compressed file with .gz/.xz extension """
+    for path in [os.path.join(input_dir, file_name + ext) for ext in ['', '.gz', '.xz']]:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(os.path.join(input_dir, file_name))
+
+
+def minimize_partition(partition, extension, args):
+    input_path = get_input_path(args.input_dir, f'{partition}.{args.language}.{extension}')
     output_path = os.path.join(args.output_dir, f'{partition}.{args.language}.{args.seg_len}.jsonlines')
-    doc_count = 0
+    doc_count, subtoken_count = 0, 0
     logger.info(f'Minimizing {input_path}...')
 
-    # Read documents
-    documents = []  # [(doc_key, lines)]
-    with open(input_path, 'r') as input_file:
-        for line in input_file.readlines():
-            begin_document_match = re.match(conll.BEGIN_DOCUMENT_REGEX, line)
-            if begin_document_match:
-                doc_key = conll.get_doc_key(begin_document_match.group(1), begin_document_match.group(2))
-                documents.append((doc_key, []))
-            elif line.startswith('#end document'):
-                continue
-            else:
-                documents[-1][1].append(line)
-
-    # Write documents
-    with open(output_path, 'w') as output_file:
-        for doc_key, doc_lines in documents:
-            if skip_doc(doc_key):
-                continue
-            document = get_document(doc_key, doc_lines, args.language, args.seg_len, tokenizer)
+    # Stream documents to worker processes; write each document in order once processed
+    start_time = time.time()
+    num_workers = args.num_workers or os.cpu_count()
+    with conll.open_conll(input_path) as input_file, open(output_path, 'w') as output_file:
+        items = ((doc_key, doc_lines, args.language, args.seg_len) for doc_key, doc_lines in conll.iter_documents(input_file)
+                 if not skip_doc(doc_key))
+        for document in util.parallel_map(document_worker, items, num_workers,
+                                          initializer=init_document_worker,
+                                          initargs=(args.tokenizer_name, args.tokenizer_cache_size, not args.slow_tokenizer)):
             output_file.write(json.dumps(document))
             output_file.write('\n')
             doc_count += 1
+            subtoken_count += sum(len(segment) for segment in document['sentences'])
+    util.log_throughput(f'Read, tokenized and segmented by {num_workers} workers', doc_count, subtoken_count, start_time)
     logger.info(f'Processed {doc_count} documents to {output_path}')
 
 
 def minimize_language(args):
-    tokenizer = util.get_tokenizer(args.tokenizer_name)
-
-    minimize_partition('dev', 'v4_gold_conll', args, tokenizer)
-    minimize_partition('test', 'v4_gold_conll', args, tokenizer)
-    minimize_partition('train', 'v4_gold_conll', args, tokenizer)
+    minimize_partition('dev', 'v4_gold_conll', args)
+    minimize_partition('test', 'v4_gold_conll', args)
+    minimize_partition('train', 'v4_gold_conll', args)
 
 
 if __name__ == '__main__':
@@ -257,13 +273,19 @@ if __name__ == '__main__':
     parser.add_argument('--tokenizer_name', type=str, default='bert-base-cased',
                         help='Name or path of the tokenizer/vocabulary')
     parser.add_argument('--input_dir', type=str, required=True,
-                        help='Input directory that contains conll files')
+                        help='Input directory that contains conll files, optionally gzip/xz compressed')
     parser.add_argument('--output_dir', type=str, required=True,
                         help='Output directory')
     parser.add_argument('--seg_len', type=int, default=128,
                         help='Segment length: 128, 256, 384, 512')
     parser.add_argument('--language', type=str, default='english',
                         help='english, chinese, arabic')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Processes for tokenization and segmentation; 0: all cores')
+    parser.add_argument('--tokenizer_cache_size', type=int, default=100000,
+                        help='Max words in LRU cache of subtokens in each process')
+    parser.add_argument('--slow_tokenizer', action='store_true',
+                        help='Tokenize word by word by the Python tokenizer')
     # parser.add_argument('--lower_case', action='store_true',
     #                     help='Do lower case on input')
 
@@ -0,0 +1,64 @@
+import argparse
+import io
+import logging
+import time
+import torch
+from run import Runner
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_model_size(model):
+    """ Bytes of serialized weights """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def validate(runner, model, examples, stored_info, modes):
+    """ Evaluate each reduced-precision inference mode against fp32; report F1 delta, speedup and model size """
+    results = {}
+    for mode in ['fp32'] + modes:
+        runner.set_inference_mode(mode)
+        model_of_mode = model.quantize_int8() if mode == 'int8' else model
+
+        start_time = time.time()
+        f1, _ = runner.evaluate(model_of_mode, examples, stored_info, 0)
+        results[mode] = (f1, time.time() - start_time, get_model_size(model_of_mode))
+    runner.set_inference_mode('fp32')
+
+    f1_fp32, time_fp32, size_fp32 = results['fp32']
+    for mode, (f1, elapsed, size) in results.items():
+        logger.info('%s: F1 %.2f (%+.2f); eval %.1fs, speedup %.2fx; model %.1fMB, %.2fx smaller' %
+                    (mode, f1, f1 - f1_fp32, elapsed, time_fp32 / elapsed, size / 1024 ** 2, size_fp32 / size))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_name', type=str, default=None,
+                        help='Configuration name in experiments.conf')
+    parser.add_argument('--model_identifier', type=str, default=None,
+                        help='Model identifier to load')
+    parser.add_argument('--artifact_path', type=str, default=None,
+                        help='Inference artifact exported by artifact.py, instead of config_name and model_identifier')
+    parser.add_argument('--split', type=str, default='dev', choices=['dev', 'tst'],
+                        help='Split to validate on')
+    parser.add_argument('--num_docs', type=int, default=0,
+                        help='Validate on the first docs of split; 0: all')
+    parser.add_argument('--modes', type=str, nargs='+', default=['int8', 'bf16'], choices=['int8', 'bf16'],
+                        help='Inference modes compared with fp32')
+    args = parser.parse_args()
+    if not args.artifact_path and not (args.config_name and args.model_identifier):
+        parser.error('Either --artifact_path, or --config_name and --model_identifier are required')
+
+    runner = Runner(args.config_name, None, artifact_path=args.artifact_path)  # CPU
+    runner.set_inference_mode('fp32')  # Quantized from the fp32 model below
+    model = runner.initialize_model(args.model_identifier)
+    examples = runner.data.get_split_examples(args.split)
+    num_docs = min(args.num_docs, len(examples)) if args.num_docs else len(examples)
+    examples = [examples[i] for i in range(num_docs)]
+    stored_info = runner.data.get_stored_info([args.split])
+    validate(runner, model, examples, stored_info, args.modes)
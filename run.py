@@ -1,11 +1,10 @@
+import contextlib
 import logging
 import random
 import numpy as np
 import torch
-from torch.utils.tensorboard import SummaryWriter
-from transformers import AdamW
 from torch.optim import Adam
-from tensorize import CorefDataProcessor
+from tensorize import CorefDataProcessor, TrainExampleLoader, get_length_batches, get_padding_stats
 import util
 import time
 from os.path import join
@@ -14,6 +13,7 @@ from datetime import datetime
 from torch.optim.lr_scheduler import LambdaLR
 from model import CorefModel
 import conll
+import artifact
 import sys
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -23,19 +23,25 @@ logger = logging.getLogger()
 
 
 class Runner:
-    def __init__(self, config_name, gpu_id=0, seed=None):
+    def __init__(self, config_name, gpu_id=0, seed=None, artifact_path=None):
+        """ artifact_path: inference artifact (see artifact.py) for config and model, instead of experiments.conf """
         self.name = config_name
         self.name_suffix = datetime.now().strftime('%b%d_%H-%M-%S')
         self.gpu_id = gpu_id
         self.seed = seed
+        self.artifact_path = artifact_path
 
-        # Set up config
-        self.config = util.initialize_config(config_name)
+        if artifact_path:
+            # Set up config; log to console only
+            self.config = artifact.load_config(artifact_path)
+        else:
+            # Set up config
+            self.config = util.initialize_config(config_name)
 
-        # Set up logger
-        log_path = join(self.config['log_dir'], 'log_' + self.name_suffix + '.txt')
-        logger.addHandler(logging.FileHandler(log_path, 'a'))
-        logger.info('Log file path: %s' % log_path)
+            # Set up logger
+            log_path = join(self.config['log_dir'], 'log_' + self.name_suffix + '.txt')
+            logger.addHandler(logging.FileHandler(log_path, 'a'))
+            logger.info('Log file path: %s' % log_path)
 
         # Set up seed
         if seed:
@@ -47,10 +53,24 @@ class Runner:
         # Set up data
         self.data = CorefDataProcessor(self.config)
 
+    def set_inference_mode(self, mode):
+        """ 'fp32', 'int8' or 'bf16': override inference_int8 and inference_bf16 of config """
+        assert mode in ['fp32', 'int8', 'bf16']
+        self.config['inference_int8'], self.config['inference_bf16'] = (mode == 'int8'), (mode == 'bf16')
+
     def initialize_model(self, saved_suffix=None):
-        model = CorefModel(self.config, self.device)
-        if saved_suffix:
+        if self.artifact_path:
+            model = artifact.load_model(self.artifact_path, self.config, self.device)
+        else:
+            model = CorefModel(self.config, self.device)
+            if not saved_suffix:
+                return model  # For training
             self.load_model_checkpoint(model, saved_suffix)
+        if self.config['inference_int8']:
+            if self.config['inference_bf16']:
+                raise ValueError('inference_int8 and inference_bf16 are exclusive: quantized layers take fp32 input')
+            model = model.quantize_int8()
+            logger.info('Quantized linear layers to int8 for inference')
         return model
 
     def train(self, model):
@@ -64,6 +84,7 @@ class Runner:
             logger.info('%s: %s' % (name, tuple(param.shape)))
 
         # Set up tensorboard
+        from torch.utils.tensorboard import SummaryWriter  # Only for training; slow to import
         tb_path = join(conf['tb_dir'], self.name + '_' + self.name_suffix)
         tb_writer = SummaryWriter(tb_path, flush_secs=30)
         logger.info('Tensorboard summary path: %s' % tb_path)
@@ -71,6 +92,8 @@ class Runner:
         # Set up data
         examples_train, examples_dev, examples_test = self.data.get_tensor_examples()
         stored_info = self.data.get_stored_info()
+        train_order = list(range(len(examples_train)))
+        train_loader = TrainExampleLoader(examples_train, conf, self.device, seed=random.getrandbits(32))
 
         # Set up optimizer and scheduler
         total_update_steps = len(examples_train) * epochs // grad_accum
@@ -91,14 +114,13 @@ class Runner:
         loss_during_report = 0.0  # Effective loss during logging step
         loss_history = []  # Full history of effective loss; length equals total update steps
         max_f1 = 0
-        start_time = time.time()
+        start_time, start_wait_time = time.time(), 0
         model.zero_grad()
         for epo in range(epochs):
-            random.shuffle(examples_train)  # Shuffle training set
-            for doc_key, example in examples_train:
+            random.shuffle(train_order)  # Shuffle training set
+            for doc_key, example_gpu in train_loader.iter_epoch(epo, train_order):
                 # Forward pass
                 model.train()
-                example_gpu = [d.to(self.device) for d in example]
                 _, loss = model(*example_gpu)
 
                 # Backward; accumulate gradients and clip by grad norm
@@ -129,12 +151,14 @@ class Runner:
                         # Show avg loss during last report interval
                         avg_loss = loss_during_report / conf['report_frequency']
                         loss_during_report = 0.0
-                        end_time = time.time()
-                        logger.info('Step %d: avg loss %.2f; steps/sec %.2f' %
-                                    (len(loss_history), avg_loss, conf['report_frequency'] / (end_time - start_time)))
-                        start_time = end_time
+                        end_time, wait_time = time.time(), train_loader.wait_time - start_wait_time
+                        logger.info('Step %d: avg loss %.2f; steps/sec %.2f; waited for input %.1f%% of time' %
+                                    (len(loss_history), avg_loss, conf['report_frequency'] / (end_time - start_time),
+                                     100 * wait_time / (end_time - start_time)))
+                        start_time, start_wait_time = end_time, train_loader.wait_time
 
                         tb_writer.add_scalar('Training_Loss', avg_loss, len(loss_history))
+                        tb_writer.add_scalar('Input_Wait_Seconds', wait_time, len(loss_history))
                         tb_writer.add_scalar('Learning_Rate_Bert', schedulers[0].get_last_lr()[0], len(loss_history))
                         tb_writer.add_scalar('Learning_Rate_Task', schedulers[1].get_last_lr()[-1], len(loss_history))
 
@@ -145,7 +169,7 @@ class Runner:
                             max_f1 = f1
                             self.save_model_checkpoint(model, len(loss_history))
                         logger.info('Eval max f1: %.2f' % max_f1)
-                        start_time = time.time()
+                        start_time, start_wait_time = time.time(), train_loader.wait_time
 
         logger.info('**********Finished training**********')
         logger.info('Actual update steps: %d' % len(loss_history))
@@ -160,15 +184,9 @@ class Runner:
         evaluator = CorefEvaluator()
         doc_to_prediction = {}
 
-        model.eval()
-        for i, (doc_key, tensor_example) in enumerate(tensor_examples):
+        for _, doc_key, output in self.get_inference_outputs(model, tensor_examples):
             gold_clusters = stored_info['gold'][doc_key]
-            tensor_example = tensor_example[:7]  # Strip out gold
-            example_gpu = [d.to(self.device) for d in tensor_example]
-            with torch.no_grad():
-                _, _, _, span_starts, span_ends, antecedent_idx, antecedent_scores = model(*example_gpu)
-            span_starts, span_ends = span_starts.tolist(), span_ends.tolist()
-            antecedent_idx, antecedent_scores = antecedent_idx.tolist(), antecedent_scores.tolist()
+            _, _, _, span_starts, span_ends, antecedent_idx, antecedent_scores = output
             predicted_clusters = model.update_evaluator(span_starts, span_ends, antecedent_idx, antecedent_scores, gold_clusters, evaluator)
             doc_to_prediction[doc_key] = predicted_clusters
 
@@ -178,6 +196,8 @@ class Runner:
             logger.info('%s: %.2f' % (name, score))
             if tb_writer:
                 tb_writer.add_scalar(name, score, step)
+        for name, (p, r, f) in evaluator.get_metric_prf().items():
+            logger.info('%s: P %.2f, R %.2f, F1 %.2f' % (name, p * 100, r * 100, f * 100))
 
         if official:
             conll_results = conll.evaluate_conll(conll_path, doc_to_prediction, stored_info['subtoken_maps'])
@@ -189,26 +209,62 @@ class Runner:
     def predict(self, model, tensor_examples):
         logger.info('Predicting %d samples...' % len(tensor_examples))
         model.to(self.device)
-        predicted_spans, predicted_antecedents, predicted_clusters = [], [], []
+        num_examples = len(tensor_examples)
+        predicted_spans, predicted_antecedents, predicted_clusters = [None] * num_examples, [None] * num_examples, [None] * num_examples
 
-        model.eval()
-        for i, (doc_key, tensor_example) in enumerate(tensor_examples):
-            tensor_example = tensor_example[:7]
-            example_gpu = [d.to(self.device) for d in tensor_example]
-            with torch.no_grad():
-                _, _, _, span_starts, span_ends, antecedent_idx, antecedent_scores = model(*example_gpu)
-            span_starts, span_ends = span_starts.tolist(), span_ends.tolist()
-            antecedent_idx, antecedent_scores = antecedent_idx.tolist(), antecedent_scores.tolist()
+        for i, doc_key, output in self.get_inference_outputs(model, tensor_examples):
+            _, _, _, span_starts, span_ends, antecedent_idx, antecedent_scores = output
             clusters, mention_to_cluster_id, antecedents = model.get_predicted_clusters(span_starts, span_ends, antecedent_idx, antecedent_scores)
 
-            spans = [(span_start, span_end) for span_start, span_end in zip(span_starts, span_ends)]
-            predicted_spans.append(spans)
-            predicted_antecedents.append(antecedents)
-            predicted_clusters.append(clusters)
+            spans = list(zip(span_starts.tolist(), span_ends.tolist()))
+            predicted_spans[i] = spans
+            predicted_antecedents[i] = antecedents
+            predicted_clusters[i] = clusters
 
         return predicted_clusters, predicted_spans, predicted_antecedents
 
+    def get_inference_outputs(self, model, tensor_examples):
+        """ Yield (example idx, doc_key, model output) by length-bucketed batches; segments of docs in a batch are
+        encoded in one BERT pass, up to eval_batch_tokens tokens per pass (0: one doc per pass)
+        """
+        if self.config['stream_window_segments']:
+            # Each doc by windows; input stays on CPU
+            logger.info('Streaming inference by windows of %d segments' % self.config['stream_window_segments'])
+            model.eval()
+            for i, (doc_key, tensor_example) in enumerate(tensor_examples):
+                with torch.no_grad(), self.get_inference_autocast():
+                    output = model.get_predictions_streaming(*tensor_example[:6])
+                yield i, doc_key, output
+            return
+
+        batches = get_length_batches(tensor_examples, self.config['eval_batch_tokens'])
+        padding_full, padding_batched = get_padding_stats(tensor_examples, batches)
+        logger.info('Encoder padding: %.2f%% by doc with full segments; %.2f%% by %d batches with trimmed segments' %
+                    (padding_full * 100, padding_batched * 100, len(batches)))
+        model.eval()
+        for batch in batches:
+            batch_outputs = self.get_batch_inference_outputs(model, [tensor_examples[i] for i in batch])
+            for i, (doc_key, output) in zip(batch, batch_outputs):
+                yield i, doc_key, output
+
+    def get_batch_inference_outputs(self, model, batch):
+        examples_gpu = [[d.to(self.device) for d in tensor_example[:7]] for _, tensor_example in batch]  # Strip out gold
+        with torch.no_grad(), self.get_inference_autocast():
+            mention_docs = model.encode_documents([example_gpu[0] for example_gpu in examples_gpu],
+                                                  [example_gpu[1] for example_gpu in examples_gpu])
+            outputs = [model(*example_gpu, mention_doc=mention_doc) for example_gpu, mention_doc in zip(examples_gpu, mention_docs)]
+        return [(doc_key, output) for (doc_key, _), output in zip(batch, outputs)]
+
+    def get_inference_autocast(self):
+        """ Context of bf16 autocast if inference_bf16, otherwise no-op """
+        if not self.config['inference_bf16']:
+            return contextlib.ExitStack()
+        if not hasattr(torch, 'autocast'):
+            raise ValueError('inference_bf16 requires torch >= 1.10')
+        return torch.autocast(self.device.type, dtype=torch.bfloat16)
+
     def get_optimizer(self, model):
+        from transformers import AdamW
         no_decay = ['bias', 'LayerNorm.weight']
         bert_param, task_param = model.get_params(named=True)
         grouped_bert_param = [
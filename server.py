@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import util
+from preprocess import get_document
+from run import Runner
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CorefServer:
+    """ Keep model loaded; documents of concurrent requests are queued and predicted together in batches, whose segments
+    are encoded in shared BERT passes (see Runner.get_inference_outputs).
+    A batch is run when it has max_batch_docs documents, or max_latency_ms after its first document arrived.
+    """
+    def __init__(self, config_name, model_identifier, gpu_id=None, seg_len=512, max_batch_docs=16, max_latency_ms=20,
+                 artifact_path=None, inference_mode=None):
+        self.runner = Runner(config_name, gpu_id, artifact_path=artifact_path)
+        if inference_mode:
+            self.runner.set_inference_mode(inference_mode)
+        self.model = self.runner.initialize_model(model_identifier)
+        self.model.to(self.model.device)
+        self.model.eval()
+        self.seg_len = seg_len
+        self.max_batch_docs = max_batch_docs
+        self.max_latency = max_latency_ms / 1000
+
+        # Created once for all requests
+        from spacy.lang.en import English
+        self.nlp = English()
+        self.nlp.add_pipe(self.nlp.create_pipe('sentencizer'))
+        config = self.runner.config
+        self.word_tokenizer = util.WordTokenizer(config['bert_tokenizer_name'], vocab=config.get('bert_vocab', None),
+                                                 do_lower_case=config.get('bert_do_lower_case', True))
+
+        self.queue = None  # Of (request doc, future), created in the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Model runs in one thread, off the event loop
+        self.latencies = collections.deque(maxlen=10000)  # Seconds of recent requests
+        self.num_docs_done, self.num_batches_done = 0, 0
+        self.doc_count = 0
+
+    def get_document(self, request_doc):
+        """ Request doc: {'text': ..., 'genre': ...} of raw text, or a document as in jsonlines files.
+        Return (document, char offsets of each word or None)
+        """
+        self.doc_count += 1
+        if 'text' not in request_doc:
+            document = dict(request_doc)
+            document['doc_key'] = f'{document.get("doc_key", "nw")[:2]}_{self.doc_count}'  # Unique in batch; keep genre
+            document.setdefault('clusters', [])  # Gold clusters are not needed for prediction
+            return document, None
+
+        genre = request_doc.get('genre', 'nw')
+        doc_lines, word_offsets = [], []
+        for token in self.nlp(request_doc['text']):
+            if not token.is_space:
+                cols = [genre] + ['-'] * 11
+                cols[3] = token.text
+                doc_lines.append('\t'.join(cols))
+                word_offsets.append((token.idx, token.idx + len(token.text)))
+            if token.is_sent_end and doc_lines and doc_lines[-1] != '\n':
+                doc_lines.append('\n')
+        document = get_document(f'{genre}_{self.doc_count}', doc_lines, 'english', self.seg_len, self.word_tokenizer)
+        return document, word_offsets
+
+    def predict_batch(self, request_docs):
+        """ Run in executor; return response of each request doc: clusters of mentions with subtoken, word (and char for
+        raw text) offsets, all inclusive except char end. A doc failing to be tensorized or predicted gets its exception
+        as response instead, without failing other docs of the batch.
+        """
+        responses = [None] * len(request_docs)
+        valid_idx, documents, word_offsets, tensor_examples = [], [], [], []
+        for i, request_doc in enumerate(request_docs):
+            try:
+                document, doc_word_offsets = self.get_document(request_doc)
+                tensor_example = self.runner.data.get_tensor_examples_from_custom_input([document])[0][0]
+            except Exception as e:
+                responses[i] = ValueError(f'Invalid document: {e!r}')
+                continue
+            valid_idx.append(i)
+            documents.append(document)
+            word_offsets.append(doc_word_offsets)
+            tensor_examples.append(tensor_example)
+
+        try:
+            predicted_clusters = self.runner.predict(self.model, tensor_examples)[0]
+        except Exception:
+            logger.exception('Failed batch of %d docs; predicting each doc separately' % len(tensor_examples))
+            predicted_clusters = []
+            for tensor_example in tensor_examples:
+                try:
+                    predicted_clusters.append(self.runner.predict(self.model, [tensor_example])[0][0])
+                except Exception as e:
+                    predicted_clusters.append(e)
+
+        for i, document, doc_word_offsets, clusters in zip(valid_idx, documents, word_offsets, predicted_clusters):
+            request_doc = request_docs[i]
+            if isinstance(clusters, Exception):
+                responses[i] = clusters
+                continue
+            subtokens, subtoken_map = util.flatten(document['sentences']), document['subtoken_map']
+            response_clusters = []
+            for cluster in clusters:
+                mentions = []
+                for start, end in cluster:
+                    mention = {'subtoken_start': start, 'subtoken_end': end,
+                               'word_start': subtoken_map[start], 'word_end': subtoken_map[end]}
+                    if doc_word_offsets is None:
+                        mention['text'] = ' '.join(subtokens[start: end + 1]).replace(' ##', '').replace('##', '')
+                    else:
+                        mention['char_start'] = doc_word_offsets[subtoken_map[start]][0]
+                        mention['char_end'] = doc_word_offsets[subtoken_map[end]][1]
+                        mention['text'] = request_doc['text'][mention['char_start']: mention['char_end']]
+                    mentions.append(mention)
+                response_clusters.append(mentions)
+            responses[i] = {'clusters': response_clusters}
+        return responses
+
+    async def run_batches(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_docs:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            request_docs, futures = zip(*batch)
+            try:
+                responses = await loop.run_in_executor(self.executor, self.predict_batch, list(request_docs))
+                for future, response in zip(futures, responses):
+                    if isinstance(response, Exception):
+                        future.set_exception(response)
+                    else:
+                        future.set_result(response)
+            except Exception as e:
+                logger.exception('Failed batch')
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            self.num_docs_done += len(batch)
+            self.num_batches_done += 1
+
+    async def predict(self, request_docs):
+        start_time = time.time()
+        futures = []
+        for request_doc in request_docs:
+            futures.append(asyncio.get_event_loop().create_future())
+            await self.queue.put((request_doc, futures[-1]))
+        responses = await asyncio.gather(*futures, return_exceptions=True)  # Exceptions of all docs are retrieved
+        self.latencies.append(time.time() - start_time)
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        return responses
+
+    def get_stats(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'queue_depth': self.queue.qsize(),
+            'num_requests': len(latencies),
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'num_docs': self.num_docs_done,
+            'avg_batch_docs': self.num_docs_done / max(self.num_batches_done, 1)
+        }
+
+    async def handle_connection(self, reader, writer):
+        """ Minimal HTTP/1.1: POST /predict with one JSON request doc per line; GET /stats """
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if len(request_line) >= 2 and request_line[0] == 'GET' and request_line[1] == '/stats':
+                status, response = 200, json.dumps(self.get_stats())
+            elif len(request_line) >= 2 and request_line[0] == 'POST' and request_line[1] == '/predict':
+                try:
+                    request_docs = [json.loads(line) for line in body.decode('utf-8').splitlines() if line.strip()]
+                    for request_doc in request_docs:
+                        if isinstance(request_doc, dict) and not isinstance(request_doc.get('text', ''), str):
+                            raise ValueError('"text" should be a string')
+                        if not isinstance(request_doc, dict) or \
+                                not (request_doc.get('text', '').strip() or request_doc.get('sentences')):
+                            raise ValueError('Each line should have non-empty "text" or "sentences"')
+                        if 'text' not in request_doc and not all(key in request_doc for key in ('speakers', 'sentence_map')):
+                            raise ValueError('Each line with "sentences" should also have "speakers" and "sentence_map"')
+                    responses = await self.predict(request_docs)
+                except ValueError as e:  # Invalid request or document
+                    status, response = 400, json.dumps({'error': str(e)})
+                else:
+                    status, response = 200, '\n'.join(json.dumps(response) for response in responses)
+            else:
+                status, response = 404, json.dumps({'error': 'GET /stats or POST /predict'})
+        except Exception as e:
+            logger.exception('Failed request')
+            status, response = 500, json.dumps({'error': str(e)})
+
+        response = response.encode('utf-8')
+        writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                     f'Content-Type: application/json\r\nContent-Length: {len(response)}\r\nConnection: close\r\n\r\n'
+                     .encode('latin-1') + response)
+        await writer.drain()
+        writer.close()
+
+    def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        loop.create_task(self.run_batches())
+        if unix_socket:
+            loop.run_until_complete(asyncio.start_unix_server(self.handle_connection, path=unix_socket))
+            logger.info(f'Serving on {unix_socket}')
+        else:
+            loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port))
+            logger.info(f'Serving on http://{host}:{port}')
+        loop.run_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_name', type=str, default=None,
+                        help='Configuration name in experiments.conf')
+    parser.add_argument('--model_identifier', type=str, default=None,
+                        help='Model identifier to load')
+    parser.add_argument('--artifact_path', type=str, default=None,
+                        help='Inference artifact exported by artifact.py, instead of config_name and model_identifier')
+    parser.add_argument('--inference_mode', type=str, default=None, choices=['fp32', 'int8', 'bf16'],
+                        help='Override inference_int8 and inference_bf16 of config')
+    parser.add_argument('--gpu_id', type=int, default=None,
+                        help='GPU id; CPU by default')
+    parser.add_argument('--seg_len', type=int, default=512)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='Path of Unix socket to serve on instead of host and port')
+    parser.add_argument('--max_batch_docs', type=int, default=16,
+                        help='Max queued documents predicted in one batch')
+    parser.add_argument('--max_latency_ms', type=float, default=20,
+                        help='Max time a document waits in queue for others to batch with')
+    args = parser.parse_args()
+    if not args.artifact_path and not (args.config_name and args.model_identifier):
+        parser.error('Either --artifact_path, or --config_name and --model_identifier are required')
+
+    server = CorefServer(args.config_name, args.model_identifier, args.gpu_id, args.seg_len, args.max_batch_docs,
+                         args.max_latency_ms, args.artifact_path, args.inference_mode)
+    server.serve(args.host, args.port, args.unix_socket)
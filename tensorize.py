@@ -4,7 +4,11 @@ import random
 import os
 from os.path import join
 import json
-import pickle
+import collections.abc
+import shutil
+import time
+import queue
+import threading
 import logging
 import torch
 
@@ -20,8 +24,10 @@ class CorefDataProcessor:
         self.max_training_seg = config['max_training_sentences']
         self.data_dir = config['data_dir']
 
-        self.tokenizer = util.get_tokenizer(config['bert_tokenizer_name'])
-        self.tensor_samples, self.stored_info = None, None  # For dataset samples; lazy loading
+        self.tokenizer = util.get_tokenizer(config['bert_tokenizer_name'], config.get('bert_vocab', None),
+                                            config.get('bert_do_lower_case', True))  # Vocab set by artifact
+        self.tensor_samples, self.stored_info = {}, {}  # {split: ...} for dataset samples; each split loaded on demand
+        self.cache_path = None
 
     def get_tensor_examples_from_custom_input(self, samples):
         """ For interactive samples; no caching """
@@ -31,58 +37,458 @@ class CorefDataProcessor:
         return tensor_samples, tensorizer.stored_info
 
     def get_tensor_examples(self):
-        """ For dataset samples """
-        cache_path = self.get_cache_path()
+        """ For dataset samples of all splits; tensors are memory-mapped from cache, loaded on access """
+        return self.get_split_examples('trn'), self.get_split_examples('dev'), self.get_split_examples('tst')
+
+    def get_split_examples(self, split):
+        """ Examples of one split: 'trn', 'dev' or 'tst'; other splits are not read, nor tensorized if cache is outdated.
+        If shared_memory_dir is set, the cache is published there, so that processes on the host share one copy in memory.
+        """
+        if split not in self.tensor_samples:
+            file_split = {'trn': 'train', 'dev': 'dev', 'tst': 'test'}[split]
+            path = join(self.data_dir, f'{file_split}.{self.language}.{self.max_seg_len}.jsonlines')
+            shared_cache_path = self.get_shared_cache_path(split) if self.config['shared_memory_dir'] else None
+            if shared_cache_path and self.is_cache_fresh(shared_cache_path, path):
+                logger.info('Attached to tensorized examples of %s in %s' % (path, shared_cache_path))
+                self.tensor_samples[split] = CachedTensorExamples(shared_cache_path)
+            else:
+                split_cache_path = join(self.get_cache_path(), split)
+                self.tensor_samples[split] = self.get_split_tensor_examples(path, split_cache_path, is_training=(split == 'trn'))
+                if shared_cache_path:
+                    self.publish_cache(split_cache_path, shared_cache_path)
+                    self.tensor_samples[split] = CachedTensorExamples(shared_cache_path)
+        return self.tensor_samples[split]
+
+    def get_shared_cache_path(self, split):
+        """ Keyed by cache path, which is keyed by tensorization config """
+        cache_path = os.path.abspath(self.get_cache_path())
+        return join(self.config['shared_memory_dir'], 'coref_hoi', f'{os.path.basename(cache_path)}.{util.get_content_hash(cache_path)[:8]}', split)
+
+    @classmethod
+    def publish_cache(cls, split_cache_path, shared_cache_path):
+        """ Copy cache of a split to shared memory, unless already published by another process;
+        replace it when complete, so that attached processes keep old files
+        """
+        os.makedirs(os.path.dirname(shared_cache_path), exist_ok=True)
+        with util.file_lock(f'{shared_cache_path}.lock'):
+            if cls.read_manifest(shared_cache_path) == cls.read_manifest(split_cache_path):
+                return
+            tmp_cache_path = f'{shared_cache_path}.tmp{os.getpid()}'
+            if os.path.exists(tmp_cache_path):
+                shutil.rmtree(tmp_cache_path)
+            shutil.copytree(split_cache_path, tmp_cache_path)
+            cls.replace_cache(tmp_cache_path, shared_cache_path)
+            logger.info('Published tensorized examples to %s' % shared_cache_path)
+
+    @classmethod
+    def replace_cache(cls, tmp_cache_path, cache_path):
+        """ Move complete cache into place under lock; old cache is moved aside first, then removed """
         if os.path.exists(cache_path):
-            # Load cached tensors if exists
-            with open(cache_path, 'rb') as f:
-                self.tensor_samples, self.stored_info = pickle.load(f)
-                logger.info('Loaded tensorized examples from cache')
+            old_cache_path = f'{cache_path}.old{os.getpid()}'
+            os.rename(cache_path, old_cache_path)
+            os.rename(tmp_cache_path, cache_path)
+            shutil.rmtree(old_cache_path, ignore_errors=True)
         else:
-            # Generate tensorized samples
-            self.tensor_samples = {}
-            tensorizer = Tensorizer(self.config, self.tokenizer)
-            paths = {
-                'trn': join(self.data_dir, f'train.{self.language}.{self.max_seg_len}.jsonlines'),
-                'dev': join(self.data_dir, f'dev.{self.language}.{self.max_seg_len}.jsonlines'),
-                'tst': join(self.data_dir, f'test.{self.language}.{self.max_seg_len}.jsonlines')
-            }
-            for split, path in paths.items():
-                logger.info('Tensorizing examples from %s; results will be cached)' % path)
-                is_training = (split == 'trn')
-                with open(path, 'r') as f:
-                    samples = [json.loads(line) for line in f.readlines()]
-                tensor_samples = [tensorizer.tensorize_example(sample, is_training) for sample in samples]
-                self.tensor_samples[split] = [(doc_key, self.convert_to_torch_tensor(*tensor)) for doc_key, tensor
-                                              in tensor_samples]
-            self.stored_info = tensorizer.stored_info
-            # Cache tensorized samples
-            with open(cache_path, 'wb') as f:
-                pickle.dump((self.tensor_samples, self.stored_info), f)
-        return self.tensor_samples['trn'], self.tensor_samples['dev'], self.tensor_samples['tst']
-
-    def get_stored_info(self):
-        return self.stored_info
+            os.rename(tmp_cache_path, cache_path)
+
+    @classmethod
+    def read_manifest(cls, split_cache_path):
+        """ Manifest of cache, or None if not complete; manifest is written last """
+        manifest_path = join(split_cache_path, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def is_cache_fresh(cls, split_cache_path, path):
+        """ Whether cache is built from the jsonlines file of the same size and modification time """
+        manifest = cls.read_manifest(split_cache_path)
+        return manifest is not None and manifest.get('file_stat') == cls.get_file_stat(path)
+
+    @classmethod
+    def get_file_stat(cls, path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def iter_split_examples(self, split):
+        """ Lazily yield (doc_key, tensors) of one split; each example is read from cache only when reached """
+        yield from self.get_split_examples(split)
+
+    def get_split_tensor_examples(self, path, split_cache_path, is_training):
+        """ Cache of a split is used if its jsonlines file has the same size and modification time, or content hash;
+        otherwise, only new or changed docs (by line hash) are tensorized, and merged with unchanged docs from cache
+        """
+        if self.is_cache_fresh(split_cache_path, path):
+            logger.info('Loaded tensorized examples of %s from cache' % path)
+            return CachedTensorExamples(split_cache_path)
+        os.makedirs(os.path.dirname(split_cache_path), exist_ok=True)
+        with util.file_lock(f'{split_cache_path}.lock'):  # Processes starting together build the cache once
+            if self.is_cache_fresh(split_cache_path, path):
+                logger.info('Loaded tensorized examples of %s from cache built by another process' % path)
+                return CachedTensorExamples(split_cache_path)
+            return self.build_split_tensor_examples(path, split_cache_path, is_training)
+
+    def build_split_tensor_examples(self, path, split_cache_path, is_training):
+        """ Update cache of a split under lock """
+        file_stat = self.get_file_stat(path)
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+        file_hash = util.get_content_hash(b''.join(lines))
+        manifest_path = join(split_cache_path, 'manifest.json')
+        manifest = self.read_manifest(split_cache_path)
+        if manifest is not None:
+            if manifest['file_hash'] == file_hash:  # Only file stat changed
+                manifest['file_stat'] = file_stat
+                with open(f'{manifest_path}.tmp{os.getpid()}', 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(f'{manifest_path}.tmp{os.getpid()}', manifest_path)  # Readers never see partial manifest
+                logger.info('Loaded tensorized examples of %s from cache' % path)
+                return CachedTensorExamples(split_cache_path)
+
+        # Get cached docs by line hash
+        cached_examples, cached_stored_info, cached_idx = None, None, {}
+        if manifest is not None:
+            cached_examples = CachedTensorExamples(split_cache_path)
+            cached_stored_info = CachedStoredInfo(split_cache_path)
+            cached_idx = {line_hash: i for i, line_hash in enumerate(manifest['line_hashes'])}
+
+        # Tensorize new or changed docs by worker processes; training docs are truncated per epoch by TrainExampleLoader
+        line_hashes = [util.get_content_hash(line) for line in lines]
+        new_idx = [i for i, line_hash in enumerate(line_hashes) if line_hash not in cached_idx]
+        new_items = [(lines[i], is_training) for i in new_idx]
+        num_workers = min(self.config['tensorize_workers'] or os.cpu_count(), len(new_items))  # In process for 0 or 1 item
+        start_time = time.time()
+        new_samples = list(util.parallel_map(tensorize_worker, new_items, num_workers,
+                                             initializer=init_tensorize_worker, initargs=(self.config, self.tokenizer)))
+        util.log_throughput(f'Tensorized new or changed examples from {path} by {num_workers} workers', len(new_samples),
+                            sum(int(tensor[1].sum()) for _, tensor, _, _ in new_samples), start_time)
+        logger.info('%d examples from cache' % (len(lines) - len(new_idx)))
+
+        # Merge with cached docs
+        tensor_samples = [None] * len(lines)
+        stored_info = {'subtoken_maps': {}, 'gold': {}}
+        for i, line_hash in enumerate(line_hashes):
+            if line_hash in cached_idx:
+                doc_key, tensor = cached_examples[cached_idx[line_hash]]
+                stored_info['subtoken_maps'][doc_key] = cached_stored_info.subtoken_maps[doc_key]
+                stored_info['gold'][doc_key] = cached_stored_info.gold[doc_key]
+                tensor_samples[i] = (doc_key, tensor)
+        for i, (doc_key, tensor, subtoken_map, gold) in zip(new_idx, new_samples):
+            stored_info['subtoken_maps'][doc_key] = subtoken_map
+            stored_info['gold'][doc_key] = gold
+            tensor_samples[i] = (doc_key, tensor)
+
+        # Cache tensorized samples, with manifest last; replace old cache when complete
+        tmp_cache_path = f'{split_cache_path}.tmp{os.getpid()}'
+        if os.path.exists(tmp_cache_path):
+            shutil.rmtree(tmp_cache_path)
+        CachedTensorExamples.write(tmp_cache_path, tensor_samples)
+        CachedStoredInfo.write(tmp_cache_path, [doc_key for doc_key, _ in tensor_samples], stored_info)
+        with open(join(tmp_cache_path, 'manifest.json'), 'w') as f:
+            json.dump({'file_hash': file_hash, 'file_stat': file_stat, 'line_hashes': line_hashes}, f)
+        self.replace_cache(tmp_cache_path, split_cache_path)
+        return CachedTensorExamples(split_cache_path)
+
+    def get_stored_info(self, splits=('trn', 'dev', 'tst')):
+        """ Stored info of splits in cache, read from cache on access; splits are tensorized if not yet """
+        stored_info = {'tokens': {}, 'genre_dict': {genre: idx for idx, genre in enumerate(self.config['genres'])}}
+        for split in splits:
+            if split not in self.stored_info:
+                self.stored_info[split] = CachedStoredInfo(self.get_split_examples(split).dir_path)
+        # Later splits take precedence for the same doc key
+        stored_info['subtoken_maps'] = collections.ChainMap(*[self.stored_info[split].subtoken_maps for split in reversed(splits)])
+        stored_info['gold'] = collections.ChainMap(*[self.stored_info[split].gold for split in reversed(splits)])
+        return stored_info
 
     @classmethod
     def convert_to_torch_tensor(cls, input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map,
                                 is_training, gold_starts, gold_ends, gold_mention_cluster_map):
-        input_ids = torch.tensor(input_ids, dtype=torch.long)
-        input_mask = torch.tensor(input_mask, dtype=torch.long)
-        speaker_ids = torch.tensor(speaker_ids, dtype=torch.long)
-        sentence_len = torch.tensor(sentence_len, dtype=torch.long)
+        input_ids, input_mask, speaker_ids, sentence_len, sentence_map, gold_starts, gold_ends, gold_mention_cluster_map = \
+            [torch.from_numpy(np.ascontiguousarray(tensor)) for tensor in (input_ids, input_mask, speaker_ids, sentence_len, sentence_map,
+                                                                          gold_starts, gold_ends, gold_mention_cluster_map)]
         genre = torch.tensor(genre, dtype=torch.long)
-        sentence_map = torch.tensor(sentence_map, dtype=torch.long)
         is_training = torch.tensor(is_training, dtype=torch.bool)
-        gold_starts = torch.tensor(gold_starts, dtype=torch.long)
-        gold_ends = torch.tensor(gold_ends, dtype=torch.long)
-        gold_mention_cluster_map = torch.tensor(gold_mention_cluster_map, dtype=torch.long)
         return input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map, \
                is_training, gold_starts, gold_ends, gold_mention_cluster_map,
 
     def get_cache_path(self):
-        cache_path = join(self.data_dir, f'cached.tensors.{self.language}.{self.max_seg_len}.{self.max_training_seg}.bin')
-        return cache_path
+        """ Keyed by hash of config and tokenizer vocab used in tensorization """
+        if self.cache_path is not None:
+            return self.cache_path
+        tensorize_config = {
+            'language': self.language,
+            'max_segment_len': self.max_seg_len,
+            'max_num_speakers': self.config['max_num_speakers'],
+            'genres': list(self.config['genres']),
+            'vocab': sorted(self.tokenizer.vocab.items()),
+            'column_dtypes': CachedTensorExamples.column_dtypes,
+            'stored_info_columns': CachedStoredInfo.columns
+        }
+        config_hash = util.get_content_hash(json.dumps(tensorize_config))
+        self.cache_path = join(self.data_dir, f'cached.tensors.{self.language}.{self.max_seg_len}.{config_hash[:12]}')
+        return self.cache_path
+
+
+class CachedTensorExamples:
+    """ Tensorized examples of a split stored by columns: tensors of all examples are concatenated in one .npy file per
+    tensor, with per-example offsets; files are memory-mapped (copy-on-write), so that examples are loaded on access and
+    pages are shared by processes. Same interface as a list of (doc_key, tensors) for reading.
+    """
+    seg_columns = ['input_ids', 'input_mask', 'speaker_ids', 'sentence_len']  # Indexed by segment offsets
+    word_columns = ['sentence_map']  # Indexed by word offsets
+    gold_columns = ['gold_starts', 'gold_ends', 'gold_mention_cluster_map']  # Indexed by gold mention offsets
+    column_dtypes = {  # Compact storage; widened by the model where needed
+        'input_ids': 'int32', 'input_mask': 'uint8', 'speaker_ids': 'int16', 'sentence_len': 'int32', 'sentence_map': 'int32',
+        'gold_starts': 'int32', 'gold_ends': 'int32', 'gold_mention_cluster_map': 'int32', 'genre': 'int16', 'is_training': 'bool'
+    }
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        with open(join(dir_path, 'doc_keys.json'), 'r') as f:
+            self.doc_keys = json.load(f)
+        self.columns = {name: np.load(join(dir_path, f'{name}.npy'), mmap_mode='c')
+                        for name in self.seg_columns + self.word_columns + self.gold_columns +
+                        ['genre', 'is_training', 'seg_offsets', 'word_offsets', 'gold_offsets']}
+
+    def __len__(self):
+        return len(self.doc_keys)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('example index out of range')
+        columns = self.columns
+        tensors = {}
+        for names, offsets in [(self.seg_columns, 'seg_offsets'), (self.word_columns, 'word_offsets'), (self.gold_columns, 'gold_offsets')]:
+            start, end = columns[offsets][i], columns[offsets][i + 1]
+            for name in names:
+                tensors[name] = torch.from_numpy(columns[name][start: end])
+        genre = torch.tensor(columns['genre'][i], dtype=torch.long)
+        is_training = torch.tensor(columns['is_training'][i], dtype=torch.bool)
+        return self.doc_keys[i], (tensors['input_ids'], tensors['input_mask'], tensors['speaker_ids'], tensors['sentence_len'],
+                                  genre, tensors['sentence_map'], is_training, tensors['gold_starts'], tensors['gold_ends'],
+                                  tensors['gold_mention_cluster_map'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):  # Memory-map again in other processes instead of copying
+        return {'dir_path': self.dir_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['dir_path'])
+
+    @classmethod
+    def write(cls, dir_path, tensor_samples, column_dtypes=None):
+        """ tensor_samples: list of (doc_key, numpy tensors) from Tensorizer; column_dtypes: {name: dtype} to override """
+        column_dtypes = dict(cls.column_dtypes, **(column_dtypes or {}))
+        os.makedirs(dir_path, exist_ok=True)
+        columns = {name: [] for name in cls.seg_columns + cls.word_columns + cls.gold_columns + ['genre', 'is_training']}
+        for _, (input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map, is_training,
+                gold_starts, gold_ends, gold_mention_cluster_map) in tensor_samples:
+            for name, tensor in zip(cls.seg_columns + cls.word_columns + cls.gold_columns + ['genre', 'is_training'],
+                                    [input_ids, input_mask, speaker_ids, sentence_len, sentence_map,
+                                     gold_starts, gold_ends, gold_mention_cluster_map, [int(genre)], [bool(is_training)]]):
+                columns[name].append(np.asarray(tensor, dtype=column_dtypes[name]))
+        for names, offsets in [(cls.seg_columns, 'seg_offsets'), (cls.word_columns, 'word_offsets'), (cls.gold_columns, 'gold_offsets')]:
+            lengths = [tensor.shape[0] for tensor in columns[names[0]]]
+            np.save(join(dir_path, f'{offsets}.npy'), np.cumsum([0] + lengths, dtype=np.int64))
+        for name, tensors in columns.items():
+            if tensors:
+                column = np.concatenate(tensors, axis=0)
+            else:
+                column = np.zeros(0, dtype=column_dtypes[name])
+            np.save(join(dir_path, f'{name}.npy'), column)
+        with open(join(dir_path, 'doc_keys.json'), 'w') as f:
+            json.dump([doc_key for doc_key, _ in tensor_samples], f)
+
+
+worker_tensorizer = None  # Tensorizer of each worker process
+
+
+def init_tensorize_worker(config, tokenizer):
+    global worker_tensorizer
+    worker_tensorizer = Tensorizer(config, tokenizer)
+
+
+def tensorize_worker(item):
+    """ Tensorize a jsonlines line; return with stored info of the doc, so that workers have no shared state """
+    line, is_training = item
+    doc_key, tensor = worker_tensorizer.tensorize_example(json.loads(line), is_training, truncate=False)
+    stored_info = worker_tensorizer.stored_info
+    return doc_key, tensor, stored_info['subtoken_maps'].pop(doc_key), stored_info['gold'].pop(doc_key)
+
+
+class CachedStoredInfo:
+    """ Subtoken maps and gold clusters of a split stored by columns along with CachedTensorExamples; subtoken_maps and gold
+    are read-only mappings by doc key, loaded on access
+    """
+    columns = ['subtoken_map', 'subtoken_map_offsets', 'gold_mentions', 'gold_cluster_offsets', 'gold_doc_offsets']
+
+    def __init__(self, dir_path):
+        with open(join(dir_path, 'doc_keys.json'), 'r') as f:
+            self.doc_idx = {doc_key: i for i, doc_key in enumerate(json.load(f))}
+        self.arrays = {name: np.load(join(dir_path, f'{name}.npy'), mmap_mode='r') for name in self.columns}
+        self.subtoken_maps = LazyMapping(self.doc_idx, self.get_subtoken_map)
+        self.gold = LazyMapping(self.doc_idx, self.get_gold)
+
+    def get_subtoken_map(self, i):
+        offsets = self.arrays['subtoken_map_offsets']
+        subtoken_map = self.arrays['subtoken_map'][offsets[i]: offsets[i + 1]].tolist()
+        return subtoken_map or None  # None if not in example
+
+    def get_gold(self, i):
+        doc_offsets, cluster_offsets = self.arrays['gold_doc_offsets'], self.arrays['gold_cluster_offsets']
+        cluster_start, cluster_end = doc_offsets[i], doc_offsets[i + 1]
+        mentions = self.arrays['gold_mentions'][cluster_offsets[cluster_start]: cluster_offsets[cluster_end]].tolist()
+        bounds = (cluster_offsets[cluster_start: cluster_end + 1] - cluster_offsets[cluster_start]).tolist()
+        return [mentions[start: end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    @classmethod
+    def write(cls, dir_path, doc_keys, stored_info):
+        """ stored_info: {'subtoken_maps': {doc_key: ...}, 'gold': {doc_key: ...}} for doc_keys in order """
+        subtoken_maps = [stored_info['subtoken_maps'][doc_key] or [] for doc_key in doc_keys]
+        clusters = util.flatten([stored_info['gold'][doc_key] for doc_key in doc_keys])
+        arrays = {
+            'subtoken_map': np.array(util.flatten(subtoken_maps), dtype=np.int32),
+            'subtoken_map_offsets': np.cumsum([0] + [len(subtoken_map) for subtoken_map in subtoken_maps], dtype=np.int64),
+            'gold_mentions': np.array(util.flatten(clusters), dtype=np.int32).reshape(-1, 2),
+            'gold_cluster_offsets': np.cumsum([0] + [len(cluster) for cluster in clusters], dtype=np.int64),
+            'gold_doc_offsets': np.cumsum([0] + [len(stored_info['gold'][doc_key]) for doc_key in doc_keys], dtype=np.int64)
+        }
+        for name, array in arrays.items():
+            np.save(join(dir_path, f'{name}.npy'), array)
+
+
+class LazyMapping(collections.abc.Mapping):
+    """ Read-only mapping of keys to values got by key idx on access """
+    def __init__(self, key_idx, get_value):
+        self.key_idx = key_idx
+        self.get_value = get_value
+
+    def __getitem__(self, key):
+        return self.get_value(self.key_idx[key])
+
+    def __iter__(self):
+        return iter(self.key_idx)
+
+    def __len__(self):
+        return len(self.key_idx)
+
+
+class TrainExampleDataset(torch.utils.data.Dataset):
+    """ Indexed by (epoch, example idx); long examples are truncated at an offset drawn from (seed, epoch, example idx),
+    so that each epoch sees different windows, independent of worker processes
+    """
+    def __init__(self, tensor_examples, config, seed):
+        self.tensor_examples = tensor_examples
+        self.tensorizer = Tensorizer(config, None)
+        self.max_training_sentences = config['max_training_sentences']
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.tensor_examples)
+
+    def __getitem__(self, key):
+        epoch, i = key
+        doc_key, example = self.tensor_examples[i]
+        num_sentences = example[0].shape[0]
+        if num_sentences > self.max_training_sentences:
+            rng = np.random.RandomState([self.seed, epoch, i])
+            sentence_offset = int(rng.randint(0, num_sentences - self.max_training_sentences + 1))
+            example = self.tensorizer.truncate_example(*example, sentence_offset=sentence_offset)
+        return doc_key, example
+
+
+class TrainExampleLoader:
+    """ Training examples of an epoch are prepared by train_loader_workers processes; the next train_prefetch_examples
+    examples are moved to device (from pinned memory if on GPU) by a background thread while the current step runs.
+    wait_time: total seconds that the consumer has waited for examples.
+    """
+    def __init__(self, tensor_examples, config, device, seed):
+        self.dataset = TrainExampleDataset(tensor_examples, config, seed)
+        self.device = device
+        self.num_workers = config['train_loader_workers']
+        self.num_prefetch = max(config['train_prefetch_examples'], 1)
+        self.wait_time = 0
+
+    def iter_epoch(self, epoch, order):
+        """ Yield (doc_key, example on device) in the order of example idx """
+        loader = torch.utils.data.DataLoader(self.dataset, batch_size=None, sampler=[(epoch, i) for i in order],
+                                             num_workers=self.num_workers, pin_memory=(self.device.type == 'cuda'))
+        prefetched = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def put(item):  # Give up if consumer has stopped
+            while not stop.is_set():
+                try:
+                    prefetched.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prefetch():
+            try:
+                for doc_key, example in loader:
+                    if not put((doc_key, [tensor.to(self.device, non_blocking=True) for tensor in example])):
+                        return
+                put(None)
+            except Exception as e:  # Re-raised in consumer
+                put(e)
+
+        thread = threading.Thread(target=prefetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.time()
+                item = prefetched.get()
+                self.wait_time += time.time() - start_time
+                if item is None:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+def get_length_batches(tensor_examples, max_batch_tokens):
+    """ Group examples of similar lengths to reduce padding at inference; return batches of example idx.
+    Examples are sorted by # segments and # tokens; a batch has at most max_batch_tokens tokens when its segments are
+    padded to the longest one, or a single example. Not for training, whose examples are truncated per epoch by
+    TrainExampleLoader and trained one at a time.
+    """
+    lengths = [(tensor_example[0].shape[0], int(tensor_example[3].sum()), int(tensor_example[3].max()))
+               for _, tensor_example in tensor_examples]  # (# segments, # tokens, longest segment)
+    sorted_idx = sorted(range(len(tensor_examples)), key=lambda i: lengths[i][:2])
+    batches, batch, batch_segs, batch_seg_len = [], [], 0, 0
+    for i in sorted_idx:
+        num_segs, _, seg_len = lengths[i]
+        if batch and (batch_segs + num_segs) * max(batch_seg_len, seg_len) > max_batch_tokens:
+            batches.append(batch)
+            batch, batch_segs, batch_seg_len = [], 0, 0
+        batch.append(i)
+        batch_segs, batch_seg_len = batch_segs + num_segs, max(batch_seg_len, seg_len)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_padding_stats(tensor_examples, batches):
+    """ Padding fraction of encoder input: one example per pass with full segments vs. given batches with trimmed segments """
+    num_tokens = sum(int(tensor_example[3].sum()) for _, tensor_example in tensor_examples)
+    num_tokens_full = sum(tensor_example[0].numel() for _, tensor_example in tensor_examples)
+    num_tokens_batched = 0
+    for batch in batches:
+        batch_sentence_len = [tensor_examples[i][1][3] for i in batch]
+        num_tokens_batched += sum(len(sentence_len) for sentence_len in batch_sentence_len) * \
+            max(int(sentence_len.max()) for sentence_len in batch_sentence_len)
+    return 1 - num_tokens / max(1, num_tokens_full), 1 - num_tokens / max(1, num_tokens_batched)
 
 
 class Tensorizer:
@@ -102,7 +508,7 @@ class Tensorizer:
             starts, ends = zip(*spans)
         else:
             starts, ends = [], []
-        return np.array(starts), np.array(ends)
+        return np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32)
 
     def _tensorize_span_w_labels(self, spans, label_dict):
         if len(spans) > 0:
@@ -113,19 +519,60 @@ class Tensorizer:
 
     def _get_speaker_dict(self, speakers):
         speaker_dict = {'UNK': 0, '[SPL]': 1}
-        for speaker in speakers:
+        for speaker in dict.fromkeys(speakers):  # Unique speakers in order
             if len(speaker_dict) > self.config['max_num_speakers']:
                 pass  # 'break' to limit # speakers
             if speaker not in speaker_dict:
                 speaker_dict[speaker] = len(speaker_dict)
         return speaker_dict
 
-    def tensorize_example(self, example, is_training):
+    def _convert_tokens_to_ids(self, tokens):
+        """ Same as convert_tokens_to_ids of the tokenizer; direct vocab lookup if there are no added tokens """
+        vocab = getattr(self.tokenizer, 'vocab', None)
+        if vocab is None or getattr(self.tokenizer, 'added_tokens_encoder', None):
+            return self.tokenizer.convert_tokens_to_ids(tokens)
+        unk_id = vocab.get(getattr(self.tokenizer, 'unk_token', None))
+        return [vocab.get(token, unk_id) for token in tokens]
+
+    def _get_bert_input(self, sentences, speakers, speaker_dict):
+        """ Fill preallocated [num segments, max segment len] arrays of all segments at once by the mask of valid tokens """
+        sentence_len = np.array([len(s) for s in sentences], dtype=np.int32)
+        assert sentence_len.max(initial=0) <= self.config['max_segment_len']
+        input_mask = np.arange(self.config['max_segment_len']) < sentence_len[:, None]
+        flat_speakers = util.flatten(speakers)
+        assert len(speaker_dict) <= np.iinfo(np.int16).max
+
+        input_ids = np.zeros(input_mask.shape, dtype=np.int32)
+        input_ids[input_mask] = self._convert_tokens_to_ids(util.flatten(sentences))
+        speaker_ids = np.zeros(input_mask.shape, dtype=np.int16)
+        speaker_ids[input_mask] = np.fromiter(map(speaker_dict.__getitem__, flat_speakers), dtype=np.int16,
+                                              count=len(flat_speakers))
+        return input_ids, input_mask.astype(np.uint8), speaker_ids, sentence_len
+
+    def _get_bert_input_sequential(self, sentences, speakers, speaker_dict):
+        """ Segment by segment; for benchmark """
+        max_sentence_len = self.config['max_segment_len']
+        input_ids, input_mask, speaker_ids = [], [], []
+        for idx, (sent_tokens, sent_speakers) in enumerate(zip(sentences, speakers)):
+            sent_input_ids = self.tokenizer.convert_tokens_to_ids(sent_tokens)
+            sent_input_mask = [1] * len(sent_input_ids)
+            sent_speaker_ids = [speaker_dict[speaker] for speaker in sent_speakers]
+            while len(sent_input_ids) < max_sentence_len:
+                sent_input_ids.append(0)
+                sent_input_mask.append(0)
+                sent_speaker_ids.append(0)
+            input_ids.append(sent_input_ids)
+            input_mask.append(sent_input_mask)
+            speaker_ids.append(sent_speaker_ids)
+        return np.array(input_ids), np.array(input_mask), np.array(speaker_ids), np.array([len(s) for s in sentences])
+
+    def tensorize_example(self, example, is_training, truncate=True):
+        """ truncate: truncate long training examples at a random offset; otherwise, left to TrainExampleLoader """
         # Mentions and clusters
         clusters = example['clusters']
         gold_mentions = sorted(tuple(mention) for mention in util.flatten(clusters))
         gold_mention_map = {mention: idx for idx, mention in enumerate(gold_mentions)}
-        gold_mention_cluster_map = np.zeros(len(gold_mentions))  # 0: no cluster
+        gold_mention_cluster_map = np.zeros(len(gold_mentions), dtype=np.int32)  # 0: no cluster
         for cluster_id, cluster in enumerate(clusters):
             for mention in cluster:
                 gold_mention_cluster_map[gold_mention_map[tuple(mention)]] = cluster_id + 1
@@ -136,27 +583,11 @@ class Tensorizer:
 
         # Sentences/segments
         sentences = example['sentences']  # Segments
-        sentence_map = example['sentence_map']
+        sentence_map = np.array(example['sentence_map'], dtype=np.int32)
         num_words = sum([len(s) for s in sentences])
-        max_sentence_len = self.config['max_segment_len']
-        sentence_len = np.array([len(s) for s in sentences])
 
         # Bert input
-        input_ids, input_mask, speaker_ids = [], [], []
-        for idx, (sent_tokens, sent_speakers) in enumerate(zip(sentences, speakers)):
-            sent_input_ids = self.tokenizer.convert_tokens_to_ids(sent_tokens)
-            sent_input_mask = [1] * len(sent_input_ids)
-            sent_speaker_ids = [speaker_dict[speaker] for speaker in sent_speakers]
-            while len(sent_input_ids) < max_sentence_len:
-                sent_input_ids.append(0)
-                sent_input_mask.append(0)
-                sent_speaker_ids.append(0)
-            input_ids.append(sent_input_ids)
-            input_mask.append(sent_input_mask)
-            speaker_ids.append(sent_speaker_ids)
-        input_ids = np.array(input_ids)
-        input_mask = np.array(input_mask)
-        speaker_ids = np.array(speaker_ids)
+        input_ids, input_mask, speaker_ids, sentence_len = self._get_bert_input(sentences, speakers, speaker_dict)
         assert num_words == np.sum(input_mask), (num_words, np.sum(input_mask))
 
         # Keep info to store
@@ -171,7 +602,7 @@ class Tensorizer:
         example_tensor = (input_ids, input_mask, speaker_ids, sentence_len, genre, sentence_map, is_training,
                           gold_starts, gold_ends, gold_mention_cluster_map)
 
-        if is_training and len(sentences) > self.config['max_training_sentences']:
+        if truncate and is_training and len(sentences) > self.config['max_training_sentences']:
             return doc_key, self.truncate_example(*example_tensor)
         else:
             return doc_key, example_tensor
@@ -185,8 +616,8 @@ class Tensorizer:
         sent_offset = sentence_offset
         if sent_offset is None:
             sent_offset = random.randint(0, num_sentences - max_sentences)
-        word_offset = sentence_len[:sent_offset].sum()
-        num_words = sentence_len[sent_offset: sent_offset + max_sentences].sum()
+        word_offset = int(sentence_len[:sent_offset].sum())
+        num_words = int(sentence_len[sent_offset: sent_offset + max_sentences].sum())
 
         input_ids = input_ids[sent_offset: sent_offset + max_sentences, :]
         input_mask = input_mask[sent_offset: sent_offset + max_sentences, :]
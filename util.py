@@ -1,10 +1,18 @@
 from os import makedirs
 from os.path import join
+import hashlib
+import collections
+import contextlib
+import fcntl
+import inspect
+import multiprocessing
+import time
 import numpy as np
 import pyhocon
 import logging
 import torch
 import random
+import tempfile
 from transformers import BertTokenizer
 
 
@@ -15,10 +23,83 @@ def flatten(l):
     return [item for sublist in l for item in sublist]
 
 
-def get_tokenizer(bert_tokenizer_name):
+def get_tokenizer(bert_tokenizer_name, vocab=None, do_lower_case=True):
+    """ vocab: tokens in id order to build the tokenizer in memory, instead of loading by name """
+    if vocab is not None:
+        return build_tokenizer(BertTokenizer, vocab, do_lower_case)
     return BertTokenizer.from_pretrained(bert_tokenizer_name)
 
 
+def get_fast_tokenizer(bert_tokenizer_name, vocab=None, do_lower_case=True):
+    """ Rust-backed tokenizer of the same vocabulary; None if not available """
+    try:
+        from transformers import BertTokenizerFast
+    except ImportError:
+        return None
+    if vocab is not None:
+        return build_tokenizer(BertTokenizerFast, vocab, do_lower_case)
+    return BertTokenizerFast.from_pretrained(bert_tokenizer_name)
+
+
+def build_tokenizer(tokenizer_cls, vocab, do_lower_case):
+    """ Tokenizer of vocab in memory; older tokenizers only read vocab file, written to a private temp dir and
+    read once on construction
+    """
+    if 'vocab' in inspect.signature(tokenizer_cls.__init__).parameters:
+        return tokenizer_cls(vocab={token: i for i, token in enumerate(vocab)}, do_lower_case=do_lower_case)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vocab_file = join(tmp_dir, 'vocab.txt')
+        with open(vocab_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(vocab) + '\n')
+        return tokenizer_cls(vocab_file, do_lower_case=do_lower_case)
+
+
+class WordTokenizer:
+    """ Tokenize all words of a document in one batch by the fast tokenizer if available.
+    Subtokens of recent words are kept in an LRU cache, as word frequencies are Zipfian.
+    """
+    def __init__(self, bert_tokenizer_name, cache_size=100000, use_fast=True, vocab=None, do_lower_case=True):
+        self.tokenizer = get_tokenizer(bert_tokenizer_name, vocab, do_lower_case)
+        self.fast_tokenizer = get_fast_tokenizer(bert_tokenizer_name, vocab, do_lower_case) if use_fast else None
+        self.cls_token, self.sep_token = self.tokenizer.cls_token, self.tokenizer.sep_token
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # {word: subtokens}
+        self.num_hits, self.num_lookups = 0, 0
+
+    def tokenize(self, word):
+        return self.tokenize_words([word])[0]
+
+    def tokenize_words(self, words):
+        """ Return subtokens of each word; same as tokenize() of the slow tokenizer on each word """
+        subtokens, missing = [None] * len(words), {}  # {word: [idx]}
+        for i, word in enumerate(words):
+            if word in self.cache:
+                self.cache.move_to_end(word)
+                subtokens[i] = self.cache[word]
+            else:
+                missing.setdefault(word, []).append(i)
+        self.num_lookups += len(words)
+        self.num_hits += len(words) - sum(len(idx) for idx in missing.values())
+
+        missing_words = list(missing.keys())
+        if self.fast_tokenizer is None:
+            missing_subtokens = [self.tokenizer.tokenize(word) for word in missing_words]
+        elif missing_words:
+            input_ids = self.fast_tokenizer.batch_encode_plus(missing_words, add_special_tokens=False)['input_ids']
+            missing_subtokens = [self.fast_tokenizer.convert_ids_to_tokens(ids) for ids in input_ids]
+        else:
+            missing_subtokens = []
+
+        for word, word_subtokens in zip(missing_words, missing_subtokens):
+            for i in missing[word]:
+                subtokens[i] = word_subtokens
+            if self.cache_size > 0:
+                self.cache[word] = word_subtokens
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return subtokens
+
+
 def initialize_config(config_name):
     logger.info("Running experiment: {}".format(config_name))
 
@@ -45,6 +126,20 @@ def set_seed(seed, set_gpu=True):
     logger.info('Random seed is set to %d' % seed)
 
 
+def get_content_hash(content):
+    """ Hex digest of bytes or str content """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def to_numpy(tensor):
+    """ Array of tensor on CPU; other input as array """
+    if torch.is_tensor(tensor):
+        return tensor.detach().cpu().numpy()
+    return np.asarray(tensor)
+
+
 def bucket_distance(offsets):
     """ offsets: [num spans1, num spans2] """
     # 10 semi-logscale bin: 0, 1, 2, 3, 4, (5-7)->5, (8-15)->6, (16-31)->7, (32-63)->8, (64+)->9
@@ -69,3 +164,61 @@ def batch_select(tensor, idx, device=torch.device('cpu')):
         selected = torch.squeeze(selected, -1)
 
     return selected
+
+
+def suffix_max(tensor):
+    """ Max over suffix along the first axis: out[i] = max(tensor[i:]) """
+    tensor = tensor.clone()
+    shift = 1
+    while shift < tensor.shape[0]:
+        tensor[:-shift] = torch.max(tensor[:-shift], tensor[shift:])
+        shift *= 2
+    return tensor
+
+
+def range_max(values, starts, ends):
+    """ Max of values[start:end] for each non-empty range, by sparse table of max over power-of-2 lengths; numpy """
+    levels = np.log2(ends - starts).astype(np.int64)
+    table = [values]
+    while len(table) <= levels.max(initial=0):
+        shift = 2 ** (len(table) - 1)
+        table.append(np.concatenate([np.maximum(table[-1][:-shift], table[-1][shift:]), table[-1][-shift:]]))
+    table = np.stack(table)  # [num levels, num values]: max over values[i: i + 2^level]
+    return np.maximum(table[levels, starts], table[levels, ends - 2 ** levels])
+
+
+def parallel_map(fn, items, num_workers, initializer=None, initargs=(), max_pending=None):
+    """ Lazily map items in order by a pool of num_workers processes; in current process if num_workers <= 1.
+    At most max_pending items are read ahead of the consumer, so that memory stays bounded for streamed items.
+    """
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, items)
+        return
+    max_pending = max_pending or 4 * num_workers
+    with multiprocessing.Pool(num_workers, initializer, initargs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ Exclusive lock among processes by flock on path, which is created if needed """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def log_throughput(stage, num_docs, num_subtokens, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    logger.info('%s: %d docs in %.1fs; %.1f docs/sec; %.0f subtokens/sec' %
+                (stage, num_docs, elapsed, num_docs / elapsed, num_subtokens / elapsed))